@@ -0,0 +1,492 @@
+# coding: utf-8
+"""
+End-to-end throughput benchmark of the IOTBot client against a local OPQBot stand-in.
+
+A fake OPQBot (socket.io events, the HTTP Action API and a media CDN) runs in a
+child process and sends synthetic friend and group traffic to the client, which
+delivers to a stub master channel. Reports messages/sec, p50/p99 latency from
+the event being emitted to coordinator.send_message, and peak RSS.
+
+Requires the plugin dependencies and aiohttp, run from the checkout to measure it::
+
+    PYTHONPATH=. python benchmarks/e2e_bench.py -n 2000 --mix text=70,pic=20,voice=5,file=5
+    PYTHONPATH=. python benchmarks/e2e_bench.py -n 2000 --json result.json
+    PYTHONPATH=. python benchmarks/e2e_bench.py -n 2000 --compare result.json
+
+Voices are only transcoded when the Silkv3 extension and ffmpeg are available,
+they are delivered as placeholders otherwise. Runs are seeded, so results of
+different commits are comparable.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+from typing import Callable, Dict, List, Optional
+
+BOT_QQ = 10000
+FRIEND_BASE = 20000
+GROUP_BASE = 30000
+MEMBER_BASE = 40000
+
+KINDS = ('text', 'pic', 'voice', 'file')
+
+
+# Fake OPQBot, runs in a child process
+
+def make_png(rng: random.Random, size: int) -> bytes:
+    """
+    A valid PNG of random pixels, about size bytes large
+    """
+    width = max(1, int((size / 3) ** 0.5))
+    raw = b''.join(b'\x00' + bytes(rng.getrandbits(8) for _ in range(width * 3)) for _ in range(width))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, width, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 0)) + chunk(b'IEND', b'')
+
+
+def make_silk(workdir: str, seconds: int) -> Optional[bytes]:
+    """
+    A Silk v3 voice, None if the codec or ffmpeg is missing
+    """
+    try:
+        import Silkv3
+    except ImportError:
+        return None
+    pcm = os.path.join(workdir, 'voice.pcm')
+    silk = os.path.join(workdir, 'voice.silk')
+    try:
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                        '-i', f'sine=frequency=440:duration={seconds}',
+                        '-f', 's16le', '-ac', '1', '-ar', '24000', pcm], check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if not Silkv3.encode(pcm, silk):
+        return None
+    with open(silk, 'rb') as f:
+        return f.read()
+
+
+def build_traffic(args, base_url: str, media: Dict[str, bytes]) -> List[dict]:
+    """
+    Generate the OPQBot events of the run, deterministic for a given seed
+    """
+    rng = random.Random(args.seed)
+    weights = [args.mix.get(kind, 0) for kind in KINDS]
+    events = []
+    for seq in range(1, args.messages + 1):
+        kind = rng.choices(KINDS, weights)[0]
+        is_group = rng.random() < args.group_ratio
+        if kind == 'text':
+            msg_type = 'TextMsg'
+            content = f"Benchmark message {seq} " + 'x' * rng.randint(0, 200)
+        elif kind == 'pic':
+            msg_type = 'PicMsg'
+            name = f"pic{rng.randrange(args.pic_variants)}.png"
+            pic = {'FileMd5': base64.b64encode(hashlib.md5(media[name]).digest()).decode(),
+                   'FileSize': len(media[name]), 'Url': f"{base_url}/media/{name}"}
+            if is_group:
+                pic.update(FileId=seq, ForwordBuf='', ForwordField=8)
+                content = json.dumps({'Content': '', 'GroupPic': [pic], 'Tips': '[群图片]'})
+            else:
+                pic.update(Path='')
+                content = json.dumps({'Content': '', 'FriendPic': [pic], 'Tips': '[好友图片]'})
+        elif kind == 'voice':
+            msg_type = 'VoiceMsg'
+            content = json.dumps({'Url': f"{base_url}/media/voice.silk", 'Tips': '[语音]'})
+        else:
+            msg_type = 'GroupFileMsg' if is_group else 'FriendFileMsg'
+            content = json.dumps({'FileID': f"file{seq}", 'FileName': f"file{seq}.bin",
+                                  'FileSize': len(media['file.bin']), 'Tips': '[文件]'})
+        if is_group:
+            group_id = GROUP_BASE + rng.randrange(args.groups)
+            data = {'FromGroupId': group_id, 'FromGroupName': f"Group {group_id}",
+                    'FromUserId': MEMBER_BASE + rng.randrange(args.members), 'FromNickName': 'member',
+                    'Content': content, 'MsgType': msg_type, 'MsgTime': int(time.time()), 'MsgSeq': seq,
+                    'MsgRandom': seq, 'RedBaginfo': None}
+            event = 'OnGroupMsgs'
+        else:
+            data = {'FromUin': FRIEND_BASE + rng.randrange(args.friends * 2), 'ToUin': BOT_QQ,
+                    'Content': content, 'MsgType': msg_type, 'MsgSeq': seq, 'RedBaginfo': None, 'TempUin': None}
+            event = 'OnFriendMsgs'
+        events.append({'event': event, 'seq': seq,
+                       'payload': {'CurrentPacket': {'WebConnId': '', 'Data': data}, 'CurrentQQ': BOT_QQ}})
+    return events
+
+
+def action_response(funcname: str, payload: dict, args, base_url: str) -> dict:
+    if funcname == 'GetQQUserList':
+        # Only half of the senders are friends, the others go through the profile lookup
+        friends = [{'FriendUin': FRIEND_BASE + i, 'IsRemark': False, 'NickName': f"friend{i}",
+                    'Remark': f"friend{i}", 'Status': 20} for i in range(args.friends)]
+        return {'Friendlist': friends, 'Totoal_friend_count': len(friends), 'GetfriendCount': len(friends)}
+    if funcname == 'GetGroupList':
+        return {'TroopList': [{'GroupId': GROUP_BASE + i, 'GroupName': f"Group {GROUP_BASE + i}",
+                               'GroupMemberCount': args.members, 'GroupNotice': '', 'GroupOwner': BOT_QQ,
+                               'GroupTotalCount': 500} for i in range(args.groups)], 'NextToken': ''}
+    if funcname == 'GetGroupUserList':
+        return {'MemberList': [{'MemberUin': MEMBER_BASE + i, 'NickName': f"member{i}", 'GroupCard': ''}
+                               for i in range(args.members)], 'LastUin': 0}
+    if funcname == 'GetUserInfo':
+        return {'code': 0, 'data': {'nickname': f"user{payload.get('UserID')}"}}
+    if funcname in ('OidbSvc.0x6d6_2', 'OfflineFilleHandleSvr.pb_ftn_CMD_REQ_APPLY_DOWNLOAD-1200'):
+        return {'Url': f"{base_url}/media/file.bin"}
+    return {'Ret': 0}
+
+
+def run_fake_opqbot(args, port: int, media_dir: str, ready):
+    import asyncio
+
+    import socketio
+    from aiohttp import web
+
+    logging.getLogger('aiohttp').setLevel(logging.CRITICAL)  # Clients going away abruptly are expected
+    base_url = f"http://127.0.0.1:{port}"
+    media = {}
+    for name in os.listdir(media_dir):
+        with open(os.path.join(media_dir, name), 'rb') as f:
+            media[name] = f.read()
+    media.setdefault('file.bin', bytes(64 * 1024))  # Group and friend files of replayed traffic
+    events = build_traffic(args, base_url, media) if args.messages else []
+    sio = socketio.AsyncServer(async_mode='aiohttp')
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    sio.attach(app)
+    clients = set()
+
+    @sio.event
+    def connect(sid, environ):
+        clients.add(sid)
+
+    @sio.event
+    def disconnect(sid):
+        clients.discard(sid)
+
+    async def lua_api(request: web.Request):
+        payload = await request.json() if request.can_read_body else {}
+        if getattr(args, 'api_delay', 0):
+            await asyncio.sleep(args.api_delay)
+        return web.json_response(action_response(request.query.get('funcname', ''), payload, args, base_url))
+
+    async def media_file(request: web.Request):
+        body = media.get(request.match_info['name'])
+        if body is None:
+            raise web.HTTPNotFound()
+        requested = request.http_range
+        if requested.start is None and requested.stop is None:
+            return web.Response(body=body, content_type='application/octet-stream')
+        start, stop, _ = requested.indices(len(body))
+        return web.Response(body=body[start:stop], status=206, content_type='application/octet-stream',
+                            headers={'Content-Range': f"bytes {start}-{stop - 1}/{len(body)}"})
+
+    async def status(request: web.Request):
+        return web.json_response({'clients': len(clients)})
+
+    async def run(request: web.Request):
+        # Emit the traffic and answer with when each event was emitted
+        emitted = {}
+        interval = 1 / args.rate if args.rate else 0
+        start = time.monotonic()
+        for index, event in enumerate(events):
+            if interval:
+                delay = start + index * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            emitted[event['seq']] = time.time()
+            for sid in list(clients):
+                # AsyncServer.emit of python-socketio 4 passes coroutines to asyncio.wait, which Python 3.11 rejects
+                await sio._emit_internal(sid, event['event'], event['payload'], '/')
+            if not interval and index % 50 == 0:
+                await asyncio.sleep(0)  # Let the websocket flush
+        return web.json_response(emitted)
+
+    app.router.add_route('*', '/v1/LuaApiCaller', lua_api)
+    app.router.add_get('/media/{name}', media_file)
+    app.router.add_get('/bench/status', status)
+    app.router.add_post('/bench/run', run)
+    ready.set()
+    web.run_app(app, host='127.0.0.1', port=port, print=None, handle_signals=False)
+
+
+def start_fake_opqbot(args, media_dir: str):
+    """
+    Start the fake OPQBot in a child process, serving the files of media_dir under /media
+    """
+    port = free_port()
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    server = context.Process(target=run_fake_opqbot, args=(args, port, media_dir, ready), daemon=True)
+    server.start()
+    ready.wait(30)
+    time.sleep(0.5)
+    return server, port
+
+
+# Client side
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def http_json(url: str, method: str = 'GET', timeout: float = 600):
+    request = urllib.request.Request(url, method=method, data=b'' if method == 'POST' else None)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def create_client(port: int, workdir: str, extra_config: dict, on_message: Callable[[str], None]):
+    """
+    Create the iot client for the fake OPQBot, on_message is called with the uid of each delivered message
+    """
+    from ehforwarderbot import coordinator
+    from ehforwarderbot.channel import MasterChannel, SlaveChannel
+
+    from efb_qq_plugin_iot.IOTBot import iot
+
+    class StubMaster(MasterChannel):
+        channel_name = "Benchmark master"
+        channel_emoji = "B"
+        channel_id = "bench.master"
+        supported_message_types = set()
+
+        def send_message(self, msg):
+            on_message(msg.uid)
+            return msg
+
+        def poll(self):
+            pass
+
+        def send_status(self, status):
+            pass
+
+        def stop_polling(self):
+            pass
+
+    class StubSlave(SlaveChannel):
+        channel_name = "Benchmark QQ slave"
+        channel_emoji = "Q"
+        channel_id = "bench.qq"
+        supported_message_types = set()
+
+        def get_chat(self, chat_uid):
+            raise NotImplementedError
+
+        def get_chats(self):
+            return []
+
+        def get_chat_picture(self, chat):
+            raise NotImplementedError
+
+        def poll(self):
+            pass
+
+        def send_message(self, msg):
+            return msg
+
+        def send_status(self, status):
+            pass
+
+        def stop_polling(self):
+            pass
+
+    master, slave = StubMaster(), StubSlave()
+    coordinator.add_channel(master)
+    coordinator.add_channel(slave)
+    config = {
+        'qq': BOT_QQ,
+        'host': 'http://127.0.0.1',
+        'port': port,
+        'media_cache_dir': os.path.join(workdir, 'media_cache'),
+        'avatar_cache_dir': os.path.join(workdir, 'avatars'),
+        'upload_index_path': os.path.join(workdir, 'upload_index.json'),
+        'snapshot_path': os.path.join(workdir, 'snapshot.json.gz'),
+        'optimize_cache_dir': os.path.join(workdir, 'optimized'),
+    }
+    config.update(extra_config)
+    return iot('iot', {'iot': config}, slave)
+
+
+def start_client(port: int, workdir: str, extra_config: dict, on_message: Callable[[str], None]):
+    """
+    Run the iot client against the fake OPQBot, on_message is called with the uid of each delivered message
+    """
+    client = create_client(port, workdir, extra_config, on_message)
+    threading.Thread(target=client.poll, name="bench_poll", daemon=True).start()
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while http_json(f"{base_url}/bench/status")['clients'] < 1:
+        if time.monotonic() > deadline:
+            raise RuntimeError("The client did not connect to the fake OPQBot")
+        time.sleep(0.1)
+    return client
+
+
+def latency_stats(latencies: List[float]) -> dict:
+    latencies = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else float('nan')
+
+    return {
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99),
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else float('nan'),
+    }
+
+
+def run_client(args, port: int, workdir: str) -> dict:
+    delivered: Dict[int, float] = {}
+    done = threading.Event()
+
+    def on_message(uid: str):
+        parts = uid.split('_')
+        if parts[-1] == '0':  # First message split from an OPQBot event
+            delivered.setdefault(int(parts[-2]), time.time())
+            if len(delivered) >= args.messages:
+                done.set()
+
+    client = start_client(port, workdir, args.config, on_message)
+    base_url = f"http://127.0.0.1:{port}"
+    rss_before = peak_rss_mb()
+    start = time.time()
+    emitted = {int(seq): at for seq, at in http_json(f"{base_url}/bench/run", 'POST').items()}
+    done.wait(args.timeout)
+    end = max(delivered.values()) if delivered else time.time()
+    client.stop_polling()
+
+    result = {
+        'messages': args.messages,
+        'delivered': len(delivered),
+        'duration': end - start,
+        'throughput': len(delivered) / (end - start) if end > start else float('nan'),
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_before_mb': rss_before,
+    }
+    result.update(latency_stats([delivered[seq] - emitted[seq] for seq in delivered if seq in emitted]))
+    if 1 in delivered:
+        result['first_ms'] = (delivered[1] - emitted[1]) * 1000
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown message kind {kind}, expected one of {', '.join(KINDS)}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def report(result: dict, baseline: Optional[dict] = None):
+    rows = [('delivered', 'delivered', '{:.0f}'), ('throughput', 'msg/s', '{:.1f}'), ('p50_ms', 'p50 ms', '{:.1f}'),
+            ('p99_ms', 'p99 ms', '{:.1f}'), ('mean_ms', 'mean ms', '{:.1f}'), ('first_ms', 'first msg ms', '{:.1f}'),
+            ('peak_rss_mb', 'peak RSS MiB', '{:.1f}')]
+    for key, label, fmt in rows:
+        if key not in result:
+            continue
+        line = f"{label:<14}{fmt.format(result[key]):>12}"
+        if baseline and key in baseline and baseline[key]:
+            change = (result[key] - baseline[key]) / baseline[key] * 100
+            line += f"  {fmt.format(baseline[key]):>12} ({change:+.1f}%) @ {baseline.get('revision', '?')}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--messages', type=int, default=1000, help="number of messages sent")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('text=70,pic=20,voice=5,file=5'),
+                        help="weights of the message kinds, e.g. text=70,pic=20,voice=5,file=5")
+    parser.add_argument('--rate', type=float, default=0, help="messages per second, 0 for as fast as possible")
+    parser.add_argument('--group-ratio', type=float, default=0.8, help="share of group messages")
+    parser.add_argument('--friends', type=int, default=50, help="number of friends")
+    parser.add_argument('--groups', type=int, default=20, help="number of groups")
+    parser.add_argument('--members', type=int, default=200, help="number of members per group")
+    parser.add_argument('--pic-kb', type=int, default=100, help="size of the pictures")
+    parser.add_argument('--pic-variants', type=int, default=50, help="number of distinct pictures")
+    parser.add_argument('--file-kb', type=int, default=512, help="size of the files")
+    parser.add_argument('--voice-seconds', type=int, default=5, help="duration of the voices")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the traffic generator")
+    parser.add_argument('--api-delay', type=float, default=0, help="seconds the fake OPQBot takes to answer the API")
+    parser.add_argument('--workdir', help="keep the caches and the snapshot of the client here between runs")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds to wait for the deliveries")
+    parser.add_argument('--config', type=json.loads, default={}, help="extra client config as JSON")
+    parser.add_argument('--json', help="write the result to this file")
+    parser.add_argument('--compare', help="compare with a result written by --json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.workdir:
+            workdir = args.workdir
+        media_dir = os.path.join(workdir, 'media')
+        os.makedirs(media_dir, exist_ok=True)
+        rng = random.Random(args.seed)
+        for i in range(args.pic_variants):
+            with open(os.path.join(media_dir, f"pic{i}.png"), 'wb') as f:
+                f.write(make_png(rng, args.pic_kb * 1024))
+        with open(os.path.join(media_dir, 'file.bin'), 'wb') as f:
+            f.write(bytes(rng.getrandbits(8) for _ in range(args.file_kb * 1024)))
+        voice = make_silk(workdir, args.voice_seconds)
+        with open(os.path.join(media_dir, 'voice.silk'), 'wb') as f:
+            f.write(voice or b'#!SILK_V3' + bytes(1024))
+        if voice is None:
+            print("Silkv3 or ffmpeg missing, voices are delivered as placeholders.")
+
+        server, port = start_fake_opqbot(args, media_dir)
+        try:
+            result = run_client(args, port, workdir)
+        finally:
+            server.terminate()
+
+    result['revision'] = git_revision()
+    result['args'] = {key: value for key, value in vars(args).items() if key not in ('json', 'compare', 'workdir')}
+    print(f"{args.messages} messages, mix {args.mix}, revision {result['revision'] or 'unknown'}")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('args') != result['args']:
+            print("Warning: the baseline was run with different arguments.")
+    report(result, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if result['delivered'] < result['messages']:
+        print(f"Only {result['delivered']} of {result['messages']} messages were delivered in time.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
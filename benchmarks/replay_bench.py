@@ -0,0 +1,124 @@
+# coding: utf-8
+"""
+Replay a traffic log recorded with the traffic_log option through the IOTBot client.
+
+The client runs against the fake OPQBot of e2e_bench.py, which answers the Action API
+and serves the media fixtures saved with traffic_log_media. Records are fed through the
+entry points of botoy at their original pace, faster, or as fast as possible::
+
+    PYTHONPATH=. python benchmarks/replay_bench.py traffic.jsonl.gz --fixtures traffic_media
+    PYTHONPATH=. python benchmarks/replay_bench.py traffic.jsonl.gz --speed 10
+    PYTHONPATH=. python benchmarks/replay_bench.py traffic.jsonl.gz --speed 0 --json result.json
+
+Only the first message split from each record is timed, events are fed but not timed.
+Media which were not saved as fixtures point to their original URLs and likely fail to download.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict
+
+from e2e_bench import BOT_QQ, git_revision, latency_stats, peak_rss_mb, report, start_client, start_fake_opqbot
+
+from efb_qq_plugin_iot.TrafficLog import TrafficReplayer, read_traffic
+
+
+def record_key(record: Dict) -> str:
+    """
+    Prefix of the uids of the messages delivered for a record
+    """
+    data = record['message'].get('CurrentPacket', {}).get('Data', {})
+    if record['kind'] == 'group':
+        return f"group_{data.get('FromGroupId')}_{data.get('MsgSeq')}"
+    return f"friend_{data.get('FromUin')}_{data.get('MsgSeq')}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('log', help="traffic log to replay")
+    parser.add_argument('--fixtures', help="media saved with the log")
+    parser.add_argument('--speed', type=float, default=1, help="1 for the original pace, 0 for as fast as possible")
+    parser.add_argument('--limit', type=int, default=0, help="replay at most this many records")
+    parser.add_argument('--friends', type=int, default=0, help="number of friends of the fake account")
+    parser.add_argument('--groups', type=int, default=0, help="number of groups of the fake account")
+    parser.add_argument('--members', type=int, default=0, help="number of members per group")
+    parser.add_argument('--idle', type=float, default=10, help="stop once nothing was delivered for this long")
+    parser.add_argument('--config', type=json.loads, default={}, help="extra client config as JSON")
+    parser.add_argument('--json', help="write the result to this file")
+    parser.add_argument('--compare', help="compare with a result written by --json")
+    args = parser.parse_args()
+    args.messages = 0  # The fake OPQBot emits nothing by itself
+    logging.basicConfig(level=logging.WARNING)
+
+    fed: Dict[str, float] = {}
+    delivered: Dict[str, float] = {}
+    last_delivery = [time.monotonic()]
+
+    def on_record(record: Dict):
+        if record['kind'] != 'event':
+            fed.setdefault(record_key(record), time.time())
+
+    def on_message(uid: str):
+        prefix, _, index = uid.rpartition('_')
+        if index == '0':
+            delivered.setdefault(prefix, time.time())
+            last_delivery[0] = time.monotonic()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        media_dir = args.fixtures or os.path.join(workdir, 'media')
+        os.makedirs(media_dir, exist_ok=True)
+        server, port = start_fake_opqbot(args, media_dir)
+        try:
+            client = start_client(port, workdir, args.config, on_message)
+            replayer = TrafficReplayer({'friend': client.bot.friend_msg_handler,
+                                        'group': client.bot.group_msg_handler,
+                                        'event': client.bot.event_handler},
+                                       speed=args.speed, fixture_url=f"http://127.0.0.1:{port}/media", qq=BOT_QQ)
+            records = read_traffic(args.log)
+            if args.limit:
+                records = (record for _, record in zip(range(args.limit), records))
+            rss_before = peak_rss_mb()
+            start = time.time()
+            count = replayer.replay(records, on_record)
+            last_delivery[0] = time.monotonic()
+            while len(delivered) < len(fed) and time.monotonic() - last_delivery[0] < args.idle:
+                time.sleep(0.1)
+            end = max(delivered.values()) if delivered else time.time()
+            client.stop_polling()
+        finally:
+            server.terminate()
+
+    result = {
+        'records': count,
+        'messages': len(fed),
+        'delivered': len(delivered),
+        'duration': end - start,
+        'throughput': len(delivered) / (end - start) if end > start else float('nan'),
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_before_mb': rss_before,
+        'revision': git_revision(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('json', 'compare')},
+    }
+    result.update(latency_stats([delivered[key] - fed[key] for key in delivered if key in fed]))
+    print(f"{count} records replayed from {args.log} at speed {args.speed or 'max'}, "
+          f"revision {result['revision'] or 'unknown'}")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if result['delivered'] < result['messages']:
+        print(f"{result['messages'] - result['delivered']} messages were not delivered, "
+              f"e.g. filtered or unsupported.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# coding: utf-8
+"""
+Startup time of the IOTBot client: importing the module, creating the client and connecting to OPQBot.
+
+Each run happens in a fresh interpreter so imports are cold, against the fake OPQBot of e2e_bench.py::
+
+    PYTHONPATH=. python benchmarks/startup_bench.py -n 10
+    PYTHONPATH=. python benchmarks/startup_bench.py -n 10 --imports 15
+    PYTHONPATH=. python benchmarks/startup_bench.py -n 10 --json result.json
+    PYTHONPATH=. python benchmarks/startup_bench.py -n 10 --compare result.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+STAGES = ('import_ms', 'create_ms', 'connect_ms', 'total_ms')
+
+
+def child(port: int, workdir: str, config: dict):
+    """
+    One startup, timings are printed as JSON on the last line
+    """
+    start = time.perf_counter()
+    import efb_qq_plugin_iot.IOTBot  # noqa: F401
+    imported = time.perf_counter()
+
+    import threading
+
+    from e2e_bench import create_client
+
+    client = create_client(port, workdir, config, lambda uid: None)
+    created = time.perf_counter()
+    threading.Thread(target=client.poll, daemon=True).start()
+    while client.sio is None or not client.sio.connected:  # poll sets sio once connected
+        time.sleep(0.001)
+    connected = time.perf_counter()
+    heavy = sorted(name for name in ('magic', 'pydub', 'Silkv3', 'PIL', 'botoy.refine') if name in sys.modules)
+    print(json.dumps({'import_ms': (imported - start) * 1000,
+                      'create_ms': (created - imported) * 1000,
+                      'connect_ms': (connected - created) * 1000,
+                      'total_ms': (connected - start) * 1000,
+                      'loaded': heavy}))
+    sys.stdout.flush()
+    os._exit(0)  # Skip tearing down the client, it is not part of the startup
+
+
+def run_child(port: int, workdir: str, config: dict, importtime: bool) -> Dict:
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + \
+        [os.path.abspath(__file__), '--child', str(port), workdir, json.dumps(config)]
+    process = subprocess.run(command, capture_output=True, text=True, timeout=120,
+                             env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    if process.returncode != 0:
+        raise RuntimeError(f"Startup failed:\n{process.stderr[-2000:]}")
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    if importtime:
+        result['imports'] = parse_importtime(process.stderr)
+    return result
+
+
+def parse_importtime(output: str) -> Dict[str, int]:
+    """
+    Cumulative import time in microseconds of the top level packages, nested imports included
+    """
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        top = name.strip().split('.')[0]
+        if top not in ('efb_qq_plugin_iot', 'e2e_bench', 'site'):
+            imports[top] = max(imports.get(top, 0), int(cumulative))
+    return imports
+
+
+def summarize(runs: List[Dict]) -> Dict:
+    result = {}
+    for stage in STAGES:
+        values = sorted(run[stage] for run in runs)
+        result[stage] = statistics.median(values)
+        result[stage.replace('_ms', '_min_ms')] = values[0]
+    result['loaded'] = runs[-1]['loaded']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5, help="number of startups measured")
+    parser.add_argument('--imports', type=int, default=0, help="list this many of the slowest imported packages")
+    parser.add_argument('--warm', action='store_true', help="keep the client state between runs, e.g. the snapshot")
+    parser.add_argument('--config', type=json.loads, default={}, help="extra client config as JSON")
+    parser.add_argument('--json', help="write the result to this file")
+    parser.add_argument('--compare', help="compare with a result written by --json")
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(int(args.child[0]), args.child[1], json.loads(args.child[2]))
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from e2e_bench import git_revision, start_fake_opqbot
+
+    server_args = argparse.Namespace(messages=0, friends=50, groups=20, members=200)
+    runs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        server, port = start_fake_opqbot(server_args, workdir)
+        try:
+            for i in range(args.runs):
+                run_dir = workdir if args.warm else tempfile.mkdtemp(dir=workdir)
+                runs.append(run_child(port, run_dir, args.config, importtime=False))
+            imports = run_child(port, tempfile.mkdtemp(dir=workdir), args.config, importtime=True)['imports'] \
+                if args.imports else {}
+        finally:
+            server.terminate()
+
+    result = summarize(runs)
+    result['revision'] = git_revision()
+    result['args'] = {'runs': args.runs, 'warm': args.warm, 'config': args.config}
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(f"{args.runs} startups, median (min), revision {result['revision'] or 'unknown'}")
+    for stage in STAGES:
+        line = f"{stage[:-3]:<10}{result[stage]:>10.1f}ms ({result[stage.replace('_ms', '_min_ms')]:.1f}ms)"
+        if baseline and baseline.get(stage):
+            change = (result[stage] - baseline[stage]) / baseline[stage] * 100
+            line += f"  {baseline[stage]:>10.1f}ms ({change:+.1f}%) @ {baseline.get('revision', '?')}"
+        print(line)
+    print(f"Optional dependencies loaded: {', '.join(result['loaded']) or 'none'}")
+    if imports:
+        print("Slowest imports:")
+        for name, micros in sorted(imports.items(), key=lambda item: -item[1])[:args.imports]:
+            print(f"  {name:<24}{micros / 1000:>8.1f}ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
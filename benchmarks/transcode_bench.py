@@ -0,0 +1,113 @@
+# coding: utf-8
+"""
+Compare the in-memory and the temporary file voice transcoding paths
+on latency and disk writes, for both directions.
+
+Requires ffmpeg and the Silkv3 extension, e.g. after ``pip install -e .``::
+
+    python benchmarks/transcode_bench.py -n 20 --seconds 10
+"""
+import argparse
+import os
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+from typing import Callable, List, Tuple
+
+from efb_qq_plugin_iot.Transcoder import IN_MEMORY_SUPPORTED, SILK_SAMPLE_RATE, audio_to_silk, ffmpeg, \
+    silk_to_opus
+
+
+def disk_writes() -> int:
+    """
+    Bytes sent to the storage layer by this process and its finished children
+    """
+    written = 0
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    written = int(line.split()[1])
+    except OSError:
+        pass
+    return written + resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock * 512
+
+
+def make_samples(workdir: str, seconds: int) -> Tuple[str, str]:
+    """
+    Create an Ogg Opus voice and its Silk v3 counterpart
+    """
+    import Silkv3
+
+    source = os.path.join(workdir, 'source.ogg')
+    pcm = os.path.join(workdir, 'source.pcm')
+    silk = os.path.join(workdir, 'source.silk')
+    ffmpeg(['-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+            '-c:a', 'libopus', '-f', 'ogg', source])
+    ffmpeg(['-i', source, '-f', 's16le', '-ac', '1', '-ar', str(SILK_SAMPLE_RATE), pcm])
+    if not Silkv3.encode(pcm, silk):
+        raise RuntimeError("Failed to encode the Silk sample")
+    return source, silk
+
+
+def measure(func: Callable[[], None], rounds: int) -> Tuple[List[float], int]:
+    func()  # Warm up
+    os.sync()
+    latencies = []
+    written = disk_writes()
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    os.sync()
+    return latencies, disk_writes() - written
+
+
+def report(name: str, latencies: List[float], written: int):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"{name:<28} mean {statistics.mean(latencies) * 1000:8.1f} ms  "
+          f"p50 {statistics.median(latencies) * 1000:8.1f} ms  p95 {p95 * 1000:8.1f} ms  "
+          f"disk {written / len(latencies) / 1024:8.1f} KiB/op")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--rounds', type=int, default=20, help="rounds per path")
+    parser.add_argument('--seconds', type=int, default=10, help="duration of the sample voice")
+    args = parser.parse_args()
+    if not IN_MEMORY_SUPPORTED:
+        print("In-memory transcoding is not supported on this platform, only the file path is measured.")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source, silk = make_samples(workdir, args.seconds)
+        print(f"Sample: {args.seconds}s voice, {os.path.getsize(source)} bytes Opus, "
+              f"{os.path.getsize(silk)} bytes Silk, {args.rounds} rounds")
+        output = os.path.join(workdir, 'output.ogg')
+
+        def inbound(in_memory: bool):
+            assert silk_to_opus(silk, output, in_memory)
+
+        def outbound(in_memory: bool):
+            # The file path overwrites its input, always work on a fresh copy
+            with tempfile.NamedTemporaryFile(dir=workdir) as copy:
+                with open(source, 'rb') as f:
+                    shutil.copyfileobj(f, copy)
+                copy.flush()
+                result = audio_to_silk(copy, in_memory)
+                assert result is not None
+                result.close()
+
+        modes = [False, True] if IN_MEMORY_SUPPORTED else [False]
+        for in_memory in modes:
+            label = 'memory' if in_memory else 'file'
+            report(f"inbound  Silk->Opus ({label})", *measure(lambda: inbound(in_memory), args.rounds))
+        for in_memory in modes:
+            label = 'memory' if in_memory else 'file'
+            report(f"outbound audio->Silk ({label})", *measure(lambda: outbound(in_memory), args.rounds))
+
+
+if __name__ == '__main__':
+    main()
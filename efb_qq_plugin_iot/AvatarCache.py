@@ -0,0 +1,148 @@
+# coding: utf-8
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import IO, Callable, Dict, Optional, Union
+
+from cachetools import LRUCache
+
+from efb_qq_plugin_iot.Downloader import Downloader
+
+logger = logging.getLogger(__name__)
+
+
+class AvatarCache:
+    """
+    Persistent avatar store with conditional revalidation.
+
+    Avatars younger than the freshness window are served from disk without
+    any request. Older ones are revalidated with ``If-None-Match`` /
+    ``If-Modified-Since``, so an unchanged avatar costs a single 304.
+    """
+
+    def __init__(self, path: Union[str, Path], downloader: Downloader, fresh_time: int = 86400,
+                 max_entries: int = 4096):
+        """
+        :param path: The directory to store avatars in
+        :param downloader: The downloader used to fetch avatars
+        :param fresh_time: Seconds during which a stored avatar is served without revalidation
+        :param max_entries: Max number of avatars whose metadata is kept in memory, others are read from disk
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.downloader = downloader
+        self.fresh_time = fresh_time
+        self.meta: LRUCache = LRUCache(maxsize=max_entries)
+        self.lock = threading.Lock()
+        # Evicting the lock of an avatar being fetched only lets a duplicate fetch through,
+        # which is harmless as files are replaced atomically
+        self.key_locks: LRUCache = LRUCache(maxsize=max_entries)
+        self.counters = {
+            'fresh': 0,
+            'revalidated': 0,
+            'fetched': 0,
+        }
+
+    def _load_meta(self, key: str) -> Optional[Dict]:
+        with self.lock:
+            meta = self.meta.get(key)
+        if meta is None:
+            try:
+                with open(self.path / f"{key}.json") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return None
+            with self.lock:
+                self.meta[key] = meta
+        return meta
+
+    def _save_meta(self, key: str, meta: Dict):
+        self._write(self.path / f"{key}.json", 'w', lambda f: json.dump(meta, f))
+        with self.lock:
+            self.meta[key] = meta
+
+    def _write(self, file_path: Path, mode: str, write: Callable[[IO], None]):
+        """
+        Write a temporary file and move it to file_path, so readers never see a partial file.
+        The temporary file is removed when writing fails.
+        """
+        tmp_name = None
+        try:
+            with tempfile.NamedTemporaryFile(mode, dir=self.path, prefix='.', delete=False) as f:
+                tmp_name = f.name
+                write(f)
+            os.replace(tmp_name, file_path)
+            tmp_name = None
+        finally:
+            if tmp_name is not None:
+                try:
+                    os.unlink(tmp_name)
+                except OSError:
+                    pass
+
+    def get(self, key: str, url: str) -> IO:
+        """
+        Get the avatar, fetching or revalidating it when needed.
+        Remember to close the file once you are done with the file!
+
+        :param key: Unique name of the avatar, including its size variant
+        :param url: The URL that points to the avatar
+        :return: File handle of the stored avatar
+        """
+        with self.lock:
+            key_lock = self.key_locks.get(key)
+            if key_lock is None:
+                key_lock = self.key_locks[key] = threading.Lock()
+        with key_lock:  # Concurrent requests of the same avatar share one fetch
+            file_path = self.path / key
+            meta = self._load_meta(key)
+            if meta is not None and not file_path.exists():
+                meta = None
+            if meta and time.time() - meta.get('checked_at', 0) < self.fresh_time:
+                self._count('fresh')
+                return open(file_path, 'rb')
+
+            headers = {}
+            if meta:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+            try:
+                r = self.downloader.request(url, headers=headers)
+            except Exception as e:
+                if meta:  # Serve the stale copy rather than nothing
+                    logger.warning(f"Failed to revalidate avatar {key}, serving the stored copy. {e}")
+                    return open(file_path, 'rb')
+                raise
+            with r:
+                if r.status_code == 304 and meta:
+                    self._count('revalidated')
+                    meta['checked_at'] = time.time()
+                    self._save_meta(key, meta)
+                    return open(file_path, 'rb')
+
+                def download(f: IO):
+                    for chunk in r.iter_content(self.downloader.chunk_size):
+                        f.write(chunk)
+
+                self._write(file_path, 'wb', download)
+                self._count('fetched')
+                self._save_meta(key, {
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                    'checked_at': time.time(),
+                })
+            return open(file_path, 'rb')
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
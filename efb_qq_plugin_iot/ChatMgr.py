@@ -1,70 +1,168 @@
 # coding: utf-8
-import contextlib
 import logging
-from typing import Dict, Optional, List
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, List, Union
 
 from ehforwarderbot.channel import SlaveChannel
-from ehforwarderbot.chat import GroupChat, PrivateChat, ChatMember
+from ehforwarderbot.chat import Chat, GroupChat, PrivateChat, ChatMember, SelfChatMember
 
 from efb_qq_plugin_iot.CustomTypes import EFBGroupMember, EFBGroupChat, EFBPrivateChat
 
 logger = logging.getLogger(__name__)
 
 
+class ChatEntry:
+    def __init__(self, chat: Chat):
+        self.chat = chat
+        self.members: Dict[str, ChatMember] = {member.uid: member for member in chat.members
+                                               if not isinstance(member, SelfChatMember)}
+        self.used_at = time.monotonic()
+
+
 class ChatMgr:
+    """
+    Builds EFB chat objects and keeps the live ones in a registry keyed by chat uid,
+    so every message of a chat reuses the same object and its indexed members.
+    Chats unused for ``idle_time`` seconds, or the least recently used beyond
+    ``max_chats``, are dropped and built again when needed.
+    """
     slave_channel = None
+    max_chats = 2000
+    idle_time = 3600
+
+    chats: 'OrderedDict[str, ChatEntry]' = OrderedDict()
+    lock = threading.RLock()
+
+    @staticmethod
+    def _update(target: Union[Chat, ChatMember], name: str, alias: Optional[str]):
+        if name and target.name != name:
+            target.name = name
+        if alias is not None and target.alias != (alias or None):
+            target.alias = alias or None
+
+    @staticmethod
+    def _entry(uid: str) -> Optional[ChatEntry]:
+        """
+        Get the registered entry of a chat, the caller must hold ChatMgr.lock
+        """
+        entry = ChatMgr.chats.get(uid)
+        if entry is not None:
+            entry.used_at = time.monotonic()
+            ChatMgr.chats.move_to_end(uid)
+        return entry
+
+    @staticmethod
+    def _register(chat: Chat) -> ChatEntry:
+        """
+        Register a new chat and evict the idle ones, the caller must hold ChatMgr.lock
+        """
+        entry = ChatMgr.chats[chat.uid] = ChatEntry(chat)
+        now = time.monotonic()
+        while ChatMgr.chats:
+            uid, oldest = next(iter(ChatMgr.chats.items()))
+            if len(ChatMgr.chats) <= ChatMgr.max_chats and now - oldest.used_at < ChatMgr.idle_time:
+                break
+            del ChatMgr.chats[uid]
+        return entry
 
     @staticmethod
     def build_efb_chat_as_group(group: EFBGroupChat,
                                 members: Optional[List[EFBGroupMember]] = None) -> GroupChat:
         """
-        Build EFB GroupChat object from EFBGroupChat Dict
+        Build EFB GroupChat object from EFBGroupChat Dict,
+        or update the registered one in place
 
         :return: GroupChat from group_id
         :param group: EFBGroupChat object, see CustomTypes.py
         :param members: Optional, the member list for the specific group, None by default
                         Each object in members (if not None) must follow the syntax of GroupChat.add_members
+                        When given, it replaces the members of the registered chat
         """
-        efb_chat: GroupChat = GroupChat(
-            channel=ChatMgr.slave_channel,
-            **group
-        )
-        if members:
-            for member in members:
-                efb_chat.add_member(
-                    **member
-                )
-        return efb_chat
+        with ChatMgr.lock:
+            entry = ChatMgr._entry(group['uid'])
+            if entry is None or not isinstance(entry.chat, GroupChat):
+                entry = ChatMgr._register(GroupChat(
+                    channel=ChatMgr.slave_channel,
+                    **group
+                ))
+            else:
+                ChatMgr._update(entry.chat, group.get('name', ''), group.get('alias'))
+            if members:
+                ChatMgr._sync_members(entry, members)
+            return entry.chat
+
+    @staticmethod
+    def _sync_members(entry: ChatEntry, members: List[EFBGroupMember]):
+        latest = {str(member['uid']): member for member in members}
+        for uid in entry.members.keys() - latest.keys():
+            entry.chat.members.remove(entry.members.pop(uid))
+        for uid, member in latest.items():
+            efb_member = entry.members.get(uid)
+            if efb_member is None:
+                entry.members[uid] = entry.chat.add_member(**member)
+            else:
+                ChatMgr._update(efb_member, member.get('name', ''), member.get('alias'))
 
     @staticmethod
     def build_efb_chat_as_private(private: EFBPrivateChat) -> PrivateChat:
         """
-        Build EFB PrivateChat object from EFBPrivateChat
+        Build EFB PrivateChat object from EFBPrivateChat,
+        or update the registered one in place
 
         :return: GroupChat from group_id
         :param private: EFBPrivateChat object, see CustomTypes.py
         """
-        efb_chat: PrivateChat = PrivateChat(
-            channel=ChatMgr.slave_channel,
-            **private
-        )
-        return efb_chat
+        with ChatMgr.lock:
+            entry = ChatMgr._entry(private['uid'])
+            if entry is None or not isinstance(entry.chat, PrivateChat):
+                entry = ChatMgr._register(PrivateChat(
+                    channel=ChatMgr.slave_channel,
+                    **private
+                ))
+            else:
+                ChatMgr._update(entry.chat, private.get('name', ''), private.get('alias'))
+                ChatMgr._update(entry.chat.other, private.get('name', ''), private.get('alias'))
+            return entry.chat
 
     @staticmethod
     def build_efb_chat_as_member(chat: GroupChat, member: EFBGroupMember) -> ChatMember:
         """
         Build EFB ChatMember object from GroupChat and EFBGroupMember.
-        It'll try to get member from GroupChat, if one is not found then a new member is added.
+        It'll try to get member from GroupChat and update its names, if one is not found then a new member is added.
 
         :param chat: Original GroupChat
         :param member: EFBGroupMember object, see CustomTypes.py
         :return: Newly built ChatMember
         """
-        with contextlib.suppress(KeyError):
-            return chat.get_member(str(member.get('uid', '')))
-        efb_chat: ChatMember = chat.add_member(
-            **member
-        )
-        return efb_chat
+        uid = str(member.get('uid', ''))
+        with ChatMgr.lock:
+            entry = ChatMgr.chats.get(chat.uid)
+            if entry is None or entry.chat is not chat:  # Not a registered chat
+                entry = ChatEntry(chat)
+            efb_member = entry.members.get(uid)
+            if efb_member is not None:
+                ChatMgr._update(efb_member, member.get('name', ''), member.get('alias'))
+                return efb_member
+            efb_member = entry.members[uid] = chat.add_member(
+                **member
+            )
+            return efb_member
 
+    @staticmethod
+    def get_member(chat_uid: str, member_uid: str) -> Optional[ChatMember]:
+        """
+        Look up a member of a registered chat
+        """
+        with ChatMgr.lock:
+            entry = ChatMgr.chats.get(chat_uid)
+            return entry.members.get(str(member_uid)) if entry else None
 
+    @staticmethod
+    def evict(chat_uid: str):
+        """
+        Drop a chat from the registry, it will be built again on next use
+        """
+        with ChatMgr.lock:
+            ChatMgr.chats.pop(chat_uid, None)
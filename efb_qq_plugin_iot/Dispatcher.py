@@ -0,0 +1,117 @@
+# coding: utf-8
+import bisect
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Processes inbound messages on a bounded set of workers,
+    one message at a time per chat and different chats in parallel.
+
+    Messages reach the handlers through the thread pool of botoy, so two messages
+    of a chat arriving close together may be submitted out of order: pending
+    messages of a chat are kept sorted by their sequence number to make up for it.
+    At most ``max_pending`` messages wait at the same time, submitting beyond
+    that blocks the caller until a message is done.
+    """
+
+    def __init__(self, workers: int = 8, max_pending: int = 1000, batch: int = 8):
+        """
+        :param workers: Max number of chats processed at the same time
+        :param max_pending: Max number of messages queued or being processed
+        :param batch: Max number of messages processed in a row for a chat before letting other chats go first
+        """
+        self.batch = max(1, int(batch))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="iot_dispatch")
+        self.slots = threading.BoundedSemaphore(max(1, int(max_pending)))
+        self.queues: Dict[Hashable, List[Tuple[int, int, Callable[[], None]]]] = {}
+        self.running = set()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.counters = {
+            'dispatched': 0,
+            'failures': 0,
+            'blocked': 0,
+            'reordered': 0,
+            'max_depth': 0,
+        }
+
+    def submit(self, key: Hashable, func: Callable[[], None], seq: Optional[int] = None):
+        """
+        Queue func after the other messages of the same chat
+
+        :param key: The chat the message belongs to
+        :param func: Processes the message
+        :param seq: Sequence number of the message in the chat, if known
+        """
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.counters['blocked'] += 1
+            logger.warning(f"Too many messages pending, waiting before queuing a message of {key}.")
+            self.slots.acquire()
+        with self.lock:
+            queue = self.queues.setdefault(key, [])
+            if seq is None:
+                seq = queue[-1][0] if queue else 0
+            elif queue and seq < queue[-1][0]:
+                self.counters['reordered'] += 1
+            bisect.insort(queue, (seq, next(self.order), func))
+            self.counters['max_depth'] = max(self.counters['max_depth'], len(queue))
+            if key in self.running:
+                return
+            self.running.add(key)
+        self._schedule(key)
+
+    def _schedule(self, key: Hashable):
+        try:
+            self.executor.submit(self._drain, key)
+        except RuntimeError:  # Shut down, drop what is left
+            with self.lock:
+                for _ in self.queues.pop(key, []):
+                    self.slots.release()
+                self.running.discard(key)
+
+    def _drain(self, key: Hashable):
+        for _ in range(self.batch):
+            with self.lock:
+                queue = self.queues.get(key)
+                if not queue:
+                    self.queues.pop(key, None)
+                    self.running.discard(key)
+                    return
+                _, _, func = queue.pop(0)
+            try:
+                func()
+            except Exception as e:
+                logger.exception(f"Failed to process a message of {key}! {e}")
+                with self.lock:
+                    self.counters['failures'] += 1
+            finally:
+                self.slots.release()
+                with self.lock:
+                    self.counters['dispatched'] += 1
+        self._schedule(key)  # Requeue behind the other chats
+
+    def depth(self, key: Hashable) -> int:
+        """
+        Number of messages of a chat waiting to be processed
+        """
+        with self.lock:
+            return len(self.queues.get(key, ()))
+
+    def stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['chats'] = len(self.queues)
+            stats['pending'] = sum(len(queue) for queue in self.queues.values())
+            stats['depths'] = {key: len(queue) for key, queue in self.queues.items() if queue}
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,419 @@
+# coding: utf-8
+import logging
+import random
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import IO, Any, Dict, Iterator, Optional
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from efb_qq_plugin_iot.MediaBuffer import BufferPool, MediaBuffer
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+# Leading bytes kept as file.head while downloading, to sniff the content type without reading it back
+HEAD_SIZE = 64 * 1024
+
+
+class DownloadTooLarge(IOError):
+    pass
+
+
+def content_length(r: requests.Response) -> Optional[int]:
+    """
+    Size of the whole file, from Content-Range for partial responses, None if unknown
+    """
+    if r.status_code == 206:
+        match = CONTENT_RANGE.match(r.headers.get('Content-Range', ''))
+        if match and match.group(3) != '*':
+            return int(match.group(3))
+        return None
+    if 'Content-Encoding' in r.headers and r.headers['Content-Encoding'] != 'identity':
+        return None  # Content-Length is the compressed size
+    try:
+        return int(r.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def range_headers(start: Optional[int], end: Optional[int] = None) -> Dict[str, str]:
+    """
+    Headers requesting bytes [start, end) of the file, the whole file when start is None.
+    Ranges must be counted on the file as stored, so the content is never compressed on the fly.
+    """
+    headers = {'Accept-Encoding': 'identity'}
+    if start is not None:
+        headers['Range'] = f"bytes={start}-{end - 1 if end is not None else ''}"
+    return headers
+
+
+def content_range_start(r: requests.Response) -> Optional[int]:
+    match = CONTENT_RANGE.match(r.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+
+def content_range_end(r: requests.Response) -> Optional[int]:
+    """
+    End of the bytes of a partial response, exclusive
+    """
+    match = CONTENT_RANGE.match(r.headers.get('Content-Range', ''))
+    return int(match.group(2)) + 1 if match else None
+
+
+class Downloader:
+    """
+    Shared HTTP downloader backed by a keep-alive ``requests.Session``.
+
+    urllib3 keeps one connection pool per host, so repeated downloads from the
+    qlogo/gchat CDNs reuse the established TCP+TLS connections instead of
+    paying a new handshake for every image, voice, video, file or avatar.
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 16,
+                 connect_timeout: float = 5, read_timeout: float = 10,
+                 retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8,
+                 chunk_size: int = 64 * 1024, max_chunk_size: int = 1024 * 1024,
+                 max_size: Optional[int] = 100 * 1024 * 1024, min_free_space: Optional[int] = 512 * 1024 * 1024,
+                 range_threshold: int = 4 * 1024 * 1024, range_parts: int = 4, range_workers: int = 4,
+                 buffers: Optional[BufferPool] = None):
+        """
+        :param pool_connections: The number of per-host connection pools to keep
+        :param pool_maxsize: The max number of connections kept in each per-host pool
+        :param connect_timeout: Seconds to wait for a connection to be established
+        :param read_timeout: Seconds to wait between bytes received from the server
+        :param retries: The max attempts before giving up
+        :param backoff_base: Base delay of the exponential backoff in seconds
+        :param backoff_max: Upper bound of a single backoff delay in seconds
+        :param chunk_size: Size of the first chunk read from a response
+        :param max_chunk_size: Chunks grow up to this size as the transfer goes on
+        :param max_size: Default max number of bytes of a download, None for no limit
+        :param min_free_space: Free disk space in bytes a download must leave, None for no check
+        :param range_threshold: Files at least this large are downloaded as range_parts parallel ranges,
+                                files larger than range_threshold / range_parts as two
+        :param range_parts: The number of ranges a large file is split into
+        :param range_workers: Max number of ranges downloaded at the same time across all downloads
+        :param buffers: Where files are downloaded to, small ones stay in memory
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = max(1, int(retries))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max(chunk_size, max_chunk_size)
+        self.max_size = max_size
+        self.min_free_space = min_free_space
+        self.range_threshold = range_threshold
+        self.range_parts = max(1, int(range_parts))
+        self.range_workers = max(1, int(range_workers))
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.buffers = buffers or BufferPool()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                   max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'retries': 0,
+            'failures': 0,
+            'bytes': 0,
+            'ranged': 0,
+            'resumed': 0,
+            'too_large': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'Downloader':
+        return cls(pool_connections=config.get('download_pool_connections', 10),
+                   pool_maxsize=config.get('download_pool_maxsize', 16),
+                   connect_timeout=config.get('download_connect_timeout', 5),
+                   read_timeout=config.get('download_read_timeout', 10),
+                   retries=config.get('download_retries', 3),
+                   backoff_base=config.get('download_backoff_base', 0.5),
+                   backoff_max=config.get('download_backoff_max', 8),
+                   max_size=config.get('download_max_size', 100) * 1024 * 1024,
+                   range_threshold=config.get('download_range_threshold', 4) * 1024 * 1024,
+                   range_parts=config.get('download_range_parts', 4),
+                   range_workers=config.get('download_range_workers', 4),
+                   buffers=BufferPool.from_config(config))
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter
+
+        :param attempt: The number of attempts already failed, starting from 1
+        :return: Seconds to sleep before the next attempt
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def request(self, url: str, method: str = 'GET', headers: Optional[Dict[str, str]] = None,
+                retry: Optional[int] = None, **kwargs) -> requests.Response:
+        """
+        Send a request through the shared session, retrying on network errors and
+        on 429/5xx responses. Other HTTP errors are raised immediately.
+        The response is streamed, remember to close it once you are done!
+
+        :param url: The URL to be requested
+        :param method: HTTP method
+        :param headers: Extra request headers
+        :param retry: The max attempts before giving up, defaults to the configured value
+        """
+        retry = retry or self.retries
+        attempt = 1
+        while True:
+            self._count('requests')
+            try:
+                r = self.session.request(method, url, headers=headers, stream=True,
+                                         timeout=self.timeout, **kwargs)
+                if r.status_code >= 400:
+                    r.close()
+                r.raise_for_status()
+                return r
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                response = getattr(e, 'response', None)
+                retryable = response is None or response.status_code in RETRY_STATUS
+                logger.warning(f"Error occurred when requesting {url}. {e}")
+                if not retryable or attempt >= retry:
+                    self._count('failures')
+                    if retryable:
+                        logger.warning("Maximum retry reached. Giving up.")
+                    raise
+                delay = self.backoff(attempt)
+                self._count('retries')
+                attempt += 1
+                time.sleep(delay)
+
+    def download(self, url: str, retry: Optional[int] = None, max_size: Optional[int] = None) -> MediaBuffer:
+        """
+        Download the given URL into a media buffer, kept in memory when small enough
+        Remember to close the file once you are done with the file!
+
+        Large files are fetched as several ranges in parallel when the server supports
+        range requests, and broken transfers resume from the last byte received.
+        The size limit is enforced on the bytes actually received, whatever the server announces.
+        The first bytes received are kept as file.head, see MimeSniffer.detect.
+
+        :param url: The URL that points to the file
+        :param retry: The max attempts before giving up, defaults to the configured value
+        :param max_size: Max number of bytes downloaded, defaults to the configured value
+        :raise DownloadTooLarge: The file is larger than max_size, or than the free disk space allows
+        """
+        retry = retry or self.retries
+        max_size = max_size or self.max_size
+        file = self.buffers.create()
+        file.url = url
+        # Only the first part is asked for when large files are split, so that this response is read to its end
+        # as the first range and its connection goes back to the pool
+        probe_end = max(1, self.range_threshold // self.range_parts) if self.range_parts > 1 else None
+        try:
+            try:
+                r = self.request(url, headers=range_headers(0, probe_end), retry=retry)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 416:  # Range not satisfiable, e.g. empty
+                    raise
+                r = self.request(url, headers=range_headers(None), retry=retry)
+            total = content_length(r)
+            if total is not None:
+                self._check_size(total, max_size, r)
+                file.reserve(total)
+            first_end = content_range_end(r) if r.status_code == 206 else None
+            if total is not None and first_end is not None and first_end < total:
+                self._download_ranges(url, r, first_end, file, total, retry, max_size)
+            else:
+                self._download_stream(url, r, file, total, retry, max_size)
+        except BaseException:
+            file.close()
+            raise
+        file.seek(0)
+        return file
+
+    def _check_size(self, size: int, max_size: int, response: requests.Response = None):
+        reason = None
+        if max_size and size > max_size:
+            reason = f"{size} bytes exceed the limit of {max_size} bytes"
+        elif self.min_free_space is not None:
+            free = shutil.disk_usage(self.buffers.directory).free
+            if size > free - self.min_free_space:
+                reason = f"{size} bytes would leave less than {self.min_free_space} bytes of free disk space"
+        if reason:
+            if response is not None:
+                response.close()
+            self._count('too_large')
+            raise DownloadTooLarge(reason)
+
+    def _read(self, r: requests.Response, limit: Optional[int] = None) -> Iterator[bytes]:
+        """
+        Read the body with chunks growing while the transfer goes on,
+        small files cost few syscalls and large ones few Python iterations
+        """
+        size = self.chunk_size
+        received = 0
+        while limit is None or received < limit:
+            chunk = r.raw.read(size if limit is None else min(size, limit - received), decode_content=True)
+            if not chunk:
+                return
+            received += len(chunk)
+            self._count('bytes', len(chunk))
+            yield chunk
+            if len(chunk) == size:
+                size = min(size * 2, self.max_chunk_size)
+
+    def _download_stream(self, url: str, r: requests.Response, file: IO, total: Optional[int], retry: int,
+                         max_size: int):
+        """
+        Download in a single request, resuming from the last byte received when the server supports ranges
+        """
+        attempt = 1
+        written = 0
+        while True:
+            try:
+                with r:
+                    if written and (r.status_code != 206 or content_range_start(r) != written):
+                        file.seek(0)  # The server does not resume, start over
+                        file.truncate()
+                        written = 0
+                    for chunk in self._read(r):
+                        written += len(chunk)
+                        if max_size and written > max_size:
+                            self._count('too_large')
+                            raise DownloadTooLarge(f"More than {max_size} bytes received")
+                        if written == len(chunk):
+                            file.head = chunk[:HEAD_SIZE]
+                        file.write(chunk)
+                if total is None or written >= total:
+                    return
+                raise requests.exceptions.ChunkedEncodingError(f"Connection closed after {written} of {total} bytes")
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                    urllib3.exceptions.HTTPError) as e:
+                # The connection broke while streaming the body
+                logger.warning(f"Error occurred when downloading {url}. {e}")
+                if attempt >= retry:
+                    self._count('failures')
+                    logger.warning("Maximum retry reached. Giving up.")
+                    raise
+                self._count('retries')
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                if r.status_code == 206:
+                    self._count('resumed')
+                r = self.request(url, headers=range_headers(written if r.status_code == 206 else None),
+                                 retry=retry - attempt + 1)
+
+    def _download_ranges(self, url: str, first: requests.Response, first_end: int, file: IO, total: int,
+                         retry: int, max_size: int):
+        """
+        Download parts of the file in parallel, the first part is the response already opened for [0, first_end),
+        the rest of the file is split between the other parts
+        """
+        file.truncate(total)
+        # Files below the threshold are fetched as two parts, this response and the rest
+        part_size = -(-(total - first_end) // (self.range_parts - 1 if total >= self.range_threshold else 1))
+        parts = [(start, min(start + part_size, total)) for start in range(first_end, total, part_size)]
+        lock = threading.Lock()
+        cancelled = threading.Event()
+        self._count('ranged')
+        futures = [self._range_executor().submit(self._download_range, url, None, file, lock, start, end, retry,
+                                                 cancelled)
+                   for start, end in parts]
+        try:
+            self._download_range(url, first, file, lock, 0, first_end, retry, cancelled)
+            for future in futures:
+                future.result()
+        except BaseException:
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            wait(futures)  # Running parts stop at their next chunk, none may write once the file is closed
+            raise
+        finally:
+            first.close()
+
+    def _download_range(self, url: str, r: Optional[requests.Response], file: IO, lock: threading.Lock,
+                        start: int, end: int, retry: int, cancelled: threading.Event):
+        """
+        Download bytes [start, end) of the file, resuming from the last byte received after a failure
+        """
+        attempt = 1
+        position = start
+        while position < end:
+            if cancelled.is_set():
+                return
+            try:
+                if r is None:
+                    r = self.request(url, headers=range_headers(position, end), retry=1)
+                    if r.status_code != 206 or content_range_start(r) != position:
+                        r.close()
+                        raise IOError(f"{url} did not answer the range {position}-{end - 1}")
+                with r:
+                    for chunk in self._read(r, end - position):
+                        if cancelled.is_set():
+                            return
+                        if position == 0:
+                            file.head = chunk[:HEAD_SIZE]
+                        with lock:
+                            file.seek(position)
+                            file.write(chunk)
+                        position += len(chunk)
+                if position < end:
+                    raise requests.exceptions.ChunkedEncodingError(f"Range closed at {position} instead of {end}")
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError) as e:
+                logger.warning(f"Error occurred when downloading {url} from byte {position}. {e}")
+                if attempt >= retry:
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                self._count('resumed')
+                cancelled.wait(self.backoff(attempt))
+                attempt += 1
+            finally:
+                r = None
+
+    def _range_executor(self) -> ThreadPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.range_workers, thread_name_prefix="iot_range")
+            return self.executor
+
+    def _count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the downloader counters.
+        ``connections`` is the number of connections opened by the live host pools,
+        ``reused`` the number of requests served by an already opened connection.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'reused': max(0, pool.num_requests - pool.num_connections),
+            }
+        stats['hosts'] = hosts
+        stats['connections'] = sum(h['connections'] for h in hosts.values())
+        stats['reused'] = sum(h['reused'] for h in hosts.values())
+        return stats
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        self.session.close()
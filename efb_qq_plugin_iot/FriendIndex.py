@@ -0,0 +1,135 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from efb_qq_plugin_iot.CustomTypes import IOTFriend
+
+logger = logging.getLogger(__name__)
+
+
+class FriendIndex:
+    """
+    Friend list indexed by uin.
+
+    Once loaded, lookups never wait for OPQBot: when the list is older than
+    ``ttl`` the stale entries keep being served while a background thread
+    fetches the new list and applies the difference in place.
+    """
+
+    def __init__(self, fetch: Callable[[], List[Dict]], ttl: int = 600):
+        """
+        :param fetch: Function returning the full friend list from OPQBot
+        :param ttl: Seconds before the friend list is refreshed
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.friends: Dict[int, IOTFriend] = {}
+        self.updated_at: float = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.metrics = {
+            'refreshes': 0,
+            'failures': 0,
+            'last_duration': 0.0,
+            'max_duration': 0.0,
+            'added': 0,
+            'removed': 0,
+            'changed': 0,
+        }
+
+    def get(self, uin: int) -> Optional[IOTFriend]:
+        self.ensure_fresh()
+        return self.friends.get(int(uin))
+
+    def all(self) -> List[IOTFriend]:
+        self.ensure_fresh()
+        return list(self.friends.values())
+
+    def ensure_fresh(self):
+        if not self.loaded:
+            self.refresh()  # Nothing to serve yet, the first load has to block
+        elif time.monotonic() - self.updated_at >= self.ttl and not self.refresh_lock.locked():
+            threading.Thread(target=self.refresh, name="iot_friend_refresh", daemon=True).start()
+
+    def refresh(self) -> bool:
+        """
+        Fetch the friend list and apply the difference to the index.
+        Concurrent calls are coalesced into the one already running.
+
+        :return: Whether the index is loaded
+        """
+        if not self.refresh_lock.acquire(blocking=False):
+            with self.refresh_lock:  # Wait for the running refresh instead of starting another one
+                return self.loaded
+        try:
+            start = time.monotonic()
+            try:
+                friend_list = self.fetch()
+            except Exception as e:
+                friend_list = None
+                logger.warning(f"Failed to fetch the friend list! {e}")
+            if not friend_list and self.friends:
+                # OPQBot answers an empty list on errors, keep serving what we have
+                friend_list = None
+            if friend_list is None:
+                with self.lock:
+                    self.metrics['failures'] += 1
+                    self.updated_at = time.monotonic()  # Retry after another ttl instead of on every lookup
+                return self.loaded
+            self.apply(friend_list)
+            duration = time.monotonic() - start
+            with self.lock:
+                self.metrics['refreshes'] += 1
+                self.metrics['last_duration'] = duration
+                self.metrics['max_duration'] = max(self.metrics['max_duration'], duration)
+            logger.debug("Friend list refreshed in %.3fs, %d friend(s)", duration, len(self.friends))
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    def apply(self, friend_list: List[Dict]):
+        """
+        Apply a full friend list to the index, only touching the entries that differ
+        """
+        latest = {int(friend['FriendUin']): IOTFriend(friend) for friend in friend_list}
+        with self.lock:
+            removed = self.friends.keys() - latest.keys()
+            changed = [uin for uin, friend in latest.items() if self.friends.get(uin) != friend]
+            for uin in removed:
+                del self.friends[uin]
+            for uin in changed:
+                if uin in self.friends:
+                    self.metrics['changed'] += 1
+                else:
+                    self.metrics['added'] += 1
+                self.friends[uin] = latest[uin]
+            self.metrics['removed'] += len(removed)
+            self.updated_at = time.monotonic()
+            self.loaded = True
+
+    def dump(self) -> Optional[List[Dict]]:
+        """
+        The friend list as received from OPQBot, None until loaded
+        """
+        with self.lock:
+            return [dict(friend) for friend in self.friends.values()] if self.loaded else None
+
+    def restore(self, friend_list: List[Dict]):
+        """
+        Serve a saved friend list until OPQBot is asked again, which the first lookup does in the background
+        """
+        if self.loaded or not friend_list:
+            return
+        self.apply(friend_list)
+        with self.lock:
+            self.updated_at = time.monotonic() - self.ttl
+
+    def stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.metrics)
+            stats['friends'] = len(self.friends)
+            stats['age'] = time.monotonic() - self.updated_at if self.loaded else None
+        return stats
@@ -0,0 +1,176 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from efb_qq_plugin_iot.CustomTypes import IOTGroup
+
+logger = logging.getLogger(__name__)
+
+
+class GroupIndex:
+    """
+    Group info indexed by group id.
+
+    OPQBot can only list every group of the account at once, so once loaded single
+    lookups never call it directly: each entry carries its own check time, and a
+    stale, invalidated or unknown entry schedules one background refresh of the list
+    while the lookup answers with what is already known.
+    """
+
+    def __init__(self, fetch: Callable[[], List[Dict]], ttl: int = 600):
+        """
+        :param fetch: Function returning the full group list from OPQBot
+        :param ttl: Seconds before an entry is considered stale
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.groups: Dict[int, IOTGroup] = {}
+        self.checked_at: Dict[int, float] = {}
+        self.refreshed_at: float = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.metrics = {
+            'refreshes': 0,
+            'failures': 0,
+            'last_duration': 0.0,
+            'max_duration': 0.0,
+            'added': 0,
+            'removed': 0,
+            'changed': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, group_id: int) -> Optional[IOTGroup]:
+        """
+        Look up a group, only the first load waits for OPQBot
+        """
+        group_id = int(group_id)
+        if not self.loaded:
+            self.refresh()  # Nothing to serve yet, the first load has to block
+        with self.lock:
+            group = self.groups.get(group_id)
+            # Unknown groups are only looked for again once the whole list is stale
+            stale = time.monotonic() - self.checked_at.get(group_id, self.refreshed_at) >= self.ttl
+        if stale:
+            self.refresh_in_background()
+        return group
+
+    def all(self) -> List[IOTGroup]:
+        if not self.loaded:
+            self.refresh()  # Listing needs the whole list, only the first load has to block
+        elif time.monotonic() - min(self.checked_at.values(), default=self.refreshed_at) >= self.ttl:
+            self.refresh_in_background()
+        return list(self.groups.values())
+
+    def invalidate(self, group_id: int):
+        """
+        Mark a single group as stale, the next lookup refreshes it in the background
+        """
+        with self.lock:
+            if int(group_id) in self.checked_at:
+                self.checked_at[int(group_id)] = time.monotonic() - self.ttl
+                self.metrics['invalidations'] += 1
+
+    def on_name_seen(self, group_id: int, name: str):
+        """
+        Update the name of a known group from the one shown in a group message
+        """
+        with self.lock:
+            group = self.groups.get(int(group_id))
+            if group is not None and name and group.get('GroupName') != name:
+                self.groups[int(group_id)] = IOTGroup(group, GroupName=name)
+                self.metrics['changed'] += 1
+
+    def refresh_in_background(self):
+        if not self.refresh_lock.locked():
+            threading.Thread(target=self.refresh, name="iot_group_refresh", daemon=True).start()
+
+    def refresh(self) -> bool:
+        """
+        Fetch the group list and apply the difference to the index.
+        Concurrent calls are coalesced into the one already running.
+
+        :return: Whether the index is loaded
+        """
+        if not self.refresh_lock.acquire(blocking=False):
+            with self.refresh_lock:  # Wait for the running refresh instead of starting another one
+                return self.loaded
+        try:
+            start = time.monotonic()
+            try:
+                group_list = self.fetch()
+            except Exception as e:
+                group_list = None
+                logger.warning(f"Failed to fetch the group list! {e}")
+            if not group_list and self.groups:
+                # OPQBot answers an empty list on errors, keep serving what we have
+                group_list = None
+            if group_list is None:
+                with self.lock:
+                    self.metrics['failures'] += 1
+                    # Retry after another ttl instead of on every lookup
+                    self.refreshed_at = time.monotonic()
+                    self.checked_at = {group_id: self.refreshed_at for group_id in self.groups}
+                return self.loaded
+            self.apply(group_list)
+            duration = time.monotonic() - start
+            with self.lock:
+                self.metrics['refreshes'] += 1
+                self.metrics['last_duration'] = duration
+                self.metrics['max_duration'] = max(self.metrics['max_duration'], duration)
+            logger.debug("Group list refreshed in %.3fs, %d group(s)", duration, len(self.groups))
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    def apply(self, group_list: List[Dict]):
+        """
+        Apply a full group list to the index, only touching the entries that differ
+        """
+        latest = {int(group['GroupId']): IOTGroup(group) for group in group_list}
+        now = time.monotonic()
+        with self.lock:
+            removed = self.groups.keys() - latest.keys()
+            changed = [group_id for group_id, group in latest.items() if self.groups.get(group_id) != group]
+            for group_id in removed:
+                del self.groups[group_id]
+            for group_id in changed:
+                if group_id in self.groups:
+                    self.metrics['changed'] += 1
+                else:
+                    self.metrics['added'] += 1
+                self.groups[group_id] = latest[group_id]
+            self.metrics['removed'] += len(removed)
+            self.checked_at = {group_id: now for group_id in latest}
+            self.refreshed_at = now
+            self.loaded = True
+
+    def dump(self) -> Optional[List[Dict]]:
+        """
+        The group list as received from OPQBot, None until loaded
+        """
+        with self.lock:
+            return [dict(group) for group in self.groups.values()] if self.loaded else None
+
+    def restore(self, group_list: List[Dict]):
+        """
+        Serve a saved group list until OPQBot is asked again, which the first lookup does in the background
+        """
+        if self.loaded or not group_list:
+            return
+        self.apply(group_list)
+        with self.lock:
+            stale = time.monotonic() - self.ttl
+            self.checked_at = {group_id: stale for group_id in self.checked_at}
+            self.refreshed_at = stale
+
+    def stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.metrics)
+            stats['groups'] = len(self.groups)
+            stats['stale'] = sum(1 for group_id in self.groups
+                                 if time.monotonic() - self.checked_at.get(group_id, 0) >= self.ttl)
+        return stats
@@ -1,34 +1,48 @@
 # coding: utf-8
 import base64
-import hashlib
+import functools
 import logging
-import tempfile
+import time
 import uuid
-from typing import Collection, BinaryIO, Dict, Any, List, Union, IO
+from typing import TYPE_CHECKING, Callable, Collection, BinaryIO, Dict, Any, List, Union, IO
 import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
-import pydub
-import socketio
-from cachetools import TTLCache
 from efb_qq_slave import BaseClient
-from ehforwarderbot import Chat, Message, Status, coordinator, MsgType
+from ehforwarderbot import Chat, Message, Status, coordinator, MsgType, utils as efb_utils
 from ehforwarderbot.channel import SlaveChannel
+from ehforwarderbot.chat import ChatMember
+from ehforwarderbot.exceptions import EFBMessageError
 from ehforwarderbot.types import ChatID
 
 from botoy import Botoy, GroupMsg, FriendMsg, EventMsg, Action
+from botoy.collection import EventNames
 
 from efb_qq_plugin_iot.IOTConfig import IOTConfig
 from efb_qq_plugin_iot.IOTFactory import IOTFactory
 from efb_qq_plugin_iot.IOTMsgProcessor import IOTMsgProcessor
+from efb_qq_plugin_iot.AvatarCache import AvatarCache
 from efb_qq_plugin_iot.ChatMgr import ChatMgr
-from efb_qq_plugin_iot.CustomTypes import IOTGroup, EFBGroupChat, EFBPrivateChat, IOTGroupMember, \
-    EFBGroupMember
-from efb_qq_plugin_iot.Utils import download_user_avatar, download_group_avatar, iot_at_user, process_quote_text
-try:
-    import Silkv3
-    VOICE_SUPPORTED = True
-except ImportError:
-    VOICE_SUPPORTED = False
+from efb_qq_plugin_iot.Dispatcher import Dispatcher
+from efb_qq_plugin_iot.Downloader import Downloader
+from efb_qq_plugin_iot.FriendIndex import FriendIndex
+from efb_qq_plugin_iot.GroupIndex import GroupIndex
+from efb_qq_plugin_iot.ImageOptimizer import ImageOptimizer
+from efb_qq_plugin_iot.MediaCache import MediaCache
+from efb_qq_plugin_iot.MemberStore import MemberStore
+from efb_qq_plugin_iot.ProfileCache import ProfileCache
+from efb_qq_plugin_iot.Snapshot import Snapshot
+from efb_qq_plugin_iot.SendScheduler import SendScheduler, PRIORITY_MEDIA, PRIORITY_TEXT
+from efb_qq_plugin_iot.TrafficLog import TrafficRecorder
+from efb_qq_plugin_iot.Transcoder import Transcoder, audio_to_silk, voice_supported
+from efb_qq_plugin_iot.UploadIndex import UploadIndex
+from efb_qq_plugin_iot.Prefetcher import Prefetcher
+from efb_qq_plugin_iot.CustomTypes import IOTGroup, EFBGroupChat, EFBPrivateChat, EFBGroupMember
+from efb_qq_plugin_iot.Utils import download_user_avatar, download_group_avatar, iot_at_user, process_quote_text, \
+    user_avatar_url, group_avatar_url, encode_file_base64
+
+if TYPE_CHECKING:
+    import socketio
 
 
 class iot(BaseClient):
@@ -40,15 +54,19 @@ class iot(BaseClient):
     channel: SlaveChannel
     logger: logging.Logger = logging.getLogger(__name__)
 
-    info_list = TTLCache(maxsize=2, ttl=600)
-
-    info_dict = TTLCache(maxsize=2, ttl=600)
-
-    group_member_list = TTLCache(maxsize=20, ttl=3600)
-    stranger_cache = TTLCache(maxsize=100, ttl=3600)
-
-    sio: socketio.Client = None
+    sio: 'socketio.Client' = None
     event: threading.Event = None
+    avatar_cache: AvatarCache = None
+    upload_index: UploadIndex = None
+    image_optimizer: ImageOptimizer = None
+    friend_index: FriendIndex = None
+    group_index: GroupIndex = None
+    member_store: MemberStore = None
+    dispatcher: Dispatcher = None
+    send_scheduler: SendScheduler = None
+    profile_cache: ProfileCache = None
+    traffic_recorder: TrafficRecorder = None
+    snapshot: Snapshot = None
 
     def __init__(self, client_id: str, config: Dict[str, Any], channel):
         super().__init__(client_id, config)
@@ -61,9 +79,80 @@ class iot(BaseClient):
         self.action = Action(qq=self.uin, host=self.host, port=self.port)
         IOTFactory.bot = self.bot
         IOTFactory.action = self.action
+        IOTFactory.downloader = Downloader.from_config(self.client_config)
+        IOTFactory.prefetcher = Prefetcher(per_message=self.client_config.get('prefetch_per_message', 4),
+                                           global_limit=self.client_config.get('prefetch_global_limit', 16))
+        IOTFactory.transcoder = Transcoder(workers=self.client_config.get('transcode_workers', 2),
+                                           max_pending=self.client_config.get('transcode_queue_size', 16),
+                                           timeout=self.client_config.get('transcode_timeout', 30))
         self.channel = channel
         ChatMgr.slave_channel = channel
+        ChatMgr.max_chats = self.client_config.get('chat_registry_size', 2000)
+        ChatMgr.idle_time = self.client_config.get('chat_idle_time', 3600)
+        if self.client_config.get('media_cache', True):
+            IOTFactory.media_cache = MediaCache(
+                self.client_config.get('media_cache_dir',
+                                       efb_utils.get_data_path(self.channel.channel_id) / 'media_cache'),
+                max_size=self.client_config.get('media_cache_size', 256) * 1024 * 1024)
+        self.avatar_size = self.client_config.get('avatar_size', 0)
+        if self.client_config.get('avatar_cache', True):
+            self.avatar_cache = AvatarCache(
+                self.client_config.get('avatar_cache_dir',
+                                       efb_utils.get_data_path(self.channel.channel_id) / 'avatars'),
+                IOTFactory.downloader,
+                fresh_time=self.client_config.get('avatar_fresh_time', 86400),
+                max_entries=self.client_config.get('avatar_cache_entries', 4096))
+        if self.client_config.get('upload_index', True):
+            self.upload_index = UploadIndex(
+                self.client_config.get('upload_index_path',
+                                       efb_utils.get_data_path(self.channel.channel_id) / 'upload_index.json'),
+                ttl=self.client_config.get('upload_index_ttl', 3 * 86400))
+        if self.client_config.get('optimize_images', False):
+            self.image_optimizer = ImageOptimizer(
+                MediaCache(self.client_config.get('optimize_cache_dir',
+                                                  efb_utils.get_data_path(self.channel.channel_id) / 'optimized'),
+                           max_size=self.client_config.get('optimize_cache_size', 64) * 1024 * 1024),
+                max_side=self.client_config.get('optimize_max_side', 2048),
+                max_size=int(self.client_config.get('optimize_max_size', 1) * 1024 * 1024),
+                quality=self.client_config.get('optimize_quality', 85),
+                animation_max_side=self.client_config.get('optimize_animation_max_side', 512),
+                animation_max_size=int(self.client_config.get('optimize_animation_max_size', 2) * 1024 * 1024))
+        self.friend_index = FriendIndex(self.action.getUserList,
+                                        ttl=self.client_config.get('friend_list_ttl', 600))
+        self.group_index = GroupIndex(self.action.getGroupList,
+                                      ttl=self.client_config.get('group_list_ttl', 600))
+        self.member_store = MemberStore(self.action.getGroupMembers,
+                                        max_groups=self.client_config.get('member_list_groups', 1000),
+                                        ttl=self.client_config.get('member_list_ttl', 86400))
+        self.profile_cache = ProfileCache(self.fetch_stranger_info,
+                                          max_size=self.client_config.get('profile_cache_size', 5000),
+                                          ttl=self.client_config.get('profile_cache_ttl', 3600),
+                                          negative_ttl=self.client_config.get('profile_negative_ttl', 60),
+                                          prefetch_workers=self.client_config.get('profile_prefetch_workers', 2))
+        if self.client_config.get('snapshot', True):
+            self.snapshot = Snapshot(
+                self.client_config.get('snapshot_path',
+                                       efb_utils.get_data_path(self.channel.channel_id) / 'snapshot.json.gz'),
+                self.uin, self.friend_index, self.group_index, self.member_store,
+                interval=self.client_config.get('snapshot_interval', 300))
+            self.snapshot.load()
+            # Reconciling also warms the indexes up when there was no snapshot
+            threading.Thread(target=self.snapshot.reconcile, name="iot_snapshot_reconcile", daemon=True).start()
+            self.snapshot.save_periodically()
         self.iot_msg = IOTMsgProcessor(self.uin)
+        self.send_scheduler = SendScheduler(rate=self.client_config.get('send_rate', 5),
+                                            burst=self.client_config.get('send_burst', 10),
+                                            target_rate=self.client_config.get('send_chat_rate', 0.9),
+                                            target_burst=self.client_config.get('send_chat_burst', 2),
+                                            max_queue=self.client_config.get('send_queue_size', 200),
+                                            retries=self.client_config.get('send_retries', 3))
+        self.dispatcher = Dispatcher(workers=self.client_config.get('dispatch_workers', 8),
+                                     max_pending=self.client_config.get('dispatch_queue_size', 1000))
+        if self.client_config.get('traffic_log'):
+            self.traffic_recorder = TrafficRecorder(self.client_config['traffic_log'],
+                                                    self.client_config.get('traffic_log_media'),
+                                                    fetch=IOTFactory.downloader.download)
+        self.setup_metrics()
 
         @self.bot.when_connected
         def on_ws_connected():
@@ -76,88 +165,131 @@ class iot(BaseClient):
         @self.bot.on_friend_msg
         def on_friend_msg(ctx: FriendMsg):
             self.logger.debug(ctx)
+            if self.traffic_recorder:
+                self.traffic_recorder.record('friend', ctx.message)
             if int(ctx.FromUin) == int(self.uin) and not IOTConfig.configs.get('receive_self_msg', True):
                 self.logger.info("Received self message and flag set. Cancel delivering...")
                 return
-            remark_name = self.get_friend_remark(ctx.FromUin)
-            if not remark_name:
-                info = self.get_stranger_info(ctx.FromUin)
-                if info:
-                    remark_name = info.get('nickname', '')
-                else:
-                    remark_name = str(ctx.FromUin)
             if ctx.MsgType == 'TempSessionMsg':  # Temporary chat
                 chat_uid = f'private_{ctx.FromUin}_{ctx.TempUin}'
             elif ctx.MsgType == 'PhoneMsg':
                 chat_uid = f'phone_{ctx.FromUin}'
             else:
                 chat_uid = f'friend_{ctx.FromUin}'
-            chat = ChatMgr.build_efb_chat_as_private(EFBPrivateChat(
-                uid=chat_uid,
-                name=remark_name,
-            ))
+            self.dispatcher.submit(chat_uid, functools.partial(handle_friend_msg, ctx, chat_uid, time.perf_counter()),
+                                   ctx.MsgSeq)
+
+        def handle_friend_msg(ctx: FriendMsg, chat_uid: str, received_at: float):
+            metrics = IOTFactory.metrics
+            metrics.observe('receive', time.perf_counter() - received_at)
+            with metrics.time('profile'):
+                remark_name = self.get_friend_remark(ctx.FromUin)
+                if not remark_name:
+                    info = self.get_stranger_info(ctx.FromUin)
+                    if info:
+                        remark_name = info.get('nickname', '')
+                    else:
+                        remark_name = str(ctx.FromUin)
+            with metrics.time('chat'):
+                chat = ChatMgr.build_efb_chat_as_private(EFBPrivateChat(
+                    uid=chat_uid,
+                    name=remark_name,
+                ))
             author = chat.other
 
             # Splitting messages
-            messages: List[Message] = []
-            func = getattr(self.iot_msg, f'iot_{ctx.MsgType}_friend')
-            messages.extend(func(ctx, chat))
+            messages = self.iot_msg.process(ctx, chat, 'friend')
 
             # Sending messages one by one
-            message_id = ctx.MsgSeq
-            for idx, val in enumerate(messages):
-                if not isinstance(val, Message):
-                    continue
-                val.uid = f"friend_{ctx.FromUin}_{message_id}_{idx}"
-                val.chat = chat
-                val.author = author
-                val.deliver_to = coordinator.master
-                coordinator.send_message(val)
-                if val.file:
-                    val.file.close()
+            self.deliver_messages(messages, f"friend_{ctx.FromUin}_{ctx.MsgSeq}", chat, author)
 
         @self.bot.on_group_msg
         def on_group_msg(ctx: GroupMsg):
+            if self.traffic_recorder:
+                self.traffic_recorder.record('group', ctx.message)
             # OPQbot has no indicator for anonymous user, so we have to test the uin
-            nickname = ctx.FromNickName
             if int(ctx.FromUserId) == int(self.uin) and not IOTConfig.configs.get('receive_self_msg', True):
                 self.logger.info("Received self message and flag set. Cancel delivering...")
                 return
-            remark_name = self.get_friend_remark(ctx.FromUserId)
-            if not remark_name:
-                info = self.get_stranger_info(ctx.FromUserId)
-                if info:
-                    remark_name = info.get('nickname', '')
-            chat = ChatMgr.build_efb_chat_as_group(EFBGroupChat(
-                uid=f"group_{ctx.FromGroupId}",
-                name=ctx.FromGroupName
-            ))
-            author = ChatMgr.build_efb_chat_as_member(chat, EFBGroupMember(
-                name=nickname,
-                alias=remark_name,
-                uid=str(ctx.FromUserId)
-            ))
+            self.dispatcher.submit(f"group_{ctx.FromGroupId}",
+                                   functools.partial(handle_group_msg, ctx, time.perf_counter()), ctx.MsgSeq)
+
+        def handle_group_msg(ctx: GroupMsg, received_at: float):
+            metrics = IOTFactory.metrics
+            metrics.observe('receive', time.perf_counter() - received_at)
+            nickname = ctx.FromNickName
+            with metrics.time('profile'):
+                remark_name = self.get_friend_remark(ctx.FromUserId)
+                if not remark_name:
+                    info = self.get_stranger_info(ctx.FromUserId)
+                    if info:
+                        remark_name = info.get('nickname', '')
+            self.member_store.on_name_seen(ctx.FromGroupId, ctx.FromUserId, nickname)
+            # The others who spoke lately are likely to speak again, have their profiles ready by then
+            self.profile_cache.prefetch([uin for uin in self.member_store.active_senders(ctx.FromGroupId)
+                                         if uin != int(ctx.FromUserId) and self.friend_index.get(uin) is None])
+            self.group_index.on_name_seen(ctx.FromGroupId, ctx.FromGroupName)
+            with metrics.time('chat'):
+                chat = ChatMgr.build_efb_chat_as_group(EFBGroupChat(
+                    uid=f"group_{ctx.FromGroupId}",
+                    name=ctx.FromGroupName
+                ))
+                author = ChatMgr.build_efb_chat_as_member(chat, EFBGroupMember(
+                    name=nickname,
+                    alias=remark_name,
+                    uid=str(ctx.FromUserId)
+                ))
             # Splitting messages
-            messages: List[Message] = []
-            func = getattr(self.iot_msg, f'iot_{ctx.MsgType}_group')
-            messages.extend(func(ctx, chat))
+            messages = self.iot_msg.process(ctx, chat, 'group')
 
             # Sending messages one by one
-            message_id = ctx.MsgSeq
-            for idx, val in enumerate(messages):
-                if not isinstance(val, Message):
-                    continue
-                val.uid = f"group_{ctx.FromGroupId}_{message_id}_{idx}"
-                val.chat = chat
-                val.author = author
-                val.deliver_to = coordinator.master
-                coordinator.send_message(val)
-                if val.file:
-                    val.file.close()
+            self.deliver_messages(messages, f"group_{ctx.FromGroupId}_{ctx.MsgSeq}", chat, author)
 
         @self.bot.on_event
         def on_event(ctx: EventMsg):
-            pass  # fixme
+            if self.traffic_recorder:
+                self.traffic_recorder.record('event', ctx.message)
+            self.member_store.on_event(ctx)
+            if ctx.EventName == EventNames.ON_EVENT_GROUP_EXIT_SUCC:  # We left the group
+                self.group_index.invalidate(ctx.FromUin)
+                ChatMgr.evict(f"group_{ctx.FromUin}")
+
+    def deliver_messages(self, messages: List[Union[Message, Future]], uid_prefix: str, chat: Chat, author: ChatMember):
+        """
+        Deliver the messages split from one QQ message to the master channel, in order.
+        Messages still being processed (e.g. voices being transcoded) are waited for,
+        which only holds back the chat they belong to.
+
+        :param messages: EFB Messages, or futures resolved with one
+        :param uid_prefix: Prefix of the message uid, the index of each message is appended
+        :param chat: The chat the messages belong to
+        :param author: The author of the messages
+        """
+        for idx, val in enumerate(messages):
+            uid = f"{uid_prefix}_{idx}"
+            if isinstance(val, Future):
+                self._deliver_future(uid, chat, author, val)
+            elif isinstance(val, Message):
+                self.deliver_message(val, uid, chat, author)
+
+    def _deliver_future(self, uid: str, chat: Chat, author: ChatMember, future: Future):
+        try:
+            msg = future.result()
+        except Exception as e:
+            self.logger.warning(f"[{uid}] Failed to process the message! {e}")
+            return
+        self.deliver_message(msg, uid, chat, author)
+
+    @staticmethod
+    def deliver_message(msg: Message, uid: str, chat: Chat, author: ChatMember):
+        msg.uid = uid
+        msg.chat = chat
+        msg.author = author
+        msg.deliver_to = coordinator.master
+        with IOTFactory.metrics.time('deliver'):
+            coordinator.send_message(msg)
+        if msg.file:
+            msg.file.close()
 
     def login(self):
         pass
@@ -181,27 +313,35 @@ class iot(BaseClient):
                 tgt_alias = iot_at_user(msg.target.author.uid)
                 tgt_text = process_quote_text(msg.target.text, max_length)
                 msg.text = "%s%s\n\n%s" % (tgt_alias, tgt_text, msg.text)
-            self.iot_send_text_message(chat_type, chat_uid, msg.text)
+            self.wait_send(self.iot_send_text_message(chat_type, chat_uid, msg.text), msg.chat.uid)
             msg.uid = str(uuid.uuid4())
             self.logger.debug('[%s] Sent as a text message. %s', msg.uid, msg.text)
         elif msg.type in (MsgType.Image, MsgType.Sticker, MsgType.Animation):
             self.logger.info("[%s] Image/Sticker/Animation %s", msg.uid, msg.type)
-            self.iot_send_image_message(chat_type, chat_uid, msg.file, msg.text)
+            file = self.image_optimizer.optimize(msg.file) if self.image_optimizer else msg.file
+            try:
+                self.iot_send_image_message(chat_type, chat_uid, file, msg.text)
+            finally:
+                if file is not msg.file:
+                    file.close()
             msg.uid = str(uuid.uuid4())
         elif msg.type is MsgType.Voice:
             self.logger.info(f"[{msg.uid}] Voice.")
-            if not VOICE_SUPPORTED:
-                self.iot_send_text_message(chat_type, chat_uid, "[语音消息]")
+            if not voice_supported():
+                self.wait_send(self.iot_send_text_message(chat_type, chat_uid, "[语音消息]"), msg.chat.uid)
             else:
-                pydub.AudioSegment.from_file(msg.file).export(msg.file, format='s16le',
-                                                              parameters=["-ac", "1", "-ar", "24000"])
-                output_file = tempfile.NamedTemporaryFile()
-                if not Silkv3.encode(msg.file.name, output_file.name):
-                    self.iot_send_text_message(chat_type, chat_uid, "[语音消息]")
+                try:
+                    output_file = audio_to_silk(msg.file, self.client_config.get('voice_in_memory', True))
+                except Exception as e:
+                    self.logger.warning(f"[{msg.uid}] Failed to transcode the voice! {e}")
+                    output_file = None
+                if not output_file:
+                    self.wait_send(self.iot_send_text_message(chat_type, chat_uid, "[语音消息]"), msg.chat.uid)
                 else:
-                    self.iot_send_voice_message(chat_type, chat_uid, output_file)
+                    with output_file:
+                        self.wait_send(self.iot_send_voice_message(chat_type, chat_uid, output_file), msg.chat.uid)
                 if msg.text:
-                    self.iot_send_text_message(chat_type, chat_uid, msg.text)
+                    self.wait_send(self.iot_send_text_message(chat_type, chat_uid, msg.text), msg.chat.uid)
             msg.uid = str(uuid.uuid4())
         return msg
 
@@ -213,36 +353,25 @@ class iot(BaseClient):
         pass
 
     def get_friends(self) -> List['Chat']:
-        if not self.info_list.get('friend', None):
-            self.update_friend_list()
         friends = []
-        self.info_dict['friend'] = {}
-        for friend in self.info_list.get('friend', []):
-            friend_uin = friend['FriendUin']
-            friend_name = friend['NickName']
-            friend_remark = friend['Remark']
+        for friend in self.friend_index.all():
             new_friend = EFBPrivateChat(
-                uid=f"friend_{friend_uin}",
-                name=friend_name,
-                alias=friend_remark
+                uid=f"friend_{friend['FriendUin']}",
+                name=friend['NickName'],
+                alias=friend['Remark']
             )
-            self.info_dict['friend'][friend_uin] = friend
             friends.append(ChatMgr.build_efb_chat_as_private(new_friend))
         return friends
 
     def get_groups(self) -> List['Chat']:
-        if not self.info_list.get('group', None):
-            self.update_group_list()
         groups = []
-        self.info_dict['group'] = {}
-        for group in self.info_list.get('group', []):
+        for group in self.group_index.all():
             group_name = group['GroupName']
             group_id = group['GroupId']
             new_group = EFBGroupChat(
                 uid=f"group_{group_id}",
                 name=group_name
             )
-            self.info_dict['group'][group_id] = IOTGroup(group)
             groups.append(ChatMgr.build_efb_chat_as_group(new_group))
         return groups
 
@@ -250,28 +379,38 @@ class iot(BaseClient):
         pass
 
     def get_stranger_info(self, user_id) -> Union[Dict, None]:
-        if not self.stranger_cache.get(user_id, None):
-            response = self.action.getUserInfo(user=user_id)
-            if response.get('code', 1) != 0:  # Failed to get info
-                return None
-            else:
-                self.stranger_cache[user_id] = response.get('data', None)
-        return self.stranger_cache.get(user_id)
+        return self.profile_cache.get(user_id)
+
+    def fetch_stranger_info(self, user_id: int) -> Union[Dict, None]:
+        response = self.action.getUserInfo(user=user_id)
+        if response.get('code', 1) != 0:  # Failed to get info
+            return None
+        return response.get('data', None)
 
     def get_group_info(self, group_id: int, no_cache=True) -> Union[None, IOTGroup]:
-        if no_cache or not self.info_dict.get('group', None):
-            self.update_group_list()
-        return self.info_dict['group'].get(group_id, None)
+        """
+        Look up a group from the index, OPQBot is only waited for until the group list is first loaded
+
+        :param no_cache: Refresh the entry in the background, the current one is still returned
+        """
+        if no_cache:
+            self.group_index.invalidate(group_id)
+        return self.group_index.get(group_id)
 
     def get_chat_picture(self, chat: 'Chat') -> BinaryIO:
         chat_type = chat.uid.split('_')
-        if chat_type[0] == 'private':
-            private_uin = chat_type[1].split('_')[0]
-            return download_user_avatar(private_uin)
-        elif chat_type[0] == 'friend':
-            return download_user_avatar(chat_type[1])
+        if chat_type[0] in ('private', 'friend'):
+            uin = chat_type[1]
+            if self.avatar_cache:
+                return self.avatar_cache.get(f"user_{uin}_{self.avatar_size}",
+                                             user_avatar_url(uin, self.avatar_size))
+            return download_user_avatar(uin, self.avatar_size)
         elif chat_type[0] == 'group':
-            return download_group_avatar(chat_type[1])
+            group_id = chat_type[1]
+            if self.avatar_cache:
+                return self.avatar_cache.get(f"group_{group_id}_{self.avatar_size}",
+                                             group_avatar_url(group_id, self.avatar_size))
+            return download_group_avatar(group_id, self.avatar_size)
 
     def get_chat(self, chat_uid: ChatID) -> 'Chat':
         chat_info = chat_uid.split('_')
@@ -291,7 +430,7 @@ class iot(BaseClient):
             group_members = self.get_group_member_list(chat_uin, no_cache=False)
             chat = ChatMgr.build_efb_chat_as_group(EFBGroupChat(
                 uid=f"group_{chat_uin}",
-                name=group_info.get('GroupName', "")
+                name=group_info.get('GroupName', "") if group_info else ""
             ), group_members)
         elif chat_type == 'private':
             pass  # fixme
@@ -303,20 +442,7 @@ class iot(BaseClient):
         return self.get_friends() + self.get_groups()
 
     def get_group_member_list(self, group_id, no_cache=True):
-        if no_cache \
-                or not self.group_member_list.get(group_id, None):  # Key expired or not exists
-            # Update group member list
-            group_members = self.action.getGroupMembers(group_id)
-            efb_group_members: List[EFBGroupMember] = []
-            for qq_member in group_members:
-                qq_member = IOTGroupMember(qq_member)
-                efb_group_members.append(EFBGroupMember(
-                    name=qq_member['NickName'],
-                    alias=qq_member['GroupCard'],
-                    uid=qq_member['MemberUin']
-                ))
-            self.group_member_list[group_id] = efb_group_members
-        return self.group_member_list[group_id]
+        return self.member_store.get_members(group_id, no_cache=no_cache)
 
     def poll(self):
         # threading.Thread(target=self.bot.run, daemon=True).start()
@@ -327,10 +453,27 @@ class iot(BaseClient):
         self.logger.info("IOTBot quited.")
 
     def stop_polling(self):
-        if self.sio:
-            self.sio.disconnect()
-        if self.bot.pool:
-            self.bot.pool.shutdown(wait=False)
+        steps = [
+            ('Socket.IO client', self.sio and self.sio.disconnect),
+            ('bot pool', self.bot.pool and functools.partial(self.bot.pool.shutdown, wait=False)),
+            ('dispatcher', self.dispatcher and self.dispatcher.shutdown),
+            ('send scheduler', self.send_scheduler and self.send_scheduler.shutdown),
+            ('metrics', IOTFactory.metrics.shutdown),
+            ('prefetcher', IOTFactory.prefetcher and IOTFactory.prefetcher.shutdown),
+            ('transcoder', IOTFactory.transcoder and IOTFactory.transcoder.shutdown),
+            ('profile cache', self.profile_cache and self.profile_cache.shutdown),
+            ('traffic recorder', self.traffic_recorder and self.traffic_recorder.close),
+            ('snapshot', self.snapshot and self.snapshot.shutdown),
+            ('downloader', IOTFactory.downloader and IOTFactory.downloader.close),
+            ('upload index', self.upload_index and self.upload_index.save),
+        ]
+        for name, stop in steps:  # One failing component must not keep the others running
+            if not stop:
+                continue
+            try:
+                stop()
+            except Exception as e:
+                self.logger.warning(f"Failed to stop the {name}! {e}")
         if self.event:
             self.event.set()
 
@@ -339,69 +482,178 @@ class iot(BaseClient):
         Update friend list from OPQBot
 
         """
-        self.info_list['friend'] = self.action.getUserList()
+        self.friend_index.refresh()
 
     def update_group_list(self):
-        self.info_list['group'] = self.action.getGroupList()
+        self.group_index.refresh()
 
     def get_friend_remark(self, uin: int) -> Union[None, str]:
-        count = 0
-        while count <= 1:
-            if not self.info_list.get('friend', None):
-                self.update_friend_list()
-                self.get_friends()
-                count += 1
-            else:
-                break
-        if count > 1:  # Failure or friend not found
-            raise Exception("Failed to update friend list!")  # todo Optimize error handling
-        if not self.info_dict.get('friend', None) or uin not in self.info_dict['friend']:
+        friend = self.friend_index.get(uin)
+        if not friend:
             return None
         # When there is no mark available, the OPQBot API will fill the remark field with nickname
         # Thus no need to test whether isRemark is true or not
-        return self.info_dict['friend'][uin].get('Remark', None)
+        return friend.get('Remark', None)
+
+    def setup_metrics(self):
+        """
+        Export the stats of the components, and serve or write the metrics when configured
+        """
+        metrics = IOTFactory.metrics
+        components = {
+            'media_cache': IOTFactory.media_cache,
+            'media_buffers': IOTFactory.downloader.buffers,
+            'avatar_cache': self.avatar_cache,
+            'friend_index': self.friend_index,
+            'group_index': self.group_index,
+            'member_store': self.member_store,
+            'profile_cache': self.profile_cache,
+            'send_scheduler': self.send_scheduler,
+            'traffic_recorder': self.traffic_recorder,
+            'snapshot': self.snapshot,
+            'image_optimizer': self.image_optimizer,
+        }
+        for name, component in components.items():
+            if component:
+                metrics.register_collector(name, component.stats)
+        metrics.register_collector('downloader', IOTFactory.downloader.stats, label='host')
+        metrics.register_collector('dispatcher', self.dispatcher.stats, label='chat')
+        metrics.register_collector('handler', lambda: metrics.transpose(self.iot_msg.stats()), label='handler')
+        if self.client_config.get('metrics_port'):
+            metrics.serve(self.client_config['metrics_port'], self.client_config.get('metrics_host', '127.0.0.1'))
+        if self.client_config.get('metrics_file'):
+            metrics.write_periodically(self.client_config['metrics_file'],
+                                       self.client_config.get('metrics_interval', 15))
+
+    def submit_send(self, target: str, func: Callable[[], Dict], priority: int = PRIORITY_MEDIA) -> 'Future[Dict]':
+        """
+        Queue a send in the send scheduler, timing how long it waited and took
+
+        :param target: The chat the message is sent to
+        :param func: Calls Action to send the message
+        """
+        queued_at = time.perf_counter()
+        waited = False
+
+        def send() -> Dict:
+            nonlocal waited
+            if not waited:  # Retries of throttled sends are not counted again
+                waited = True
+                IOTFactory.metrics.observe('send_wait', time.perf_counter() - queued_at)
+            with IOTFactory.metrics.time('send'):
+                return func()
+
+        return self.send_scheduler.submit(target, send, priority)
+
+    def wait_send(self, future: Union['Future[Dict]', None], target: str, check: bool = True) -> Dict:
+        """
+        Wait for a send queued by submit_send
 
-    def iot_send_text_message(self, chat_type: str, chat_uin: str, content: str):
+        Whether the message went out is unknown when the send was already in flight
+        on timeout, or when OPQBot could not be reached (botoy then returns no Ret).
+        This is only logged, reporting a failure would make the user send it again.
+
+        :param check: Also fail when OPQBot does not accept the message
+        :return: OPQBot response, without Ret when the outcome is unknown
+        :raise EFBMessageError: The message was not sent
+        """
+        if future is None:
+            raise EFBMessageError(f"Sending to {target} is not supported.")
+        try:
+            response = future.result(timeout=self.client_config.get('send_timeout', 60)) or {}
+        except FutureTimeoutError:
+            if future.cancel():  # Still queued, it is never sent
+                raise EFBMessageError(f"Timed out sending to {target}.")
+            self.logger.warning(f"Timed out waiting for the message to {target} being sent, delivery unknown.")
+            return {}
+        except Exception as e:
+            raise EFBMessageError(f"Failed to send to {target}! {e}") from e
+        if 'Ret' not in response:
+            self.logger.warning(f"No response from OPQBot for the message to {target}, delivery unknown.")
+        elif check and response['Ret'] != 0:
+            raise EFBMessageError(f"OPQBot refused the message to {target}. {response}")
+        return response
+
+    def iot_send_text_message(self, chat_type: str, chat_uin: str, content: str) -> 'Future[Dict]':
+        target = f"{chat_type}_{chat_uin}"
         if chat_type == 'phone':  # Send text to self
-            self.action.sendPhoneText(content)
+            return self.submit_send(target, functools.partial(self.action.sendPhoneText, content), PRIORITY_TEXT)
         elif chat_type == 'group':
             chat_uin = int(chat_uin)
-            self.action.sendGroupText(chat_uin, content)
+            return self.submit_send(target, functools.partial(self.action.sendGroupText, chat_uin, content),
+                                    PRIORITY_TEXT)
         elif chat_type == 'friend':
             chat_uin = int(chat_uin)
-            self.action.sendFriendText(chat_uin, content)
+            return self.submit_send(target, functools.partial(self.action.sendFriendText, chat_uin, content),
+                                    PRIORITY_TEXT)
         elif chat_type == 'private':
             user_info = chat_uin.split('_')
             chat_uin = int(user_info[0])
             chat_origin = int(user_info[1])
-            self.action.sendPrivateText(chat_uin, chat_origin, content)
+            return self.submit_send(target, functools.partial(self.action.sendPrivateText,
+                                                              chat_uin, chat_origin, content),
+                                    PRIORITY_TEXT)
 
     def iot_send_image_message(self, chat_type: str, chat_uin: str, file: IO, content: Union[str, None] = None):
-        image_base64 = base64.b64encode(file.read()).decode("UTF-8")
-        md5_sum = hashlib.md5(file.read()).hexdigest()
         content = content if content else ""
+        image_base64, md5_sum = encode_file_base64(file)  # The MD5 is needed either way, the file is read once
+        if self.upload_index and md5_sum in self.upload_index:
+            # Already uploaded, reference it by MD5 instead of sending the bytes again
+            response = self.iot_send_pic(chat_type, chat_uin, content,
+                                         picMd5s=base64.b64encode(bytes.fromhex(md5_sum)).decode())
+            if response.get('Ret', -1) == 0 or 'Ret' not in response:  # Uploading again may send it twice
+                self.logger.debug("Sent image %s by MD5 reference", md5_sum)
+                return response
+            self.logger.info("MD5 reference of image %s rejected, uploading it again. %s", md5_sum, response)
+            self.upload_index.discard(md5_sum)
+        response = self.iot_send_pic(chat_type, chat_uin, content, picBase64Buf=image_base64)
+        if response.get('Ret', 0) != 0:
+            raise EFBMessageError(f"OPQBot refused the picture to {chat_type}_{chat_uin}. {response}")
+        if self.upload_index and 'Ret' in response:
+            self.upload_index.add(md5_sum)
+        return response
+
+    def iot_send_pic(self, chat_type: str, chat_uin: str, content: str, **pic) -> Dict:
+        """
+        Send a picture to the given chat and wait for it to be sent
+
+        :param pic: Either picBase64Buf or picMd5s, passed to Action as is
+        :return: OPQBot response
+        :raise EFBMessageError: The picture was not sent
+        """
+        target = f"{chat_type}_{chat_uin}"
+        future = None
         if chat_type == 'private':
             user_info = chat_uin.split('_')
             chat_uin = int(user_info[0])
             chat_origin = int(user_info[1])
-            self.action.sendPrivatePic(user=chat_uin, group=chat_origin, picBase64Buf=image_base64, content=content)
+            future = self.submit_send(target, functools.partial(
+                self.action.sendPrivatePic, user=chat_uin, group=chat_origin, content=content, **pic))
         elif chat_type == 'friend':
             chat_uin = int(chat_uin)
-            self.action.sendFriendPic(user=chat_uin, picBase64Buf=image_base64, content=content)
+            future = self.submit_send(target, functools.partial(
+                self.action.sendFriendPic, user=chat_uin, content=content, **pic))
         elif chat_type == 'group':
             chat_uin = int(chat_uin)
-            self.action.sendGroupPic(group=chat_uin, picBase64Buf=image_base64, content=content)
+            future = self.submit_send(target, functools.partial(
+                self.action.sendGroupPic, group=chat_uin, content=content, **pic))
+        return self.wait_send(future, target, check=False)
 
-    def iot_send_voice_message(self, chat_type: str, chat_uin: str, file: IO):
-        voice_base64 = base64.b64encode(file.read()).decode("UTF-8")
+    def iot_send_voice_message(self, chat_type: str, chat_uin: str, file: IO) -> Union['Future[Dict]', None]:
+        voice_base64, _ = encode_file_base64(file)
+        target = f"{chat_type}_{chat_uin}"
         if chat_type == 'private':
             user_info = chat_uin.split('_')
             chat_uin = int(user_info[0])
             chat_origin = int(user_info[1])
-            self.action.sendPrivateVoice(user=chat_uin, group=chat_origin, voiceBase64Buf=voice_base64)
+            return self.submit_send(target, functools.partial(
+                self.action.sendPrivateVoice, user=chat_uin, group=chat_origin, voiceBase64Buf=voice_base64))
         elif chat_type == 'friend':
             chat_uin = int(chat_uin)
-            self.action.sendFriendVoice(user=chat_uin, voiceBase64Buf=voice_base64)
+            return self.submit_send(target, functools.partial(
+                self.action.sendFriendVoice, user=chat_uin, voiceBase64Buf=voice_base64))
         elif chat_type == 'group':
             chat_uin = int(chat_uin)
-            self.action.sendGroupVoice(group=chat_uin, voiceBase64Buf=voice_base64)
\ No newline at end of file
+            return self.submit_send(target, functools.partial(
+                self.action.sendGroupVoice, group=chat_uin, voiceBase64Buf=voice_base64))
+        return None
\ No newline at end of file
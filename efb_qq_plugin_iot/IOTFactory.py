@@ -2,7 +2,18 @@ from typing import Dict
 
 from botoy import Action, Botoy
 
+from efb_qq_plugin_iot.Downloader import Downloader
+from efb_qq_plugin_iot.MediaCache import MediaCache
+from efb_qq_plugin_iot.Metrics import Metrics
+from efb_qq_plugin_iot.Prefetcher import Prefetcher
+from efb_qq_plugin_iot.Transcoder import Transcoder
+
 
 class IOTFactory:
     action: Action = None
     bot: Botoy = None
+    downloader: Downloader = None
+    prefetcher: Prefetcher = None
+    media_cache: MediaCache = None
+    transcoder: Transcoder = None
+    metrics: Metrics = Metrics()
@@ -1,36 +1,192 @@
 import json
 import logging
+import os
+import re
+import shutil
 import tempfile
+import threading
+import time
 from contextlib import suppress
 from json.decoder import JSONDecodeError
-from typing import List
+from concurrent.futures import Future
+from typing import IO, TYPE_CHECKING, Callable, Dict, List, Tuple, Union
 
-import pydub as pydub
 from botoy import FriendMsg, GroupMsg
-from botoy.refine import refine_pic_friend_msg, refine_voice_friend_msg, refine_pic_group_msg, refine_voice_group_msg
-from botoy.refine._friend_msg import refine_reply_friend_msg, refine_video_friend_msg, refine_file_friend_msg
-from botoy.refine._group_msg import refine_reply_group_msg, refine_at_group_msg, refine_file_group_msg, \
-    refine_video_group_msg
 from ehforwarderbot import Message, Chat
 
+from efb_qq_plugin_iot.Downloader import DownloadTooLarge
+from efb_qq_plugin_iot.IOTConfig import IOTConfig
 from efb_qq_plugin_iot.IOTFactory import IOTFactory
 from efb_qq_plugin_iot.MsgDecorator import efb_text_simple_wrapper, efb_image_wrapper, efb_unsupported_wrapper, \
     efb_voice_wrapper, efb_video_wrapper, efb_file_wrapper
-from efb_qq_plugin_iot.Utils import download_file
+from efb_qq_plugin_iot.Transcoder import IN_MEMORY_SUPPORTED, memory_copy, memory_file, memory_file_path, \
+    silk_to_opus, voice_supported
+from efb_qq_plugin_iot.Utils import download_file, download_media
 
 logger = logging.getLogger(__name__)
 
-try:
-    import Silkv3
+if TYPE_CHECKING:
+    from botoy.refine import _FriendPic, _GroupPic
 
-    VOICE_SUPPORTED = True
-except ImportError:
-    VOICE_SUPPORTED = False
+MB = 1024 * 1024
+
+
+MsgHandlerFunc = Callable[[Union[FriendMsg, GroupMsg], Chat], List[Union[Message, Future]]]
+
+
+class MsgHandler:
+    """
+    A registered message handler, counting its invocations and their duration
+    """
+
+    def __init__(self, func: MsgHandlerFunc):
+        self.func = func
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __call__(self, ctx: Union[FriendMsg, GroupMsg], chat: Chat) -> List[Union[Message, Future]]:
+        start = time.perf_counter()
+        failed = True
+        try:
+            messages = self.func(ctx, chat)
+            failed = False
+            return messages
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.calls += 1
+                self.failures += failed
+                self.total_time += duration
+                self.max_time = max(self.max_time, duration)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'failures': self.failures,
+                'total_time': self.total_time,
+                'mean_time': self.total_time / self.calls if self.calls else 0.0,
+                'max_time': self.max_time,
+            }
 
 
 class IOTMsgProcessor:
+    HANDLER_NAME = re.compile(r'^iot_(\w+)_(friend|group)$')
+
     def __init__(self, uin: int):
         self.uin = uin
+        self.handlers: Dict[Tuple[str, str], MsgHandler] = {}
+        self.unsupported = MsgHandler(self.iot_unsupported)
+        for name in dir(self):
+            match = self.HANDLER_NAME.match(name)
+            if match:
+                self.register(match.group(1), match.group(2), getattr(self, name))
+
+    def register(self, msg_type: str, kind: str, func: MsgHandlerFunc):
+        """
+        Register the handler of a message type, replacing the existing one
+
+        :param msg_type: MsgType of the OPQBot message, e.g. TextMsg
+        :param kind: friend or group
+        :param func: Called with the message and the chat, returns the EFB messages
+                     (or futures resolved with one) to deliver
+        """
+        self.handlers[(msg_type, kind)] = MsgHandler(func)
+
+    def process(self, ctx: Union[FriendMsg, GroupMsg], chat: Chat, kind: str) -> List[Union[Message, Future]]:
+        """
+        Split a message from OPQBot into EFB messages with the handler registered for its type
+
+        :param kind: friend or group
+        """
+        handler = self.handlers.get((ctx.MsgType, kind), self.unsupported)
+        with IOTFactory.metrics.time('process'):
+            return handler(ctx, chat) or []
+
+    def stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """
+        Invocation counts and durations of the handlers invoked at least once
+        """
+        stats = {f"{msg_type}_{kind}": handler.stats() for (msg_type, kind), handler in self.handlers.items()
+                 if handler.calls}
+        if self.unsupported.calls:
+            stats['unsupported'] = self.unsupported.stats()
+        return stats
+
+    @staticmethod
+    def _fetch_pics(pics: List[Union['_FriendPic', '_GroupPic']]) -> List[Message]:
+        """
+        Download all pictures of one message concurrently.
+        Pictures that failed to download are replaced by a placeholder to keep the original order.
+
+        :param pics: Refined pictures in their original order
+        :return: EFB Messages in the same order as pics
+        """
+        md5s = {pic.Url: pic.FileMd5 for pic in pics}
+        messages = []
+        for result in IOTFactory.prefetcher.fetch_all([pic.Url for pic in pics],
+                                                      lambda url: download_media(url, md5=md5s.get(url))):
+            if result.ok:
+                messages.append(efb_image_wrapper(result.file))
+            else:
+                messages.append(efb_unsupported_wrapper("[Image download failed, Please check it on your phone]"))
+        return messages
+
+    @staticmethod
+    def _transcode_voice(input_file: IO) -> 'Future[Message]':
+        """
+        Transcode a Silk voice to Opus in the transcoder process pool.
+
+        When in memory, the worker opens the in-memory files of this process through /proc,
+        neither the voice nor the result is written to disk.
+
+        :param input_file: The downloaded Silk file, closed once the transcoding is done
+        :return: A future resolved with the voice message, or a placeholder on failure
+        """
+        in_memory = IOTConfig.configs.get('voice_in_memory', True) and IN_MEMORY_SUPPORTED
+        source = None
+        if in_memory:
+            if getattr(input_file, 'in_memory', False):  # Not spilled to disk to get a path
+                source = memory_copy(input_file, 'silk')
+            output_file = memory_file('opus')
+            input_path = memory_file_path(source, os.getpid()) if source else input_file.name
+            output_path = memory_file_path(output_file, os.getpid())
+        else:
+            output_file = tempfile.NamedTemporaryFile()
+            input_path, output_path = input_file.name, output_file.name
+        start = time.perf_counter()
+
+        def wrapper() -> Message:
+            if not in_memory:
+                return efb_voice_wrapper(output_file)
+            # Handed over as a media buffer, named after the voice and delivered without a path
+            voice = IOTFactory.downloader.buffers.create()
+            try:
+                shutil.copyfileobj(output_file, voice)
+                voice.seek(0)
+                voice.md5 = getattr(input_file, 'md5', None)
+                voice.url = getattr(input_file, 'url', None)
+                return efb_voice_wrapper(voice)
+            except BaseException:
+                voice.close()
+                raise
+
+        def cleanup(delivered: bool):
+            IOTFactory.metrics.observe('transcode', time.perf_counter() - start)
+            input_file.close()
+            if source:
+                source.close()
+            if in_memory or not delivered:
+                output_file.close()
+
+        return IOTFactory.transcoder.transcode(
+            silk_to_opus, input_path, output_path, in_memory,
+            wrapper=wrapper,
+            fallback=lambda: efb_unsupported_wrapper("[Voice Message, Please check it on your phone]"),
+            cleanup=cleanup)
 
     @staticmethod
     def iot_TextMsg_friend(ctx: FriendMsg, chat: Chat) -> List[Message]:
@@ -53,17 +209,12 @@ class IOTMsgProcessor:
 
     @staticmethod
     def iot_PicMsg_friend(ctx: FriendMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_pic_friend_msg
+
         messages = []
         refine_pics = refine_pic_friend_msg(ctx)
         if refine_pics:
-            for pics in refine_pics.FriendPic:
-                try:
-                    f = download_file(pics.Url)
-                except Exception as e:
-                    logger.warning(f"Failed to download the image! {e}")
-                    continue
-                else:
-                    messages.append(efb_image_wrapper(f))
+            messages.extend(IOTMsgProcessor._fetch_pics(refine_pics.FriendPic))
             if refine_pics.Content:
                 messages.append(efb_text_simple_wrapper(refine_pics.Content))
         else:
@@ -73,7 +224,9 @@ class IOTMsgProcessor:
 
     @staticmethod
     def iot_VoiceMsg_friend(ctx: FriendMsg, chat: Chat) -> List[Message]:
-        if not VOICE_SUPPORTED:
+        from botoy.refine import refine_voice_friend_msg
+
+        if not voice_supported():
             content = "[Voice Message, Please check it on your phone]"
             return [efb_unsupported_wrapper(content)]
         refine_voices = refine_voice_friend_msg(ctx)
@@ -85,29 +238,28 @@ class IOTMsgProcessor:
                 content = "[Voice Message, Please check it on your phone]"
                 return [efb_unsupported_wrapper(content)]
             else:
-                output_file = tempfile.NamedTemporaryFile()
-                if not Silkv3.decode(input_file.name, output_file.name):
-                    content = "[Voice Message, Please check it on your phone]"
-                    return [efb_unsupported_wrapper(content)]
-                pydub.AudioSegment.from_raw(file=output_file, sample_width=2, frame_rate=24000, channels=1) \
-                    .export(output_file, format="ogg", codec="libopus",
-                            parameters=['-vbr', 'on'])
-                return [efb_voice_wrapper(output_file)]
+                return [IOTMsgProcessor._transcode_voice(input_file)]
         else:
             content = "[Voice Message, Please check it on your phone]"
             return [efb_unsupported_wrapper(content)]
 
     @staticmethod
     def iot_VideoMsg_friend(ctx: FriendMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_video_friend_msg
+
         refine_video = refine_video_friend_msg(ctx)
         if refine_video:
             video_raw_url = refine_video.VideoUrl
             video_md5 = refine_video.VideoMd5
             try:
-                video_info = IOTFactory.action.getVideoURL(group=0,
-                                                           videoURL=video_raw_url,
-                                                           videoMD5=video_md5)
-                video_file = download_file(video_info.get('VideoUrl', ''))
+                video_file = download_media(
+                    lambda: IOTFactory.action.getVideoURL(group=0, videoURL=video_raw_url,
+                                                          videoMD5=video_md5).get('VideoUrl', ''),
+                    md5=video_md5, max_size=IOTConfig.configs.get('max_video_size', 50) * MB)
+            except DownloadTooLarge as e:
+                logger.warning(f"Skipped the video! {e}")
+                content = "[Video too large, Please check it on your phone]"
+                return [efb_unsupported_wrapper(content)]
             except Exception as e:
                 logger.warning(f"Failed to download the video! {e}")
                 content = "[Video Message, Please check it on your phone]"
@@ -120,20 +272,30 @@ class IOTMsgProcessor:
 
     @staticmethod
     def iot_FriendFileMsg_friend(ctx: FriendMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_file_friend_msg
+
         refine_file = refine_file_friend_msg(ctx)
         if refine_file:
             file_id = refine_file.FileID
             file_size = refine_file.FileSize
             file_name = refine_file.FileName
-            if file_size > 50 * 1024 * 1024:  # 50M
+            max_size = IOTConfig.configs.get('max_file_size', 50) * MB
+            if file_size > max_size:
                 content = "[File too large, Please check it on your phone]\n" \
                           f"File name: {file_name}\n" \
                           f"File size: {file_size}\n" \
                           f"File id: {file_id}"
                 return [efb_unsupported_wrapper(content)]
             try:
-                file_info = IOTFactory.action.getFriendFileURL(file_id)
-                actual_file = download_file(file_info.get('Url', ''))
+                actual_file = download_media(
+                    lambda: IOTFactory.action.getFriendFileURL(file_id).get('Url', ''),
+                    ident=f"friend_file_{file_id}", max_size=max_size)
+            except DownloadTooLarge as e:
+                logger.warning(f"Skipped the file {file_name}! {e}")
+                content = "[File too large, Please check it on your phone]\n" \
+                          f"File name: {file_name}\n" \
+                          f"File id: {file_id}"
+                return [efb_unsupported_wrapper(content)]
             except Exception as e:
                 logger.warning(f"Failed to download the file! {e}")
                 content = "[File message, Please check it on your phone]"
@@ -164,6 +326,8 @@ class IOTMsgProcessor:
 
     @staticmethod
     def iot_ReplayMsg_friend(ctx: FriendMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_reply_friend_msg
+
         refine_reply = refine_reply_friend_msg(ctx)
         if refine_reply:
             quote_text = f"「{refine_reply.SrcContent}」\n\n{refine_reply.Content}"
@@ -177,6 +341,8 @@ class IOTMsgProcessor:
         return [efb_text_simple_wrapper(content)]
 
     def iot_AtMsg_group(self, ctx: GroupMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_at_group_msg
+
         refine_at = refine_at_group_msg(ctx)
         quote_text = ""
         if refine_at:
@@ -200,17 +366,12 @@ class IOTMsgProcessor:
 
     @staticmethod
     def iot_PicMsg_group(ctx: GroupMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_pic_group_msg
+
         messages = []
         refine_pics = refine_pic_group_msg(ctx)
         if refine_pics:
-            for pics in refine_pics.GroupPic:
-                try:
-                    f = download_file(pics.Url)
-                except Exception as e:
-                    logger.warning(f"Failed to download the image! {e}")
-                    continue
-                else:
-                    messages.append(efb_image_wrapper(f))
+            messages.extend(IOTMsgProcessor._fetch_pics(refine_pics.GroupPic))
             if refine_pics.Content:
                 messages.append(efb_text_simple_wrapper(refine_pics.Content))
         else:
@@ -220,15 +381,21 @@ class IOTMsgProcessor:
 
     @staticmethod
     def iot_VideoMsg_group(ctx: GroupMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_video_group_msg
+
         refine_video = refine_video_group_msg(ctx)
         if refine_video:
             video_raw_url = refine_video.VideoUrl
             video_md5 = refine_video.VideoMd5
             try:
-                video_info = IOTFactory.action.getVideoURL(group=ctx.FromGroupId,
-                                                           videoURL=video_raw_url,
-                                                           videoMD5=video_md5)
-                video_file = download_file(video_info.get('VideoUrl', ''))
+                video_file = download_media(
+                    lambda: IOTFactory.action.getVideoURL(group=ctx.FromGroupId, videoURL=video_raw_url,
+                                                          videoMD5=video_md5).get('VideoUrl', ''),
+                    md5=video_md5, max_size=IOTConfig.configs.get('max_video_size', 50) * MB)
+            except DownloadTooLarge as e:
+                logger.warning(f"Skipped the video! {e}")
+                content = "[Video too large, Please check it on your phone]"
+                return [efb_unsupported_wrapper(content)]
             except Exception as e:
                 logger.warning(f"Failed to download the video! {e}")
                 content = "[Video Message, Please check it on your phone]"
@@ -241,7 +408,9 @@ class IOTMsgProcessor:
 
     @staticmethod
     def iot_VoiceMsg_group(ctx: GroupMsg, chat: Chat) -> List[Message]:
-        if not VOICE_SUPPORTED:
+        from botoy.refine import refine_voice_group_msg
+
+        if not voice_supported():
             content = "[Voice Message, Please check it on your phone]"
             return [efb_unsupported_wrapper(content)]
         refine_voices = refine_voice_group_msg(ctx)
@@ -253,34 +422,37 @@ class IOTMsgProcessor:
                 content = "[Voice Message, Please check it on your phone]"
                 return [efb_unsupported_wrapper(content)]
             else:
-                output_file = tempfile.NamedTemporaryFile()
-                if not Silkv3.decode(input_file.name, output_file.name):
-                    content = "[Voice Message, Please check it on your phone]"
-                    return [efb_unsupported_wrapper(content)]
-                pydub.AudioSegment.from_raw(file=output_file, sample_width=2, frame_rate=24000, channels=1) \
-                    .export(output_file, format="ogg", codec="libopus",
-                            parameters=['-vbr', 'on'])
-                return [efb_voice_wrapper(output_file)]
+                return [IOTMsgProcessor._transcode_voice(input_file)]
         else:
             content = "[Voice Message, Please check it on your phone]"
             return [efb_unsupported_wrapper(content)]
 
     @staticmethod
     def iot_GroupFileMsg_group(ctx: GroupMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_file_group_msg
+
         refine_file = refine_file_group_msg(ctx)
         if refine_file:
             file_id = refine_file.FileID
             file_size = refine_file.FileSize
             file_name = refine_file.FileName
-            if file_size > 50 * 1024 * 1024:  # 50M
+            max_size = IOTConfig.configs.get('max_file_size', 50) * MB
+            if file_size > max_size:
                 content = "[File too large, Please check it on your phone]\n" \
                           f"File name: {file_name}\n" \
                           f"File size: {file_size}\n" \
                           f"File id: {file_id}"
                 return [efb_unsupported_wrapper(content)]
             try:
-                file_info = IOTFactory.action.getGroupFileURL(ctx.FromGroupId, file_id)
-                actual_file = download_file(file_info.get('Url', ''))
+                actual_file = download_media(
+                    lambda: IOTFactory.action.getGroupFileURL(ctx.FromGroupId, file_id).get('Url', ''),
+                    ident=f"group_file_{ctx.FromGroupId}_{file_id}", max_size=max_size)
+            except DownloadTooLarge as e:
+                logger.warning(f"Skipped the file {file_name}! {e}")
+                content = "[File too large, Please check it on your phone]\n" \
+                          f"File name: {file_name}\n" \
+                          f"File id: {file_id}"
+                return [efb_unsupported_wrapper(content)]
             except Exception as e:
                 logger.warning(f"Failed to download the file! {e}")
                 content = "[File message, Please check it on your phone]"
@@ -309,6 +481,8 @@ class IOTMsgProcessor:
         return self.iot_ReplayMsg_group(ctx, chat)
 
     def iot_ReplayMsg_group(self, ctx: GroupMsg, chat: Chat) -> List[Message]:
+        from botoy.refine import refine_reply_group_msg
+
         refine_reply = refine_reply_group_msg(ctx)
         if refine_reply:
             quote_text = f"「{refine_reply.SrcContent}」\n\n{refine_reply.Content}"
@@ -323,8 +497,7 @@ class IOTMsgProcessor:
             at_list[(begin_index, end_index)] = chat.self
         return [efb_text_simple_wrapper(quote_text, at_list)]
 
-    def __getattr__(self, name):
-        def fallback(*args, **kwargs):
-            content = f"Unsupported Message Type: {name}"
-            return [efb_unsupported_wrapper(content)]
-        return fallback
+    @staticmethod
+    def iot_unsupported(ctx: Union[FriendMsg, GroupMsg], chat: Chat) -> List[Message]:
+        content = f"Unsupported Message Type: {ctx.MsgType}"
+        return [efb_unsupported_wrapper(content)]
@@ -0,0 +1,166 @@
+# coding: utf-8
+import importlib.util
+import io
+import logging
+import threading
+from typing import IO, Dict, Iterator, Optional
+
+from cachetools import LRUCache
+
+from efb_qq_plugin_iot.IOTFactory import IOTFactory
+from efb_qq_plugin_iot.MediaCache import MediaCache
+from efb_qq_plugin_iot.Utils import hash_file_md5
+
+logger = logging.getLogger(__name__)
+
+
+class ImageOptimizer:
+    """
+    Downscales and recompresses the pictures sent to QQ before they are uploaded.
+
+    QQ recompresses pictures anyway, uploading a full resolution photo only costs
+    a larger payload and a slower send. Pictures within the limits, and those
+    which do not get any smaller, are sent as is. Results are cached by the MD5
+    of the source, so a picture sent again is neither decoded nor uploaded again
+    (its optimized copy keeps the same MD5 for the upload index).
+
+    Pillow is an optional dependency (the images extra), without it the optimizer
+    disables itself and pictures are sent as is.
+    """
+
+    def __init__(self, cache: Optional[MediaCache] = None, max_side: int = 2048, max_size: int = 1024 * 1024,
+                 quality: int = 85, animation_max_side: int = 512, animation_max_size: int = 2 * 1024 * 1024):
+        """
+        :param cache: Where optimized pictures are kept, None to optimize them every time
+        :param max_side: Pictures with a longer side are downscaled to it
+        :param max_size: Pictures larger than this many bytes are recompressed
+        :param quality: JPEG quality of the recompressed pictures
+        :param animation_max_side: Same as max_side for GIFs and other animations
+        :param animation_max_size: Same as max_size for GIFs and other animations
+        """
+        self.enabled = importlib.util.find_spec('PIL') is not None
+        if not self.enabled:
+            logger.warning("Pillow is not installed, pictures are sent as is. "
+                           "Install efb-qq-plugin-iot[images] to optimize them.")
+        self.cache = cache
+        self.max_side = max_side
+        self.max_size = max_size
+        self.quality = quality
+        self.animation_max_side = animation_max_side
+        self.animation_max_size = animation_max_size
+        self.settings = f"{max_side}:{max_size}:{quality}:{animation_max_side}:{animation_max_size}"
+        self.lock = threading.Lock()
+        self.kept: LRUCache = LRUCache(maxsize=1024)  # MD5s of the pictures better sent as is
+        self.counters = {
+            'optimized': 0,
+            'kept': 0,
+            'cache_hits': 0,
+            'failures': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+
+    def optimize(self, file: IO) -> IO:
+        """
+        :param file: The picture to be sent
+        :return: The optimized picture, or file itself when it is better sent as is,
+                 in both cases positioned at the beginning. Close it once sent if it is not file.
+        """
+        if not self.enabled:
+            file.seek(0)
+            return file
+        source_md5 = hash_file_md5(file)
+        size = file.tell()
+        file.seek(0)
+        with self.lock:
+            kept = self.kept.get(source_md5, False)
+        if kept:
+            self._count('kept')
+            return file
+        key = MediaCache.key(ident=f"{source_md5}:{self.settings}")
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached:
+                self._count('cache_hits')
+                return cached
+        try:
+            with IOTFactory.metrics.time('optimize'):
+                output = self._optimize(file, size)
+        except Exception as e:  # Pillow raises all sorts of errors on broken or unknown pictures
+            logger.warning(f"Failed to optimize the picture {source_md5}, sending it as is. {e}")
+            self._count('failures')
+            output = None
+        file.seek(0)
+        if output is None:
+            with self.lock:
+                self.kept[source_md5] = True
+            self._count('kept')
+            return file
+        if self.cache:
+            try:
+                cached = self.cache.put(key, output)
+                if cached:
+                    cached.close()
+            except OSError as e:
+                logger.warning(f"Failed to store the optimized picture {source_md5}. {e}")
+        with self.lock:
+            self.counters['optimized'] += 1
+            self.counters['bytes_in'] += size
+            self.counters['bytes_out'] += len(output.getbuffer())
+        return output
+
+    def _optimize(self, file: IO, size: int) -> Optional[io.BytesIO]:
+        from PIL import Image
+
+        image = Image.open(file)
+        if getattr(image, 'is_animated', False):
+            if max(image.size) <= self.animation_max_side and size <= self.animation_max_size:
+                return None
+            output = self._animation(image)
+        else:
+            if max(image.size) <= self.max_side and size <= self.max_size:
+                return None
+            output = self._picture(image)
+        if len(output.getbuffer()) >= size:
+            return None
+        output.seek(0)
+        return output
+
+    def _picture(self, image) -> io.BytesIO:
+        from PIL import Image, ImageOps
+
+        scale = min(1.0, self.max_side / max(image.size))
+        # JPEGs are decoded at the smallest scale still larger than the target, a fraction of a full decode
+        image.draft('RGB', (int(image.width * scale) + 1, int(image.height * scale) + 1))
+        image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+        image = ImageOps.exif_transpose(image)  # The EXIF orientation is not kept, cheaper on the downscaled copy
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image.save(output, 'PNG')
+        else:
+            image.convert('RGB').save(output, 'JPEG', quality=self.quality, optimize=True)
+        return output
+
+    def _animation(self, image) -> io.BytesIO:
+        from PIL import ImageSequence
+
+        def frames() -> Iterator:
+            # Frames are resized one at a time as they are written, never all held in memory
+            for frame in ImageSequence.Iterator(image):
+                frame = frame.convert('RGBA')
+                frame.thumbnail((self.animation_max_side, self.animation_max_side))
+                yield frame
+
+        resized = frames()
+        output = io.BytesIO()
+        next(resized).save(output, 'GIF', save_all=True, append_images=resized, loop=image.info.get('loop', 0),
+                           optimize=True)
+        return output
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
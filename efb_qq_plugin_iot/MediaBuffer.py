@@ -0,0 +1,192 @@
+# coding: utf-8
+import io
+import logging
+import os
+import tempfile
+import threading
+from typing import IO, Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BufferPool:
+    """
+    Creates the buffers media are downloaded into and bounds the memory they hold.
+
+    Small media such as stickers and thumbnails stay in memory, a buffer is spilled
+    to a file in the spool directory once it grows past the threshold, once the
+    buffers together would exceed the memory budget, or as soon as a path is asked for.
+    """
+
+    def __init__(self, threshold: int = 512 * 1024, max_memory: int = 64 * 1024 * 1024,
+                 spool_dir: Optional[str] = None):
+        """
+        :param threshold: Max size in bytes of a buffer kept in memory, 0 to always use files
+        :param max_memory: Max number of bytes held in memory by all buffers together
+        :param spool_dir: The directory buffers are spilled to, e.g. a tmpfs, the system temp directory by default
+        """
+        self.threshold = threshold
+        self.max_memory = max_memory
+        self.spool_dir = spool_dir
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.memory = 0
+        self.counters = {
+            'created': 0,
+            'spilled': 0,
+            'spilled_bytes': 0,
+            'memory_full': 0,
+            'peak_memory': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'BufferPool':
+        return cls(threshold=config.get('media_buffer_threshold', 512) * 1024,
+                   max_memory=config.get('media_buffer_memory', 64) * 1024 * 1024,
+                   spool_dir=config.get('media_buffer_dir'))
+
+    @property
+    def directory(self) -> str:
+        return self.spool_dir or tempfile.gettempdir()
+
+    def create(self) -> 'MediaBuffer':
+        """
+        Create an empty buffer
+        Remember to close the buffer once you are done with it!
+        """
+        with self.lock:
+            self.counters['created'] += 1
+        return MediaBuffer(self)
+
+    def _reserve(self, size: int) -> bool:
+        with self.lock:
+            if self.memory + size > self.max_memory:
+                self.counters['memory_full'] += 1
+                return False
+            self.memory += size
+            self.counters['peak_memory'] = max(self.counters['peak_memory'], self.memory)
+            return True
+
+    def _release(self, size: int):
+        with self.lock:
+            self.memory -= size
+
+    def _spilled(self, size: int):
+        with self.lock:
+            self.counters['spilled'] += 1
+            self.counters['spilled_bytes'] += size
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['memory'] = self.memory
+        return stats
+
+
+class MediaBuffer:
+    """
+    A file object holding its content in memory until it is spilled to a named temporary file.
+
+    Accessing name or fileno spills the buffer, so it can be handed to anything expecting a file on disk,
+    e.g. an external codec. Other file methods are those of the underlying io.BytesIO or temporary file.
+    """
+
+    def __init__(self, pool: BufferPool):
+        self.pool = pool
+        self.file: IO[bytes] = io.BytesIO()
+        self.reserved = 0  # Bytes accounted in the pool for the in-memory content
+
+    @property
+    def in_memory(self) -> bool:
+        return self.reserved is not None
+
+    def _ensure(self, size: int):
+        """
+        Make room in memory for size bytes, spill when it does not fit
+        """
+        if not self.in_memory or size <= self.reserved:
+            return
+        if size <= self.pool.threshold and self.pool._reserve(size - self.reserved):
+            self.reserved = size
+        else:
+            self.spill()
+
+    def reserve(self, size: int):
+        """
+        Announce the expected size of the content, spill at once when it is not going to stay in memory
+        """
+        self._ensure(size)
+
+    def spill(self):
+        """
+        Move the content to a named temporary file in the spool directory, keeping the position
+        """
+        if not self.in_memory:
+            return
+        memory = self.file
+        file = tempfile.NamedTemporaryFile(dir=self.pool.spool_dir)
+        try:
+            file.write(memory.getbuffer())
+            file.seek(memory.tell())
+        except BaseException:
+            file.close()
+            raise
+        self.file = file
+        self.pool._release(self.reserved)
+        self.pool._spilled(len(memory.getbuffer()))
+        self.reserved = None
+        memory.close()
+
+    def write(self, data) -> int:
+        if self.in_memory:
+            self._ensure(self.file.tell() + len(data))
+        return self.file.write(data)
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        if self.in_memory and size is not None:
+            self._ensure(size)
+        return self.file.truncate(size)
+
+    def pread(self, size: int, offset: int) -> bytes:
+        """
+        Read without moving the position, like os.pread
+        """
+        if self.in_memory:
+            return bytes(self.file.getbuffer()[offset:offset + size])
+        return os.pread(self.file.fileno(), size, offset)
+
+    @property
+    def name(self) -> str:
+        self.spill()
+        return self.file.name
+
+    def fileno(self) -> int:
+        self.spill()
+        return self.file.fileno()
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def close(self):
+        if self.in_memory and self.reserved:
+            self.pool._release(self.reserved)
+            self.reserved = 0
+        self.file.close()
+
+    def __getattr__(self, name: str):
+        return getattr(self.__dict__['file'], name)
+
+    def __enter__(self) -> 'MediaBuffer':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __del__(self):
+        if 'file' in self.__dict__:
+            self.close()
@@ -0,0 +1,170 @@
+# coding: utf-8
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import IO, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """
+    Content-addressed on-disk cache for inbound media.
+
+    Entries are keyed by the MD5 carried in the OPQ payload when there is one,
+    otherwise by a stable identifier such as the CDN URL. The cache is bounded
+    by total size and evicts the least recently used entries first.
+    """
+
+    def __init__(self, path: Union[str, Path], max_size: int = 256 * 1024 * 1024):
+        """
+        :param path: The directory to store cached files in
+        :param max_size: Max total size of cached files in bytes
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: 'OrderedDict[str, int]' = OrderedDict()  # key -> size, least recently used first
+        self.size = 0
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+        self.load()
+
+    @staticmethod
+    def key(md5: Optional[str] = None, ident: Optional[str] = None) -> Optional[str]:
+        """
+        Build the cache key of a media item
+
+        :param md5: MD5 of the content, either hex or base64 encoded as OPQ reports it
+        :param ident: Any stable identifier of the content (CDN URL, file id) used when md5 is missing
+        :return: The cache key, None if the item can not be cached
+        """
+        if md5:
+            if len(md5) != 32:
+                try:
+                    md5 = binascii.hexlify(base64.b64decode(md5, validate=True)).decode()
+                except (binascii.Error, ValueError):
+                    md5 = hashlib.sha1(md5.encode()).hexdigest()
+            return f"md5-{md5.lower()}"
+        if ident:
+            return f"id-{hashlib.sha256(ident.encode()).hexdigest()}"
+        return None
+
+    def load(self):
+        """
+        Rebuild the index from files already on disk, oldest access first
+        """
+        files = []
+        for file in self.path.glob('*/*'):
+            if not file.is_file():
+                continue
+            if file.name.startswith('.'):  # Unfinished write
+                file.unlink()
+                continue
+            stat = file.stat()
+            files.append((stat.st_mtime, file.name, stat.st_size))
+        with self.lock:
+            for _, key, size in sorted(files):
+                self.entries[key] = size
+                self.size += size
+        logger.debug("Loaded %d cached media file(s), %d bytes", len(self.entries), self.size)
+        self.evict()
+
+    def _path(self, key: str) -> Path:
+        return self.path / key[-2:] / key
+
+    def get(self, key: str) -> Optional[IO]:
+        """
+        Open a cached file.
+        Remember to close the file once you are done with the file!
+
+        :param key: The cache key
+        :return: File handle of the cached content, None on miss
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+        path = self._path(key)
+        try:
+            os.utime(path)  # Persist the LRU order across restarts
+            return open(path, 'rb')
+        except OSError:  # Removed behind our back
+            with self.lock:
+                self.size -= self.entries.pop(key, 0)
+                self.counters['hits'] -= 1
+                self.counters['misses'] += 1
+            return None
+
+    def put(self, key: str, file: IO) -> Optional[IO]:
+        """
+        Store a copy of the file, the position of file is reset to the beginning afterwards.
+        Remember to close the returned file once you are done with the file!
+
+        :param key: The cache key
+        :param file: The file to be cached
+        :return: File handle of the cached copy, opened before it can be evicted,
+                 None if the file is too large to be cached
+        """
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        if size > self.max_size:
+            return None
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_name = None
+        cached = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=path.parent, prefix='.', delete=False) as tmp:
+                tmp_name = tmp.name
+                shutil.copyfileobj(file, tmp)
+            cached = open(tmp_name, 'rb')  # Still readable once renamed, or evicted right away
+            os.replace(tmp_name, path)
+            tmp_name = None
+        finally:
+            file.seek(0)
+            if tmp_name is not None:
+                if cached:
+                    cached.close()
+                try:
+                    os.unlink(tmp_name)
+                except OSError:
+                    pass
+        with self.lock:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+        self.evict()
+        return cached
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or not self.entries:
+                    return
+                key, size = self.entries.popitem(last=False)
+                self.size -= size
+                self.counters['evictions'] += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+            stats['size'] = self.size
+        return stats
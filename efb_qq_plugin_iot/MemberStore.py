@@ -0,0 +1,222 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from botoy import EventMsg
+from botoy.collection import EventNames
+
+from efb_qq_plugin_iot.CustomTypes import EFBGroupMember, IOTGroupMember
+
+logger = logging.getLogger(__name__)
+
+
+class GroupMembers:
+    def __init__(self):
+        self.members: Dict[int, EFBGroupMember] = {}
+        self.active: 'OrderedDict[int, None]' = OrderedDict()  # Recent senders, most recent last
+        self.synced_at: float = 0
+        self.lock = threading.Lock()
+
+
+class MemberStore:
+    """
+    Group member lists indexed per group by uin.
+
+    A group is fully synced from OPQBot the first time it is needed, then kept
+    up to date from join/leave events and the names seen in group messages.
+    A full resync only happens again after ``ttl`` or when explicitly requested.
+    """
+
+    def __init__(self, fetch: Callable[[int], List[Dict]], max_groups: int = 1000, ttl: int = 86400,
+                 max_active: int = 20):
+        """
+        :param fetch: Function returning the full member list of a group from OPQBot
+        :param max_groups: Max number of groups to keep, least recently used are dropped first
+        :param ttl: Seconds before a group is fully synced again
+        :param max_active: Number of recent senders remembered per group
+        """
+        self.fetch = fetch
+        self.max_groups = max_groups
+        self.max_active = max_active
+        self.ttl = ttl
+        self.groups: 'OrderedDict[int, GroupMembers]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {
+            'syncs': 0,
+            'joins': 0,
+            'leaves': 0,
+            'renames': 0,
+            'evictions': 0,
+        }
+
+    def _group(self, group_id: int, create: bool = True) -> Optional[GroupMembers]:
+        with self.lock:
+            group = self.groups.get(group_id)
+            if group is None:
+                if not create:
+                    return None
+                group = self.groups[group_id] = GroupMembers()
+                while len(self.groups) > self.max_groups:
+                    self.groups.popitem(last=False)
+                    self.counters['evictions'] += 1
+            else:
+                self.groups.move_to_end(group_id)
+            return group
+
+    @staticmethod
+    def build_member(qq_member: IOTGroupMember) -> EFBGroupMember:
+        return EFBGroupMember(
+            name=qq_member['NickName'],
+            alias=qq_member['GroupCard'],
+            uid=str(qq_member['MemberUin'])
+        )
+
+    def get_members(self, group_id: int, no_cache: bool = False) -> List[EFBGroupMember]:
+        """
+        Get the member list of a group, fully syncing it only if needed
+
+        :param group_id: Group ID
+        :param no_cache: Force a full sync from OPQBot
+        """
+        group_id = int(group_id)
+        group = self._group(group_id)
+        synced_at = group.synced_at
+        with group.lock:  # Concurrent syncs of the same group share one fetch
+            if no_cache and group.synced_at == synced_at or time.time() - group.synced_at >= self.ttl:
+                self.sync(group_id, group)
+            return list(group.members.values())
+
+    def get_member(self, group_id: int, uin: int) -> Optional[EFBGroupMember]:
+        """
+        Look up a single member without touching OPQBot
+        """
+        group = self._group(int(group_id), create=False)
+        return group.members.get(int(uin)) if group else None
+
+    def sync(self, group_id: int, group: GroupMembers):
+        qq_members = self.fetch(group_id)
+        if not qq_members:  # OPQBot answers an empty list on errors
+            logger.warning(f"Got an empty member list of group {group_id}, keeping the cached one.")
+            return
+        group.members = {int(qq_member['MemberUin']): self.build_member(IOTGroupMember(qq_member))
+                         for qq_member in qq_members}
+        group.synced_at = time.time()
+        with self.lock:
+            self.counters['syncs'] += 1
+
+    def invalidate(self, group_id: int):
+        """
+        Drop a group, it will be fully synced on next access
+        """
+        with self.lock:
+            self.groups.pop(int(group_id), None)
+
+    def on_join(self, group_id: int, uin: int, name: str):
+        group = self._group(int(group_id), create=False)
+        if not group or not group.synced_at:
+            return
+        group.members[int(uin)] = EFBGroupMember(name=name, alias="", uid=str(uin))
+        with self.lock:
+            self.counters['joins'] += 1
+
+    def on_leave(self, group_id: int, uin: int):
+        group = self._group(int(group_id), create=False)
+        if not group:
+            return
+        if group.members.pop(int(uin), None) is not None:
+            with self.lock:
+                self.counters['leaves'] += 1
+
+    def on_name_seen(self, group_id: int, uin: int, display_name: str):
+        """
+        Update the group card of a member from the name shown in a group message.
+        OPQBot has no event for card changes, so messages are the only source.
+
+        Groups never synced are left out, an empty entry would evict a synced group.
+
+        :param display_name: The group card if set, the nickname otherwise
+        """
+        group = self._group(int(group_id), create=False)
+        if not group:
+            return
+        with self.lock:
+            group.active[int(uin)] = None
+            group.active.move_to_end(int(uin))
+            while len(group.active) > self.max_active:
+                group.active.popitem(last=False)
+        member = group.members.get(int(uin))
+        if not member or not display_name or display_name in (member['name'], member['alias']):
+            return
+        member['alias'] = display_name
+        with self.lock:
+            self.counters['renames'] += 1
+
+    def active_senders(self, group_id: int) -> List[int]:
+        """
+        The members who sent a message in the group lately, most recent first
+        """
+        group = self._group(int(group_id), create=False)
+        if not group:
+            return []
+        with self.lock:
+            return list(reversed(group.active.keys()))
+
+    def on_event(self, ctx: EventMsg):
+        """
+        Apply a group event from OPQBot to the store
+        """
+        from botoy.refine import refine_group_exit_event_msg, refine_group_join_event_msg
+
+        if ctx.EventName == EventNames.ON_EVENT_GROUP_JOIN:
+            join = refine_group_join_event_msg(ctx)
+            self.on_join(join.FromUin, join.UserID, join.UserName)
+        elif ctx.EventName == EventNames.ON_EVENT_GROUP_EXIT:
+            leave = refine_group_exit_event_msg(ctx)
+            self.on_leave(leave.FromUin, leave.UserID)
+        elif ctx.EventName == EventNames.ON_EVENT_GROUP_EXIT_SUCC:  # We left the group
+            self.invalidate(ctx.FromUin)
+
+    def dump(self) -> List[Dict]:
+        """
+        The synced member lists, least recently used group first
+        """
+        with self.lock:
+            groups = list(self.groups.items())
+            return [{'group_id': group_id, 'synced_at': group.synced_at, 'members': list(group.members.values()),
+                     'active': list(group.active.keys())}
+                    for group_id, group in groups if group.synced_at]
+
+    def restore(self, groups: List[Dict]):
+        """
+        Load saved member lists, each is fully synced again once older than ttl as usual
+        """
+        with self.lock:
+            for saved in reversed(groups):  # Inserted in front of the groups used since startup
+                group_id = int(saved['group_id'])
+                if group_id in self.groups:
+                    continue
+                group = GroupMembers()
+                group.members = {int(member['uid']): EFBGroupMember(member) for member in saved['members']}
+                group.synced_at = saved['synced_at']
+                group.active = OrderedDict.fromkeys(saved.get('active', []))
+                self.groups[group_id] = group
+                self.groups.move_to_end(group_id, last=False)
+            while len(self.groups) > self.max_groups:
+                self.groups.popitem(last=False)
+
+    def recent(self, count: int) -> List[int]:
+        """
+        The groups used most recently, most recent first
+        """
+        with self.lock:
+            return list(reversed(self.groups.keys()))[:count]
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['groups'] = len(self.groups)
+        stats['members'] = sum(len(group.members) for group in list(self.groups.values()))
+        return stats
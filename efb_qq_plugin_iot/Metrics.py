@@ -0,0 +1,208 @@
+# coding: utf-8
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'efb_iot'
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value) -> Optional[float]:
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    return None
+
+
+class Metrics:
+    """
+    Latency histograms per processing stage and the stats of the components,
+    rendered in the Prometheus text format.
+
+    Stages of inbound messages: receive (waiting in the dispatcher), profile,
+    chat, process, download, transcode, mime and deliver.
+    Stages of outbound messages: send_wait (waiting in the send queue) and send.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms: Dict[str, Histogram] = {}
+        self.collectors: List[Tuple[str, Callable[[], Dict], str]] = []
+        self.lock = threading.Lock()
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.writer: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """
+        Observe the duration of the block, failed or not
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def register_collector(self, name: str, collect: Callable[[], Dict], label: str = 'key'):
+        """
+        Export the stats of a component, read each time the metrics are rendered
+
+        :param name: Prefix of the exported metrics, e.g. media_cache
+        :param collect: Returns the stats, numeric values are exported as they are,
+                        dict values are exported with their keys as the given label,
+                        e.g. {'hosts': {host: {'requests': 1}}} as name_hosts_requests{label="host"} 1
+        :param label: Name of the label of nested values
+        """
+        self.collectors.append((name, collect, label))
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            histograms = {stage: (list(h.counts), h.sum, h.count, h.buckets) for stage, h in self.histograms.items()}
+        if histograms:
+            lines.append(f"# HELP {PREFIX}_stage_seconds Time spent in each processing stage.")
+            lines.append(f"# TYPE {PREFIX}_stage_seconds histogram")
+            for stage, (counts, total, count, buckets) in sorted(histograms.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{_escape(stage)}",le="{bound}"}} '
+                                 f'{cumulative}')
+                lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{_escape(stage)}"}} {total}')
+                lines.append(f'{PREFIX}_stage_seconds_count{{stage="{_escape(stage)}"}} {count}')
+        for name, collect, label in self.collectors:
+            try:
+                stats = collect() or {}
+            except Exception as e:
+                logger.warning(f"Failed to collect the stats of {name}! {e}")
+                continue
+            lines.extend(self._render_stats(f"{PREFIX}_{name}", stats, label))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_stats(prefix: str, stats: Dict, label: str) -> List[str]:
+        lines = []
+        for key, value in stats.items():
+            number = _number(value)
+            if number is not None:
+                lines.append(f"{prefix}_{key} {number}")
+            elif isinstance(value, dict):  # {label value: number} or {label value: {stat: number}}
+                for sub_key, sub_value in value.items():
+                    label_text = f'{label}="{_escape(sub_key)}"'
+                    number = _number(sub_value)
+                    if number is not None:
+                        lines.append(f'{prefix}_{key}{{{label_text}}} {number}')
+                    elif isinstance(sub_value, dict):
+                        for stat, stat_value in sub_value.items():
+                            number = _number(stat_value)
+                            if number is not None:
+                                lines.append(f'{prefix}_{key}_{stat}{{{label_text}}} {number}')
+        return lines
+
+    @staticmethod
+    def transpose(stats: Dict[str, Dict]) -> Dict[str, Dict]:
+        """
+        Turn {name: {stat: number}} into {stat: {name: number}},
+        to export the stats of several named components of the same kind
+        """
+        transposed: Dict[str, Dict] = {}
+        for name, values in stats.items():
+            for stat, value in values.items():
+                transposed.setdefault(stat, {})[name] = value
+        return transposed
+
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        """
+        Serve the metrics over HTTP from a background thread
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="iot_metrics_http", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def write_periodically(self, path: str, interval: float = 15):
+        """
+        Write the metrics to a file every interval seconds, e.g. for the textfile collector of node_exporter
+        """
+        path = str(path)
+
+        def run():
+            while not self.stopped.wait(interval):
+                self.write(path)
+
+        self.writer = threading.Thread(target=run, name="iot_metrics_file", daemon=True)
+        self.writer.start()
+
+    def write(self, path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics')
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+            tmp_path = None
+        except OSError as e:
+            logger.warning(f"Failed to write the metrics to {path}! {e}")
+        finally:
+            if tmp_path is not None:  # Not renamed, e.g. the disk is full
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+    def shutdown(self):
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,134 @@
+# coding: utf-8
+import logging
+import mimetypes
+import os
+import threading
+from typing import IO, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Bytes handed to libmagic when no signature matches, enough for the formats it knows
+MAGIC_BYTES = 64 * 1024
+
+# (offset, signature, MIME type, extension) of the common media, checked in order
+SIGNATURES = (
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png', '.png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg', '.jpg'),
+    (0, b'GIF87a', 'image/gif', '.gif'),
+    (0, b'GIF89a', 'image/gif', '.gif'),
+    (0, b'BM', 'image/bmp', '.bmp'),
+    (0, b'II*\x00', 'image/tiff', '.tiff'),
+    (0, b'MM\x00*', 'image/tiff', '.tiff'),
+    (0, b'\x00\x00\x01\x00', 'image/vnd.microsoft.icon', '.ico'),
+    (0, b'#!SILK_V3', 'audio/silk', '.silk'),
+    (1, b'#!SILK_V3', 'audio/silk', '.silk'),  # Voices of QQ have a leading 0x02
+    (0, b'#!AMR', 'audio/amr', '.amr'),
+    (0, b'OggS', 'audio/ogg', '.ogg'),
+    (0, b'fLaC', 'audio/flac', '.flac'),
+    (0, b'ID3', 'audio/mpeg', '.mp3'),
+    (0, b'\xff\xfb', 'audio/mpeg', '.mp3'),
+    (0, b'\xff\xf3', 'audio/mpeg', '.mp3'),
+    (0, b'\xff\xf2', 'audio/mpeg', '.mp3'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm', '.webm'),
+    (0, b'FLV', 'video/x-flv', '.flv'),
+    (0, b'%PDF-', 'application/pdf', '.pdf'),
+)
+
+# Form type of RIFF containers, at offset 8
+RIFF_TYPES = {
+    b'WEBP': ('image/webp', '.webp'),
+    b'WAVE': ('audio/x-wav', '.wav'),
+    b'AVI ': ('video/x-msvideo', '.avi'),
+}
+
+# Major brand of ISO base media files (ftyp box at offset 4), other brands are MP4
+FTYP_BRANDS = {
+    b'qt  ': ('video/quicktime', '.mov'),
+    b'M4A ': ('audio/mp4', '.m4a'),
+    b'heic': ('image/heic', '.heic'),
+    b'heix': ('image/heic', '.heic'),
+    b'mif1': ('image/heif', '.heif'),
+    b'avif': ('image/avif', '.avif'),
+    b'3gp4': ('video/3gpp', '.3gp'),
+    b'3gp5': ('video/3gpp', '.3gp'),
+}
+
+_magic = None
+_magic_lock = threading.Lock()
+
+
+def sniff(head: bytes) -> Optional[Tuple[str, str]]:
+    """
+    Identify the common image, audio and video formats from the leading bytes of a file
+
+    :param head: The first bytes of the file, 16 are enough
+    :return: The MIME type and the extension with its dot, None when no signature matches
+    """
+    head = bytes(head[:16])
+    if head[:4] == b'RIFF':
+        return RIFF_TYPES.get(head[8:12])
+    if head[4:8] == b'ftyp':
+        return FTYP_BRANDS.get(head[8:12], ('video/mp4', '.mp4'))
+    for offset, signature, mime, extension in SIGNATURES:
+        if head.startswith(signature, offset):
+            return mime, extension
+    return None
+
+
+def _libmagic():
+    """
+    The libmagic handle, opened once as loading its database is the costly part
+    """
+    global _magic
+    with _magic_lock:
+        if _magic is None:
+            import magic
+
+            _magic = magic.Magic(mime=True)
+        return _magic
+
+
+def extension_of(mime: str) -> str:
+    return mimetypes.guess_extension(mime) or '.' + mime.split('/')[-1]
+
+
+def read_head(file: IO, size: int) -> bytes:
+    """
+    Read the first bytes of a file without moving its position
+    """
+    if hasattr(file, 'pread'):  # A media buffer, maybe in memory
+        return file.pread(size, 0)
+    try:
+        return os.pread(file.fileno(), size, 0)
+    except (AttributeError, OSError, ValueError):
+        position = file.tell()
+        try:
+            file.seek(0)
+            return file.read(size)
+        finally:
+            file.seek(position)
+
+
+def detect(file: IO) -> Tuple[str, str]:
+    """
+    Detect the MIME type of a file from its content
+
+    The leading bytes are matched against the signatures of the common media first,
+    libmagic only looks at the formats left. Files downloaded by the Downloader carry
+    their leading bytes as file.head, others are read back.
+
+    :param file: The file handle
+    :return: The MIME type and the extension with its dot
+    """
+    head = getattr(file, 'head', None)
+    if head is None:
+        head = read_head(file, MAGIC_BYTES)
+    result = sniff(head)
+    if result:
+        return result
+    if len(head) < MAGIC_BYTES:
+        head = read_head(file, MAGIC_BYTES)  # Maybe only the first chunk of a larger file
+    mime = _libmagic().from_buffer(head)
+    if isinstance(mime, bytes):
+        mime = mime.decode()
+    return mime, extension_of(mime)
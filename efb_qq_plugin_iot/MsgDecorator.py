@@ -1,10 +1,63 @@
+import hashlib
+import uuid
 from typing import Mapping, Tuple, Union, IO
 
-import magic
 from ehforwarderbot import MsgType, Chat
 from ehforwarderbot.chat import ChatMember
 from ehforwarderbot.message import Substitutions, Message
 
+from efb_qq_plugin_iot import MimeSniffer
+from efb_qq_plugin_iot.IOTFactory import IOTFactory
+
+
+def detect_mime(file: IO) -> Tuple[str, str]:
+    """
+    Detect the MIME type of a file from its content
+
+    :param file: The file handle
+    :return: The MIME type and the extension with its dot
+    """
+    with IOTFactory.metrics.time('mime'):
+        return MimeSniffer.detect(file)
+
+
+def default_filename(file: IO, extension: str) -> str:
+    """
+    Name of a media whose actual file name is unknown, without spilling an in-memory buffer to get a path
+
+    :param file: The file handle, media buffers carry the md5 from the payload or the url downloaded
+    :param extension: The detected extension with its dot
+    """
+    if not getattr(file, 'in_memory', False):
+        return file.name + extension
+    md5 = getattr(file, 'md5', None)
+    url = getattr(file, 'url', None)
+    if md5:
+        return md5.lower() + extension
+    if url:
+        return hashlib.md5(url.encode()).hexdigest() + extension
+    return uuid.uuid4().hex + extension
+
+
+def efb_media_wrapper(msg_type: MsgType, file: IO, filename: str = None, text: str = None) -> Message:
+    """
+    A EFB message wrapper for media.
+    Media buffers still in memory are delivered without a path, which would spill them to disk.
+
+    :param msg_type: The type of the message
+    :param file: The file handle
+    :param filename: The actual filename
+    :param text: The attached text
+    :return: EFB Message
+    """
+    mime, extension = detect_mime(file)
+    efb_msg = Message(type=msg_type, file=file, mime=mime, filename=filename or default_filename(file, extension))
+    if not getattr(file, 'in_memory', False):
+        efb_msg.path = file.name
+    if text:
+        efb_msg.text = text
+    return efb_msg
+
 
 def efb_text_simple_wrapper(text: str, ats: Union[Mapping[Tuple[int, int], Union[Chat, ChatMember]], None] = None) -> Message:
     """
@@ -40,35 +93,16 @@ def efb_unsupported_wrapper(text: str) -> Message:
 
 def efb_image_wrapper(file: IO, filename: str = None, text: str = None) -> Message:
     """
-    A EFB message wrapper for images.
+    A EFB message wrapper for images, GIFs are sent as animations.
 
     :param file: The file handle
     :param filename: The actual filename
     :param text: The attached text
     :return: EFB Message
     """
-    efb_msg = Message()
-    efb_msg.file = file
-    mime = magic.from_file(file.name, mime=True)
-    if isinstance(mime, bytes):
-        mime = mime.decode()
-
-    if "gif" in mime:
+    efb_msg = efb_media_wrapper(MsgType.Image, file, filename, text)
+    if "gif" in efb_msg.mime:
         efb_msg.type = MsgType.Animation
-    else:
-        efb_msg.type = MsgType.Image
-
-    if filename:
-        efb_msg.filename = filename
-    else:
-        efb_msg.filename = file.name
-        efb_msg.filename += '.' + str(mime).split('/')[1]  # Add extension suffix
-
-    if text:
-        efb_msg.text = text
-
-    efb_msg.path = efb_msg.file.name
-    efb_msg.mime = mime
     return efb_msg
 
 
@@ -81,57 +115,12 @@ def efb_voice_wrapper(file: IO, filename: str = None, text: str = None) -> Messa
     :param text: The attached text
     :return: EFB Message
     """
-    efb_msg = Message()
-    efb_msg.type = MsgType.Audio
-    efb_msg.file = file
-    mime = magic.from_file(efb_msg.file.name, mime=True)
-    if isinstance(mime, bytes):
-        mime = mime.decode()
-    if filename:
-        efb_msg.filename = filename
-    else:
-        efb_msg.filename = file.name
-        efb_msg.filename += '.' + str(mime).split('/')[1]  # Add extension suffix
-    efb_msg.path = efb_msg.file.name
-    efb_msg.mime = mime
-    if text:
-        efb_msg.text = text
-    return efb_msg
+    return efb_media_wrapper(MsgType.Audio, file, filename, text)
 
 
 def efb_video_wrapper(file: IO, filename: str = None, text: str = None) -> Message:
-    efb_msg = Message()
-    efb_msg.type = MsgType.Video
-    efb_msg.file = file
-    mime = magic.from_file(efb_msg.file.name, mime=True)
-    if isinstance(mime, bytes):
-        mime = mime.decode()
-    if filename:
-        efb_msg.filename = filename
-    else:
-        efb_msg.filename = file.name
-        efb_msg.filename += '.' + str(mime).split('/')[1]  # Add extension suffix
-    efb_msg.path = efb_msg.file.name
-    efb_msg.mime = mime
-    if text:
-        efb_msg.text = text
-    return efb_msg
+    return efb_media_wrapper(MsgType.Video, file, filename, text)
 
 
 def efb_file_wrapper(file: IO, filename: str = None, text: str = None) -> Message:
-    efb_msg = Message()
-    efb_msg.type = MsgType.File
-    efb_msg.file = file
-    mime = magic.from_file(efb_msg.file.name, mime=True)
-    if isinstance(mime, bytes):
-        mime = mime.decode()
-    if filename:
-        efb_msg.filename = filename
-    else:
-        efb_msg.filename = file.name
-        efb_msg.filename += '.' + str(mime).split('/')[1]  # Add extension suffix
-    efb_msg.path = efb_msg.file.name
-    efb_msg.mime = mime
-    if text:
-        efb_msg.text = text
-    return efb_msg
\ No newline at end of file
+    return efb_media_wrapper(MsgType.File, file, filename, text)
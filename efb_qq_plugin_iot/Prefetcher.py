@@ -0,0 +1,88 @@
+# coding: utf-8
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, IO, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchResult:
+    """
+    Outcome of fetching a single item of a multi-item message
+    """
+
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.url = url
+        self.file: Optional[IO] = None
+        self.error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.file is not None and self.error is None
+
+    def __repr__(self):
+        status = "ok" if self.ok else f"failed ({self.error})"
+        return f"<PrefetchResult #{self.index} {status}>"
+
+
+class Prefetcher:
+    """
+    Fetch all media items of one message concurrently, keeping their original order.
+
+    Concurrency is bounded twice: the shared executor caps the number of downloads
+    running across all messages, and each call to ``fetch_all`` keeps at most
+    ``per_message`` of its own downloads in flight so a single 9-picture post
+    cannot occupy the whole pool.
+    """
+
+    def __init__(self, per_message: int = 4, global_limit: int = 16):
+        """
+        :param per_message: Max concurrent downloads for one message
+        :param global_limit: Max concurrent downloads across all messages
+        """
+        self.per_message = max(1, int(per_message))
+        self.global_limit = max(1, int(global_limit))
+        self.executor = ThreadPoolExecutor(max_workers=self.global_limit,
+                                           thread_name_prefix="iot_prefetch")
+
+    def fetch_all(self, urls: Sequence[str],
+                  fetch: Callable[[str], IO]) -> List[PrefetchResult]:
+        """
+        Fetch every URL and return one result per URL, in the order given.
+        Failures never raise, check ``PrefetchResult.ok`` instead.
+
+        :param urls: URLs to be fetched
+        :param fetch: The function used to fetch a single URL
+        :return: Results in the same order as urls
+        """
+        results = [PrefetchResult(index, url) for index, url in enumerate(urls)]
+        if len(results) <= 1:  # Nothing to parallelize, skip the thread hop
+            for result in results:
+                self._fetch(result, fetch)
+        else:
+            slots = threading.BoundedSemaphore(self.per_message)
+            futures = []
+            for result in results:
+                slots.acquire()
+                future = self.executor.submit(self._fetch, result, fetch)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+            wait(futures)
+        failed = [result for result in results if not result.ok]
+        if failed:
+            logger.warning("Prefetched %d/%d item(s), failed: %s",
+                           len(results) - len(failed), len(results), failed)
+        return results
+
+    @staticmethod
+    def _fetch(result: PrefetchResult, fetch: Callable[[str], IO]):
+        try:
+            result.file = fetch(result.url)
+        except Exception as e:
+            logger.warning(f"Failed to download {result.url}! {e}")
+            result.error = e
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
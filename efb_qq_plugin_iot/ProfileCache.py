@@ -0,0 +1,142 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional
+
+from cachetools import LRUCache, TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileCache:
+    """
+    User profiles (nickname etc.) of strangers, looked up by uin.
+
+    Concurrent lookups of the same uin share a single request to OPQBot,
+    failed lookups are remembered for ``negative_ttl`` so they are not repeated
+    on every message, and profiles of senders seen again are refreshed ahead
+    of their expiry in the background.
+    """
+
+    def __init__(self, fetch: Callable[[int], Optional[Dict]], max_size: int = 5000, ttl: int = 3600,
+                 negative_ttl: int = 60, prefetch_workers: int = 2, refresh_ahead: float = 0.8):
+        """
+        :param fetch: Function returning the profile of a uin, None if it failed
+        :param max_size: Max number of profiles kept, should cover the members of the active groups
+        :param ttl: Seconds a profile is kept
+        :param negative_ttl: Seconds a failed lookup is remembered
+        :param prefetch_workers: Max number of concurrent background lookups
+        :param refresh_ahead: Fraction of ttl after which a profile seen again is refreshed in the background
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.profiles: TTLCache = TTLCache(maxsize=max_size, ttl=ttl)
+        self.failures: TTLCache = TTLCache(maxsize=max_size, ttl=negative_ttl)
+        self.fetched_at: LRUCache = LRUCache(maxsize=max_size)
+        self.in_flight: Dict[int, Future] = {}
+        self.tasks: Dict[int, Future] = {}  # Background lookups, by uin
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(prefetch_workers)),
+                                           thread_name_prefix="iot_profile")
+        self.counters = {
+            'hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'fetches': 0,
+            'failures': 0,
+            'prefetches': 0,
+        }
+
+    def get(self, uin: int) -> Optional[Dict]:
+        """
+        Get the profile of a uin, waiting for the lookup only when nothing is cached
+
+        :return: The profile, None if the lookup failed
+        """
+        uin = int(uin)
+        with self.lock:
+            profile = self.profiles.get(uin)
+            if profile is not None:
+                self.counters['hits'] += 1
+                if uin not in self.failures and \
+                        time.monotonic() - self.fetched_at.get(uin, 0) >= self.ttl * self.refresh_ahead:
+                    self._submit(uin)
+                return profile
+            if uin in self.failures:
+                self.counters['negative_hits'] += 1
+                return None
+            self.counters['misses'] += 1
+            future = self.in_flight.get(uin)
+            if future is None:
+                future = self.in_flight[uin] = Future()
+                owner = True
+            else:
+                # A background lookup still queued behind other prefetches is done here instead of waited for
+                task = self.tasks.get(uin)
+                owner = task is not None and task.cancel()
+                if owner:
+                    del self.tasks[uin]
+                else:
+                    self.counters['coalesced'] += 1
+        if owner:
+            self._load(uin, future)
+        return future.result()
+
+    def prefetch(self, uins: Iterable[int]):
+        """
+        Look up the profiles not cached yet in the background, ``prefetch_workers`` at a time
+        """
+        with self.lock:
+            for uin in uins:
+                uin = int(uin)
+                if uin not in self.profiles and uin not in self.failures:
+                    self._submit(uin)
+
+    def _submit(self, uin: int):
+        """
+        Schedule a background lookup, the caller must hold self.lock
+        """
+        if uin in self.in_flight:
+            return
+        future = self.in_flight[uin] = Future()
+        self.counters['prefetches'] += 1
+        try:
+            self.tasks[uin] = self.executor.submit(self._load, uin, future)
+        except RuntimeError:  # Shut down
+            del self.in_flight[uin]
+            future.set_result(None)
+
+    def _load(self, uin: int, future: Future):
+        profile = None
+        try:
+            profile = self.fetch(uin)
+        except Exception as e:
+            logger.warning(f"Failed to get the profile of {uin}! {e}")
+        with self.lock:
+            self.counters['fetches'] += 1
+            if profile is not None:
+                self.profiles[uin] = profile
+                self.fetched_at[uin] = time.monotonic()
+                self.failures.pop(uin, None)
+            else:
+                self.failures[uin] = True
+                self.counters['failures'] += 1
+                profile = self.profiles.get(uin)  # A failed refresh keeps the profile we have
+            del self.in_flight[uin]
+            self.tasks.pop(uin, None)
+        future.set_result(profile)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['profiles'] = len(self.profiles)
+            stats['negative'] = len(self.failures)
+            stats['in_flight'] = len(self.in_flight)
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,257 @@
+# coding: utf-8
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_TEXT = 0
+PRIORITY_MEDIA = 1
+
+# Ret codes of OPQBot for sending too fast to a chat / to groups
+THROTTLED_RETS = (241, 299)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        """
+        :param rate: Tokens added per second
+        :param burst: Max number of tokens
+        """
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def _fill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def ready_at(self, now: float) -> float:
+        """
+        When the next token is available
+        """
+        self._fill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._fill(now)
+        self.tokens -= 1
+
+    def drain(self, now: float):
+        self._fill(now)
+        self.tokens = min(self.tokens, 0)
+
+
+class SendJob:
+    def __init__(self, target: Hashable, func: Callable[[], Dict], priority: int, seq: int):
+        self.target = target
+        self.func = func
+        self.priority = priority
+        self.seq = seq
+        self.future: 'Future[Dict]' = Future()
+        self.queued_at = time.monotonic()
+        self.not_before = 0.0
+        self.attempts = 0
+
+
+class SendScheduler:
+    """
+    Sends outbound messages to OPQBot from a single thread, within token bucket
+    limits both per target chat and globally.
+
+    Messages of a chat are sent in the order they were queued, while text jumps
+    ahead of media queued for other chats. Sends rejected by OPQBot for
+    being too frequent are retried with an exponential backoff.
+    """
+
+    def __init__(self, rate: float = 5, burst: float = 10, target_rate: float = 0.9, target_burst: float = 2,
+                 max_queue: int = 200, queue_timeout: float = 60, retries: int = 3, retry_delay: float = 1.1):
+        """
+        :param rate: Messages per second sent in total
+        :param burst: Messages sent in a row in total before rate applies
+        :param target_rate: Messages per second sent to a single chat
+        :param target_burst: Messages sent in a row to a single chat before target_rate applies
+        :param max_queue: Max number of messages waiting, submitting more blocks the caller
+        :param queue_timeout: Seconds a caller waits for room in the queue before the message is rejected
+        :param retries: Max number of retries of a throttled message
+        :param retry_delay: Seconds before the first retry, doubled on each one
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self.target_buckets: Dict[Hashable, TokenBucket] = {}
+        self.queues: Dict[Hashable, Deque[SendJob]] = {}
+        self.slots = threading.BoundedSemaphore(max(1, int(max_queue)))
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+        self.running = True
+        self.sending: Optional[SendJob] = None  # The job in flight, resolved by the sender thread only
+        self.thread: Optional[threading.Thread] = None
+        self.metrics = {
+            'queued': 0,
+            'sent': 0,
+            'failed': 0,
+            'rejected': 0,
+            'throttled': 0,
+            'retries': 0,
+            'last_latency': 0.0,
+            'max_latency': 0.0,
+            'total_latency': 0.0,
+        }
+
+    def submit(self, target: Hashable, func: Callable[[], Dict], priority: int = PRIORITY_MEDIA) -> 'Future[Dict]':
+        """
+        Queue a send to a chat
+
+        :param target: The chat the message is sent to
+        :param func: Sends the message, returning the response of OPQBot
+        :param priority: PRIORITY_TEXT or PRIORITY_MEDIA
+        :return: A future resolved with the response of OPQBot once sent
+        """
+        job = SendJob(target, func, priority, next(self.order))
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            with self.cond:
+                self.metrics['rejected'] += 1
+            logger.warning(f"Send queue is full, dropping a message to {target}.")
+            job.future.set_exception(RuntimeError("Send queue is full"))
+            return job.future
+        with self.cond:
+            if not self.running:
+                self.slots.release()
+                job.future.set_exception(RuntimeError("Send scheduler is shut down"))
+                return job.future
+            self.queues.setdefault(target, deque()).append(job)
+            self.metrics['queued'] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="iot_sender", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return job.future
+
+    def _target_bucket(self, target: Hashable) -> TokenBucket:
+        bucket = self.target_buckets.get(target)
+        if bucket is None:
+            bucket = self.target_buckets[target] = TokenBucket(self.target_rate, self.target_burst)
+        return bucket
+
+    def _next_job(self) -> Optional[SendJob]:
+        """
+        Wait for the next job allowed to be sent, None once shut down.
+        The caller must hold self.cond.
+        """
+        while self.running:
+            now = time.monotonic()
+            best: Optional[SendJob] = None
+            wake_at = None
+            for target, queue in self.queues.items():
+                job = queue[0]
+                ready_at = max(job.not_before, self._target_bucket(target).ready_at(now))
+                if ready_at > now:
+                    wake_at = ready_at if wake_at is None else min(wake_at, ready_at)
+                elif best is None or (job.priority, job.seq) < (best.priority, best.seq):
+                    best = job
+            if best is not None:
+                global_ready_at = self.bucket.ready_at(now)
+                if global_ready_at <= now:
+                    return best
+                wake_at = global_ready_at if wake_at is None else min(wake_at, global_ready_at)
+            self.cond.wait(None if wake_at is None else wake_at - now)
+        return None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                job = self._next_job()
+                if job is None:
+                    return
+                # Marked running before the first attempt, a send in flight or waiting for a retry can no longer
+                # be cancelled, so callers are never told a message failed while it may still go out
+                cancelled = not job.future.running() and not job.future.set_running_or_notify_cancel()
+                if not cancelled:
+                    now = time.monotonic()
+                    self.bucket.take(now)
+                    self._target_bucket(job.target).take(now)
+                    self.sending = job
+            if cancelled:  # Given up by the caller while queued, e.g. on a timeout
+                self._finish(job, exception=CancelledError())
+                continue
+            try:
+                response = job.func() or {}
+            except Exception as e:
+                logger.warning(f"Failed to send a message to {job.target}! {e}")
+                self._finish(job, exception=e)
+                continue
+            if response.get('Ret') in THROTTLED_RETS:
+                with self.cond:
+                    self.metrics['throttled'] += 1
+                    retry = job.attempts < self.retries and self.running
+                    if retry:
+                        job.attempts += 1
+                        job.not_before = time.monotonic() + self.retry_delay * 2 ** (job.attempts - 1)
+                        self._target_bucket(job.target).drain(time.monotonic())
+                        self.metrics['retries'] += 1
+                        self.sending = None
+                if retry:
+                    logger.info(f"Throttled while sending to {job.target}, retry #{job.attempts} "
+                                f"in {job.not_before - time.monotonic():.1f}s.")
+                    continue  # The job stays at the head of its queue
+            self._finish(job, response=response)
+
+    def _finish(self, job: SendJob, response: Dict = None, exception: Exception = None):
+        with self.cond:
+            if self.sending is job:
+                self.sending = None
+            queue = self.queues.get(job.target)
+            if queue and queue[0] is job:
+                queue.popleft()
+                if not queue:
+                    del self.queues[job.target]
+            latency = time.monotonic() - job.queued_at
+            self.metrics['sent' if exception is None else 'failed'] += 1
+            self.metrics['last_latency'] = latency
+            self.metrics['max_latency'] = max(self.metrics['max_latency'], latency)
+            self.metrics['total_latency'] += latency
+            if len(self.target_buckets) > 1000:  # Forget the chats whose bucket is full again
+                now = time.monotonic()
+                self.target_buckets = {target: bucket for target, bucket in self.target_buckets.items()
+                                       if target in self.queues or bucket.ready_at(now) > now or
+                                       bucket.tokens < bucket.burst}
+        self.slots.release()
+        if job.future.cancelled():  # Skipped, a running future can not be cancelled or failed by shutdown
+            return
+        if exception is None:
+            job.future.set_result(response)
+        else:
+            job.future.set_exception(exception)
+
+    def stats(self) -> Dict:
+        with self.cond:
+            stats = dict(self.metrics)
+            stats['pending'] = sum(len(queue) for queue in self.queues.values())
+            stats['targets'] = len(self.queues)
+            done = stats['sent'] + stats['failed']
+            stats['mean_latency'] = stats['total_latency'] / done if done else 0.0
+        return stats
+
+    def shutdown(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+            # The job in flight is left to the sender thread, which resolves it once sent
+            jobs = [job for queue in self.queues.values() for job in queue if job is not self.sending]
+            self.queues.clear()
+        for job in jobs:
+            self.slots.release()
+            # Cancelled jobs are already resolved, jobs waiting for a retry are already running
+            if job.future.running() or job.future.set_running_or_notify_cancel():
+                job.future.set_exception(RuntimeError("Send scheduler is shut down"))
@@ -0,0 +1,167 @@
+# coding: utf-8
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Union
+
+from efb_qq_plugin_iot.FriendIndex import FriendIndex
+from efb_qq_plugin_iot.GroupIndex import GroupIndex
+from efb_qq_plugin_iot.MemberStore import MemberStore
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class Snapshot:
+    """
+    Local copy of the friend, group and member indexes, so that after a restart the
+    first messages and the initial chat sync are served at once instead of waiting
+    for the lists to be fetched from OPQBot.
+
+    The snapshot is loaded on startup and reconciled with OPQBot in the background,
+    then saved at intervals and on shutdown.
+    """
+
+    def __init__(self, path: Union[str, Path], uin: int, friend_index: FriendIndex, group_index: GroupIndex,
+                 member_store: MemberStore, interval: float = 300, max_age: float = 30 * 86400):
+        """
+        :param path: The gzip compressed JSON file the snapshot is saved to
+        :param uin: The QQ account, snapshots of other accounts are ignored
+        :param interval: Seconds between two saves
+        :param max_age: Snapshots older than this many seconds are ignored
+        """
+        self.path = Path(path)
+        self.uin = int(uin)
+        self.friend_index = friend_index
+        self.group_index = group_index
+        self.member_store = member_store
+        self.interval = interval
+        self.max_age = max_age
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.metrics = {
+            'loaded': 0,
+            'load_duration': 0.0,
+            'age': 0.0,
+            'saves': 0,
+            'save_failures': 0,
+            'save_duration': 0.0,
+            'size': 0,
+            'reconcile_duration': 0.0,
+        }
+
+    def load(self) -> bool:
+        """
+        Restore the indexes from the snapshot
+
+        :return: Whether a usable snapshot was found
+        """
+        start = time.monotonic()
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, EOFError, ValueError) as e:
+            logger.warning(f"Failed to load the snapshot, starting without it. {e}")
+            return False
+        if snapshot.get('version') != VERSION or snapshot.get('uin') != self.uin:
+            logger.info("Ignoring a snapshot of another version or account.")
+            return False
+        age = time.time() - snapshot.get('saved_at', 0)
+        if age > self.max_age:
+            logger.info(f"Ignoring a snapshot saved {age:.0f}s ago.")
+            return False
+        self.friend_index.restore(snapshot.get('friends'))
+        self.group_index.restore(snapshot.get('groups'))
+        self.member_store.restore(snapshot.get('members', []))
+        duration = time.monotonic() - start
+        with self.lock:
+            self.metrics['loaded'] = 1
+            self.metrics['load_duration'] = duration
+            self.metrics['age'] = age
+        logger.info(f"Loaded the snapshot saved {age:.0f}s ago in {duration * 1000:.1f}ms.")
+        return True
+
+    def reconcile(self, member_groups: int = 20):
+        """
+        Bring the indexes up to date with OPQBot, meant to run in the background right after load
+
+        :param member_groups: Number of the most recently used groups whose members are synced again,
+                              the others are synced on demand
+        """
+        start = time.monotonic()
+        self.friend_index.refresh()
+        self.group_index.refresh()
+        for group_id in self.member_store.recent(member_groups):
+            if self.stopped.is_set():
+                return
+            if self.group_index.get(group_id) is None and self.group_index.loaded:
+                self.member_store.invalidate(group_id)  # Left while offline
+                continue
+            self.member_store.get_members(group_id, no_cache=True)
+        with self.lock:
+            self.metrics['reconcile_duration'] = time.monotonic() - start
+
+    def save(self):
+        friends = self.friend_index.dump()
+        groups = self.group_index.dump()
+        if friends is None and groups is None:
+            return  # Nothing loaded yet, keep the previous snapshot
+        start = time.monotonic()
+        snapshot = {
+            'version': VERSION,
+            'uin': self.uin,
+            'saved_at': time.time(),
+            'friends': friends,
+            'groups': groups,
+            'members': self.member_store.dump(),
+        }
+        tmp_name = None
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.path.parent, prefix='.', delete=False) as tmp:
+                tmp_name = tmp.name
+                with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+                    json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_name, self.path)
+            tmp_name = None
+        except OSError as e:
+            logger.warning(f"Failed to save the snapshot. {e}")
+            with self.lock:
+                self.metrics['save_failures'] += 1
+            return
+        finally:
+            if tmp_name is not None:  # Not renamed, e.g. the disk is full
+                try:
+                    os.unlink(tmp_name)
+                except OSError:
+                    pass
+        with self.lock:
+            self.metrics['saves'] += 1
+            self.metrics['save_duration'] = time.monotonic() - start
+            self.metrics['size'] = os.path.getsize(self.path)
+
+    def save_periodically(self):
+        def run():
+            while not self.stopped.wait(self.interval):
+                self.save()
+
+        threading.Thread(target=run, name="iot_snapshot", daemon=True).start()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return dict(self.metrics)
+
+    def shutdown(self):
+        """
+        Stop the periodic saves and save one last time
+        """
+        self.stopped.set()
+        self.save()
@@ -0,0 +1,247 @@
+# coding: utf-8
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Any, Callable, Dict, IO, Iterable, Iterator, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+FIXTURE_SCHEME = 'fixture://'
+
+# Fields of the message contents holding a downloadable media
+MEDIA_URL_KEYS = ('Url', 'VoiceUrl', 'VideoUrl')
+
+KINDS = ('friend', 'group', 'event')
+
+
+def rewrite_media_urls(message: Dict, rewrite: Callable[[str], str]) -> Dict:
+    """
+    Copy of a raw OPQBot message whose media URLs are replaced by rewrite(url)
+
+    Media are referenced from the Content of the message, a JSON string
+    for pictures, voices, videos and files.
+    """
+    data = message.get('CurrentPacket', {}).get('Data', {})
+    content = data.get('Content')
+    if not isinstance(content, str) or not content.startswith('{'):
+        return message
+    try:
+        parsed = json.loads(content)
+    except ValueError:
+        return message
+
+    def walk(value):
+        if isinstance(value, dict):
+            return {k: rewrite(v) if k in MEDIA_URL_KEYS and isinstance(v, str) and v else walk(v)
+                    for k, v in value.items()}
+        if isinstance(value, list):
+            return [walk(v) for v in value]
+        return value
+
+    rewritten = walk(parsed)
+    if rewritten == parsed:
+        return message
+    message = dict(message)
+    message['CurrentPacket'] = dict(message['CurrentPacket'])
+    message['CurrentPacket']['Data'] = dict(data, Content=json.dumps(rewritten, ensure_ascii=False))
+    return message
+
+
+class TrafficRecorder:
+    """
+    Appends the raw payloads received from OPQBot to a gzip compressed JSON lines log,
+    to profile and load test with real traffic offline.
+
+    Records are written from a background thread so receiving is never slowed down
+    by the disk, they are dropped when the writer can not keep up. Each session
+    appends a new gzip member to the log and flushes it regularly, a crash loses
+    at most the last flush interval.
+
+    When a fixtures directory is given, the media are downloaded in the
+    background as well and their URLs rewritten to ``fixture://<name>``,
+    as the URLs of the QQ CDN expire.
+    """
+
+    def __init__(self, path: str, fixtures_dir: Optional[str] = None,
+                 fetch: Optional[Callable[[str], IO[bytes]]] = None,
+                 max_pending: int = 1000, flush_interval: float = 1):
+        """
+        :param path: The log file, appended to
+        :param fixtures_dir: Where media are saved, None to keep the original URLs
+        :param fetch: Downloads a media to a file object, required for fixtures
+        :param max_pending: Max number of records waiting to be written
+        :param flush_interval: Seconds between flushes of the log
+        """
+        self.path = str(path)
+        self.fixtures_dir = str(fixtures_dir) if fixtures_dir and fetch else None
+        self.fetch = fetch
+        self.flush_interval = flush_interval
+        self.queue: 'queue.Queue[Optional[Dict]]' = queue.Queue(max(1, int(max_pending)))
+        self.counters = {
+            'recorded': 0,
+            'dropped': 0,
+            'fixtures': 0,
+            'fixture_failures': 0,
+        }
+        self.lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        if self.fixtures_dir:
+            os.makedirs(self.fixtures_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name="iot_traffic_recorder", daemon=True)
+        self.thread.start()
+
+    def record(self, kind: str, message: Dict):
+        """
+        Queue a raw payload for the log
+
+        :param kind: friend, group or event
+        :param message: The payload as received, i.e. ``ctx.message``
+        """
+        try:
+            self.queue.put_nowait({'t': time.time(), 'kind': kind, 'message': message})
+        except queue.Full:
+            with self.lock:
+                self.counters['dropped'] += 1
+
+    def _fixture(self, url: str) -> str:
+        if url.startswith(FIXTURE_SCHEME) or not url.startswith(('http://', 'https://')):
+            return url
+        parsed = urlparse(url)
+        # The signature in the query changes between downloads of the same media
+        name = hashlib.sha1(f"{parsed.netloc}{parsed.path}".encode()).hexdigest()
+        path = os.path.join(self.fixtures_dir, name)
+        if not os.path.exists(path):
+            try:
+                file = self.fetch(url)
+                try:
+                    file.seek(0)
+                    with open(path + '.part', 'wb') as f:
+                        shutil.copyfileobj(file, f)
+                    os.replace(path + '.part', path)
+                finally:
+                    file.close()
+            except Exception as e:
+                logger.warning(f"Failed to save the fixture of {url}! {e}")
+                with self.lock:
+                    self.counters['fixture_failures'] += 1
+                return url
+            with self.lock:
+                self.counters['fixtures'] += 1
+        return FIXTURE_SCHEME + name
+
+    def _run(self):
+        try:
+            log = gzip.open(self.path, 'at', encoding='utf-8')
+        except OSError as e:
+            logger.error(f"Failed to open the traffic log {self.path}! {e}")
+            return
+        flushed_at = time.monotonic()
+        with log:
+            while True:
+                try:
+                    record = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    record = {}
+                if record is None:
+                    break
+                if record:
+                    if self.fixtures_dir:
+                        record['message'] = rewrite_media_urls(record['message'], self._fixture)
+                    log.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    with self.lock:
+                        self.counters['recorded'] += 1
+                if time.monotonic() - flushed_at >= self.flush_interval:
+                    log.flush()
+                    flushed_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.counters)
+        stats['pending'] = self.queue.qsize()
+        return stats
+
+    def close(self):
+        """
+        Write what is left and close the log
+        """
+        self.queue.put(None)
+        self.thread.join(timeout=30)
+
+
+def read_traffic(path: str) -> Iterator[Dict]:
+    """
+    Records of a traffic log in order, a log cut short by a crash is read up to the last complete record
+    """
+    with gzip.open(str(path), 'rt', encoding='utf-8') as log:
+        try:
+            for line in log:
+                if not line.endswith('\n'):
+                    break
+                yield json.loads(line)
+        except (EOFError, OSError) as e:  # gzip.BadGzipFile is an OSError, and only exists since Python 3.8
+            logger.warning(f"Traffic log {path} is truncated, stopped reading. {e}")
+
+
+class TrafficReplayer:
+    """
+    Feeds recorded traffic back through the handlers, keeping the
+    original pacing scaled by speed, or as fast as possible.
+    """
+
+    def __init__(self, handlers: Dict[str, Callable[[Dict], Any]], speed: float = 1.0,
+                 fixture_url: Optional[str] = None, qq: Optional[int] = None):
+        """
+        :param handlers: Entry point of each kind of record, e.g. ``{'friend': bot.friend_msg_handler}``
+        :param speed: 1 for the original pace, 10 for 10 times faster, 0 for as fast as possible
+        :param fixture_url: Base URL fixture:// media are served from
+        :param qq: Replay as received by this account instead of the recorded one
+        """
+        self.handlers = handlers
+        self.speed = speed
+        self.fixture_url = fixture_url.rstrip('/') + '/' if fixture_url else None
+        self.qq = qq
+
+    def _prepare(self, message: Dict) -> Dict:
+        if self.fixture_url:
+            message = rewrite_media_urls(message, lambda url: self.fixture_url + url[len(FIXTURE_SCHEME):]
+                                         if url.startswith(FIXTURE_SCHEME) else url)
+        if self.qq is not None:
+            message = dict(message, CurrentQQ=self.qq)
+        return message
+
+    def replay(self, records: Iterable[Dict], on_record: Optional[Callable[[Dict], None]] = None) -> int:
+        """
+        :param records: Records of a traffic log, see read_traffic
+        :param on_record: Called with each record right before it is fed
+        :return: Number of records fed
+        """
+        count = 0
+        first_at = None
+        start = time.monotonic()
+        for record in records:
+            handler = self.handlers.get(record.get('kind'))
+            if handler is None:
+                continue
+            if self.speed:
+                if first_at is None:
+                    first_at = record['t']
+                delay = start + (record['t'] - first_at) / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            message = self._prepare(record['message'])
+            if on_record:
+                on_record(record)
+            try:
+                handler(message)
+            except Exception as e:
+                logger.warning(f"Failed to replay a {record.get('kind')} record! {e}")
+            count += 1
+        return count
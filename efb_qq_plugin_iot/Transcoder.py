@@ -0,0 +1,283 @@
+# coding: utf-8
+import functools
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import IO, Any, Callable, List, Optional
+
+from ehforwarderbot import Message
+
+logger = logging.getLogger(__name__)
+
+
+IN_MEMORY_SUPPORTED = hasattr(os, 'memfd_create') and os.path.isdir('/proc/self/fd')
+
+SILK_SAMPLE_RATE = 24000
+
+
+@functools.lru_cache(maxsize=None)
+def voice_supported() -> bool:
+    """
+    Whether the Silk v3 codec is installed, found without importing it until a voice is transcoded
+    """
+    return importlib.util.find_spec('Silkv3') is not None
+
+
+def memory_file(name: str) -> IO:
+    """
+    Create an anonymous in-memory file.
+    Unlike pipes it can be opened again by path, which the file based Silk codec requires.
+
+    :param name: Name of the file, for debugging only
+    :return: File object, use memory_file_path to get a path of it
+    """
+    return open(os.memfd_create(name), 'w+b')
+
+
+def memory_file_path(file: IO, pid: Optional[int] = None) -> str:
+    """
+    :param pid: The process owning the file when the path is opened by another one, e.g. a transcoding worker
+    """
+    return f"/proc/{pid or 'self'}/fd/{file.fileno()}"
+
+
+def memory_copy(file: IO, name: str) -> IO:
+    """
+    Copy a file into an anonymous in-memory file, so that content held in memory
+    gets a path without being spilled to disk.
+
+    :return: The copy positioned at the beginning, remember to close it!
+    """
+    copy = memory_file(name)
+    file.seek(0)
+    shutil.copyfileobj(file, copy)
+    file.seek(0)
+    copy.seek(0)
+    return copy
+
+
+def ffmpeg(args: List[str], stdin: Optional[IO] = None, stdout: Optional[IO] = None):
+    """
+    Run the converter configured for pydub, raise if it failed
+
+    :param args: Arguments passed to the converter
+    :param stdin: File used as the standard input of the converter, pipe:0 refers to it
+    :param stdout: File used as the standard output of the converter, pipe:1 refers to it
+    """
+    import pydub
+
+    process = subprocess.run([pydub.AudioSegment.converter, '-hide_banner', '-loglevel', 'error', '-y'] + args,
+                             stdin=stdin if stdin is not None else subprocess.DEVNULL,
+                             stdout=stdout if stdout is not None else subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError(f"Converter exited with {process.returncode}: {process.stderr.decode(errors='replace')}")
+
+
+def silk_to_opus(input_path: str, output_path: str, in_memory: bool = True) -> bool:
+    """
+    Transcode a Silk v3 voice into Ogg Opus. Runs in a worker process.
+
+    :param input_path: Path of the Silk v3 file
+    :param output_path: Path the Ogg Opus file is written to
+    :param in_memory: Keep the intermediate PCM in memory instead of a temporary file, when supported
+    :return: Whether the transcoding succeeded
+    """
+    import Silkv3
+
+    if in_memory and IN_MEMORY_SUPPORTED:
+        with memory_file('silk_pcm') as pcm_file:
+            if not Silkv3.decode(input_path, memory_file_path(pcm_file)):
+                return False
+            pcm_file.seek(0)
+            ffmpeg(['-f', 's16le', '-ar', str(SILK_SAMPLE_RATE), '-ac', '1', '-i', 'pipe:0',
+                    '-c:a', 'libopus', '-vbr', 'on', '-f', 'ogg', output_path], stdin=pcm_file)
+        return True
+
+    import pydub
+
+    with tempfile.NamedTemporaryFile() as pcm_file:
+        if not Silkv3.decode(input_path, pcm_file.name):
+            return False
+        pydub.AudioSegment.from_raw(file=pcm_file, sample_width=2, frame_rate=SILK_SAMPLE_RATE, channels=1) \
+            .export(output_path, format="ogg", codec="libopus",
+                    parameters=['-vbr', 'on'])
+    return True
+
+
+def audio_to_silk(file: IO, in_memory: bool = True) -> Optional[IO]:
+    """
+    Transcode any audio supported by the converter into Silk v3.
+
+    :param file: The source audio, must have a path (file.name) unless it is a media buffer kept in memory
+    :param in_memory: Keep the source, the intermediate PCM and the result in memory instead of temporary files,
+                      when supported
+    :return: The Silk v3 file positioned at the beginning, None on failure.
+             Remember to close the file once you are done with the file!
+    """
+    import Silkv3
+
+    if in_memory and IN_MEMORY_SUPPORTED:
+        # A media buffer still in memory is copied to an in-memory file instead of being spilled for a path
+        source = memory_copy(file, 'audio') if getattr(file, 'in_memory', False) else None
+        try:
+            with memory_file('silk_pcm') as pcm_file:
+                ffmpeg(['-i', memory_file_path(source, os.getpid()) if source else file.name,
+                        '-f', 's16le', '-ac', '1', '-ar', str(SILK_SAMPLE_RATE), 'pipe:1'], stdout=pcm_file)
+                output_file = memory_file('silk')
+                if not Silkv3.encode(memory_file_path(pcm_file), memory_file_path(output_file)):
+                    output_file.close()
+                    return None
+        finally:
+            if source:
+                source.close()
+        output_file.seek(0)
+        return output_file
+
+    import pydub
+
+    pydub.AudioSegment.from_file(file).export(file, format='s16le',
+                                              parameters=["-ac", "1", "-ar", str(SILK_SAMPLE_RATE)])
+    output_file = tempfile.NamedTemporaryFile()
+    if not Silkv3.encode(file.name, output_file.name):
+        output_file.close()
+        return None
+    return output_file
+
+
+class Transcoder:
+    """
+    Runs voice transcoding in a dedicated process pool so it never blocks the bot workers.
+
+    Jobs beyond ``max_pending`` are rejected right away and jobs exceeding
+    ``timeout`` are given up, in both cases the fallback message is delivered instead.
+    A job still running on timeout is hung, the pool is killed along with it and the
+    other jobs it was running fall back as well. The pool is only started when the first job arrives.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 16, timeout: float = 30):
+        """
+        :param workers: The number of worker processes
+        :param max_pending: Max number of jobs queued or running at the same time
+        :param timeout: Seconds to wait for a job before giving up
+        """
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max(1, int(max_pending)))
+        self.lock = threading.Lock()
+        self.executor: ProcessPoolExecutor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                # Forking a process full of threads is unsafe, start clean interpreters instead
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def _reset_executor(self, broken: ProcessPoolExecutor, terminate: bool = False):
+        """
+        Drop a broken pool, the next job starts a new one
+
+        :param terminate: Kill the worker processes, a running job cannot be cancelled otherwise
+        """
+        with self.lock:
+            if self.executor is broken:
+                logger.warning(f"Transcoding process pool is {'hung' if terminate else 'broken'}, "
+                               f"restarting it on the next job.")
+                self.executor = None
+        processes = list((broken._processes or {}).values()) if terminate else []
+        broken.shutdown(wait=False)
+        for process in processes:
+            process.terminate()
+
+    def transcode(self, func: Callable[..., bool], *args: Any,
+                  wrapper: Callable[[], Message], fallback: Callable[[], Message],
+                  cleanup: Callable[[bool], None] = None) -> 'Future[Message]':
+        """
+        Run func(*args) in the process pool.
+
+        :param func: A picklable function returning whether the transcoding succeeded
+        :param wrapper: Called to build the message once func succeeded
+        :param fallback: Called to build the placeholder message on failure, timeout or full queue
+        :param cleanup: Called once the job is over, even after a timeout,
+                        with whether the message built by wrapper was delivered
+        :return: A future resolved with the message to be delivered
+        """
+        result: 'Future[Message]' = Future()
+        result_lock = threading.Lock()
+
+        def finish(build: Callable[[], Message]) -> bool:
+            with result_lock:
+                if result.done():
+                    return False
+                try:
+                    result.set_result(build())
+                except Exception as e:
+                    result.set_exception(e)
+                    return False
+                return True
+
+        def release(delivered: bool):
+            if cleanup:
+                try:
+                    cleanup(delivered)
+                except Exception as e:
+                    logger.warning(f"Failed to clean up after transcoding! {e}")
+
+        if not self.slots.acquire(blocking=False):
+            logger.warning("Transcoding queue is full, delivering the placeholder instead.")
+            finish(fallback)
+            release(False)
+            return result
+
+        def on_timeout():
+            logger.warning(f"Transcoding timed out after {self.timeout}s, delivering the placeholder instead.")
+            finish(fallback)
+            if not future.cancel():  # Already running, the worker is hung
+                self._reset_executor(executor, terminate=True)
+
+        timer = threading.Timer(self.timeout, on_timeout)
+        timer.daemon = True
+
+        executor = self._get_executor()
+
+        def on_done(future: Future):
+            self.slots.release()
+            timer.cancel()
+            try:
+                succeeded = False if future.cancelled() else future.result()
+            except Exception as e:
+                logger.warning(f"Transcoding failed! {e}")
+                if isinstance(e, BrokenProcessPool):
+                    self._reset_executor(executor)
+                succeeded = False
+            delivered = finish(wrapper if succeeded else fallback) and succeeded
+            release(delivered)
+
+        try:
+            future = executor.submit(func, *args)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                self._reset_executor(executor)
+            self.slots.release()
+            logger.warning(f"Failed to submit the transcoding job! {e}")
+            finish(fallback)
+            release(False)
+            return result
+        timer.start()
+        future.add_done_callback(on_done)
+        return result
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
@@ -0,0 +1,96 @@
+# coding: utf-8
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+
+class UploadIndex:
+    """
+    Persistent index of picture MD5s already uploaded to OPQBot.
+
+    Pictures found here can be resent by MD5 reference instead of uploading
+    the whole payload again.
+    """
+
+    def __init__(self, path: Union[str, Path], ttl: int = 3 * 86400, max_size: int = 10000,
+                 save_interval: int = 10):
+        """
+        :param path: The JSON file the index is persisted to
+        :param ttl: Seconds an uploaded picture is considered reusable
+        :param max_size: Max number of MD5s to remember, least recently used are dropped first
+        :param save_interval: Min seconds between two writes of the index file
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.entries: 'OrderedDict[str, float]' = OrderedDict()  # md5 -> upload time
+        self.last_save = 0
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load the upload index, starting with an empty one. {e}")
+            return
+        now = time.time()
+        with self.lock:
+            for md5, uploaded_at in sorted(entries.items(), key=lambda item: item[1]):
+                if now - uploaded_at < self.ttl:
+                    self.entries[md5] = uploaded_at
+
+    def __contains__(self, md5: str) -> bool:
+        with self.lock:
+            uploaded_at = self.entries.get(md5)
+            if uploaded_at is None:
+                return False
+            if time.time() - uploaded_at >= self.ttl:
+                del self.entries[md5]
+                self.dirty = True
+                return False
+            self.entries.move_to_end(md5)
+            return True
+
+    def add(self, md5: str):
+        with self.lock:
+            self.entries.pop(md5, None)
+            self.entries[md5] = time.time()
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.dirty = True
+        if time.time() - self.last_save >= self.save_interval:
+            self.save()
+
+    def discard(self, md5: str):
+        with self.lock:
+            if self.entries.pop(md5, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = dict(self.entries)
+            self.dirty = False
+            self.last_save = time.time()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=self.path.parent, prefix='.', delete=False) as f:
+                json.dump(entries, f)
+            os.replace(f.name, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to save the upload index. {e}")
@@ -1,47 +1,147 @@
+import base64
+import hashlib
 import logging
-import tempfile
+from typing import Callable, IO, Tuple, Union
 
-import requests
+from efb_qq_plugin_iot.Downloader import Downloader
+from efb_qq_plugin_iot.IOTConfig import IOTConfig
+from efb_qq_plugin_iot.IOTFactory import IOTFactory
+from efb_qq_plugin_iot.MediaBuffer import MediaBuffer
 
 
-def download_user_avatar(uid: str) -> tempfile:
-    url = "https://q1.qlogo.cn/g?b=qq&nk={}&s=0".format(uid)
-    return download_file(url)
+def user_avatar_url(uid: str, size: int = 0) -> str:
+    """
+    :param uid: QQ number of the user
+    :param size: Size variant of the avatar (40, 100, 140 or 640), 0 for the original size
+    """
+    return "https://q1.qlogo.cn/g?b=qq&nk={}&s={}".format(uid, size)
+
 
+def group_avatar_url(uid: str, size: int = 0) -> str:
+    """
+    :param uid: Group ID
+    :param size: Size variant of the avatar (40, 100, 140 or 640), 0 for the original size
+    """
+    return "https://p.qlogo.cn/gh/{}/{}/{}".format(uid, uid, size if size else "")
 
-def download_group_avatar(uid: str) -> tempfile:
-    url = "https://p.qlogo.cn/gh/{}/{}/".format(uid, uid)
-    return download_file(url)
 
+def download_user_avatar(uid: str, size: int = 0) -> IO:
+    return download_file(user_avatar_url(uid, size))
 
-def download_file(url: str, retry: int = 3) -> tempfile:
+
+def download_group_avatar(uid: str, size: int = 0) -> IO:
+    return download_file(group_avatar_url(uid, size))
+
+
+def get_downloader() -> Downloader:
+    """
+    Get the shared downloader, create one from the client config if not initialized yet
+    """
+    if IOTFactory.downloader is None:
+        IOTFactory.downloader = Downloader.from_config(IOTConfig.configs)
+    return IOTFactory.downloader
+
+
+def download_file(url: str, retry: int = None, max_size: int = None) -> IO:
     """
     A function that downloads files from given URL
     Remember to close the file once you are done with the file!
 
-    :param retry: The max retries before giving up
+    :param retry: The max attempts before giving up, use the downloader setting by default
     :param url: The URL that points to the file
+    :param max_size: Max number of bytes downloaded, use the downloader setting by default
+    :raise DownloadTooLarge: The file is larger than max_size
     """
-    count = 1
-    while True:
+    with IOTFactory.metrics.time('download'):
+        return get_downloader().download(url, retry=retry, max_size=max_size)
+
+
+def download_media(url: Union[str, Callable[[], str]], md5: str = None, ident: str = None,
+                   max_size: int = None) -> IO:
+    """
+    Download media through the media cache, cache hits cost no network I/O
+    Remember to close the file once you are done with the file!
+
+    :param url: The URL that points to the file, or a function returning it
+                when an extra API call is needed to resolve the URL
+    :param md5: The MD5 of the content carried by the OPQ payload, if any
+    :param ident: Stable identifier used as the cache key when md5 is missing, the URL by default
+    :param max_size: Max number of bytes downloaded, use the downloader setting by default
+    """
+    cache = IOTFactory.media_cache
+    key = None
+    if cache:
+        key = cache.key(md5=md5, ident=ident or (url if isinstance(url, str) else None))
+    if key:
+        file = cache.get(key)
+        if file:
+            return file
+    file = download_file(url if isinstance(url, str) else url(), max_size=max_size)
+    if md5 and isinstance(file, MediaBuffer):
+        file.md5 = md5  # Names the media without a path
+    if key:
         try:
-            file = tempfile.NamedTemporaryFile()
-            r = requests.get(url, stream=True, timeout=10)
-            r.raise_for_status()  # Replace this with better error handling.
-
-            for chunk in r.iter_content(1024):
-                file.write(chunk)
-        except Exception as e:
-            logging.getLogger(__name__).warning(f"Error occurred when downloading {url}. {e}")
-            if count >= retry:
-                logging.getLogger(__name__).warning(f"Maximum retry reached. Giving up.")
-                raise e
-            count += 1
+            cached = cache.put(key, file)
+        except OSError as e:
+            logging.getLogger(__name__).warning(f"Failed to store {key} in the media cache. {e}")
         else:
-            break
+            if cached and getattr(file, 'in_memory', False):
+                # The cached copy is already on disk, spilling the buffer to get a path would write it again
+                file.close()
+                return cached
+            if cached:
+                cached.close()
     return file
 
 
+def encode_file_base64(file: IO, chunk_size: int = 192 * 1024) -> Tuple[str, str]:
+    """
+    Base64-encode a file and compute its MD5 in a single streaming pass.
+    Only one chunk of the raw content is held in memory at a time, the encoded
+    chunks are joined once at the end.
+
+    :param file: The file to be encoded, read from the beginning
+    :param chunk_size: Size of each chunk read from the file
+    :return: The base64 encoded content and the hex MD5 of the raw content
+    """
+    file.seek(0)
+    md5 = hashlib.md5()
+    # Aligned on the 3-byte groups of base64, so that chunks encode without padding
+    chunk_size = max(3, chunk_size - chunk_size % 3)
+    encoded = []
+    pending = b''  # The remainder of a short read, carried to the next chunk
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        md5.update(chunk)
+        if pending:
+            chunk = pending + chunk
+        cut = len(chunk) - len(chunk) % 3
+        encoded.append(base64.b64encode(memoryview(chunk)[:cut]).decode('ascii'))
+        pending = chunk[cut:]
+    encoded.append(base64.b64encode(pending).decode('ascii'))
+    return ''.join(encoded), md5.hexdigest()
+
+
+def hash_file_md5(file: IO, chunk_size: int = 192 * 1024) -> str:
+    """
+    Compute the MD5 of a file from the beginning, position is left at the end of file
+
+    :param file: The file to be hashed
+    :param chunk_size: Size of each chunk read from the file
+    :return: The hex MD5 of the content
+    """
+    file.seek(0)
+    md5 = hashlib.md5()
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
 def process_quote_text(text: str, max_length: int) -> str:
     """
     Simple wrapper for processing quoted text
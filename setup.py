@@ -50,6 +50,9 @@ setup(
         "cachetools",
         "pydub"
     ],
+    extras_require={
+        'images': ['Pillow'],
+    },
     entry_points={
         'ehforwarderbot.qq.plugin': 'iot = efb_qq_plugin_iot:IOTBot'
     },
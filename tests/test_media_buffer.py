@@ -0,0 +1,29 @@
+# coding: utf-8
+from ehforwarderbot import MsgType, coordinator
+
+from efb_qq_plugin_iot.IOTBot import iot
+from efb_qq_plugin_iot.MediaBuffer import BufferPool
+from efb_qq_plugin_iot.MsgDecorator import efb_image_wrapper
+
+STICKER = b'\x89PNG\r\n\x1a\n' + b'\x00' * 4096
+
+
+def test_sticker_delivered_from_memory(monkeypatch):
+    pool = BufferPool(threshold=64 * 1024)
+    file = pool.create()
+    file.write(STICKER)
+    file.seek(0)
+    file.md5 = 'D41D8CD98F00B204E9800998ECF8427E'
+    delivered = []
+
+    def send_message(msg):
+        delivered.append((msg.type, msg.mime, msg.filename, msg.path, msg.file.read()))
+        return msg
+
+    monkeypatch.setattr(coordinator, 'master', object(), raising=False)
+    monkeypatch.setattr(coordinator, 'send_message', send_message)
+    iot.deliver_message(efb_image_wrapper(file), 'friend_1_1_0', None, None)
+
+    assert delivered == [(MsgType.Image, 'image/png', 'd41d8cd98f00b204e9800998ecf8427e.png', None, STICKER)]
+    assert file.in_memory
+    assert pool.stats()['spilled'] == 0